@@ -1,6 +1,10 @@
 #! /usr/bin/env python3
 
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+import argparse
+import concurrent.futures
+import errno
+import functools
 import json
 import logging
 import os
@@ -9,26 +13,25 @@ import pathlib
 import shutil
 import sqlite3
 import subprocess
+import threading
 import time
 import tomllib
 import urllib.parse
 from urllib.parse import urljoin
 
-from audio_book_shelf import AudioBookShelf
-import audible
-import audible_cli
+from audible_client import AudibleAPI, RESPONSE_GROUP_PROFILES
+import audible_download
+import import_schema
+from audio_book_shelf import AudioBookShelf, ItemResolver, MetadataBatch
+from ffmpeg_pool import ConversionPool
+import metrics
+import mp4_chapters
+import pipeline
 import ffmpeg
 import requests
 
 logger = logging.getLogger(__name__)
 
-# Haven't figured out how to do podcasts/episodes yet
-asin_to_skip = ['B0CK8RZ2GR'
-               ,'B0BR2QK8M7'
-               ,'B0BJ7BV4PH'
-               ,'B08JCLTS2P'
-               ]
-
 config_filename = os.getenv("AUDIBLE_AUDIOBOOKSHELF_CONFIG_FILE")
 if config_filename:
     config_file = pathlib.Path(config_filename)
@@ -42,6 +45,9 @@ with config_file.open("rb") as f:
     config = tomllib.load(f)
 
 shelf = AudioBookShelf(config=config["audiobookshelf"])
+audible_api = AudibleAPI.from_config(config)
+conversion_pool = ConversionPool.from_config(config.get('ffmpeg', {}))
+content_cache = audible_download.ContentCache.from_config(config)
 
 #config = {}
 #config['db'] = pathlib.Path.home() / '.audible' / 'audiobookshelf.db'
@@ -64,6 +70,8 @@ shelf = AudioBookShelf(config=config["audiobookshelf"])
 #config['tmp_dir'] = '/tmp'
 
 RELEASE_DATE_FORMAT = "%Y-%m-%d"
+SYNC_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.000Z"
+LIBRARY_SYNC_OVERLAP = timedelta(days=1)
 
 
 
@@ -71,82 +79,423 @@ class ImportDatabase:
     '''
     Tracks what files have already been imported into audiobookshelf to prevent
     constant redownloading, reconverting, and/or reimporting of files
+
+    The import pipeline reads and records books from several worker threads,
+    so the connection is shared between threads and guarded by a lock.
+    Records are kept in memory and written in batches of `commit_every`, or
+    after `commit_interval` seconds, whichever comes first; call close() (or
+    flush()) when done so the last batch is not lost.  Each batch is written
+    in one short transaction, so the product and download caches, which
+    keep their tables in the same file, are not locked out in between.
     '''
-    def __init__(self, db_file):
-        self.con = sqlite3.connect(db_file)
+    MIGRATIONS = import_schema.MIGRATIONS
+
+    # Stay well below SQLite's limit on the number of bound parameters
+    MAX_QUERY_PARAMETERS = 500
+
+    def __init__(self, db_file, commit_every=10, commit_interval=30.0):
+        self.con = sqlite3.connect(db_file, check_same_thread=False)
         self.cur = self.con.cursor()
-        #self.setup_database(config['db'])
-        self.setup_database(config['database']['location'])
+        self.lock = threading.Lock()
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        # Statements not yet written, by (table, asin), so a later record
+        # for the same book replaces an earlier one
+        self._pending = {}
+        self._last_commit = time.monotonic()
+        self.setup_database()
+
+    def already_imported(self, asins, table='books'):
+        '''
+        Return the subset of the given ASINs that have already been imported,
+        answering a whole library page with a single query
+        '''
+        asins = list(asins)
+        imported = set()
+        with self.lock:
+            for i in range(0, len(asins), self.MAX_QUERY_PARAMETERS):
+                chunk = asins[i:i + self.MAX_QUERY_PARAMETERS]
+                placeholders = ', '.join('?' * len(chunk))
+                res = self.cur.execute(f'SELECT asin FROM {table} '
+                                       f'WHERE asin IN ({placeholders})'
+                                      ,chunk
+                                      )
+                imported.update(row[0] for row in res)
+            imported.update(asin for asin in asins
+                            if (table, asin) in self._pending
+                           )
+        return imported
 
     def is_book_already_imported(self, asin):
         '''
         Check whether specified book has already been imported
         '''
-        res = self.cur.execute("SELECT asin FROM books WHERE asin = ?", (asin,))
-        return len(res.fetchall()) > 0
+        return bool(self.already_imported([asin]))
 
     def is_podcast_episode_already_imported(self, asin):
         '''
         Check whether specified book has already been imported
         '''
-        res = self.cur.execute("SELECT asin FROM podcast_episodes "
-                               "WHERE asin = ?"
-                              ,(asin,)
-                              )
-        return len(res.fetchall()) > 0
+        return bool(self.already_imported([asin], table='podcast_episodes'))
 
     def record_book_as_imported(self, asin, title, abs_path, abs_dir):
         '''
         Record a book as imported
         '''
-        # In case abs_dir or abs_path are strings, convert to a pathlib.Paths
-        abs_dir = pathlib.Path(abs_dir)
-        abs_path = pathlib.Path(abs_path)
-
-        self.cur.execute('INSERT INTO books (asin, title, location) '
-                         'values (?, ?, ?)'
-                        ,(asin, title, abs_path.relative_to(abs_dir).as_posix())
-                        )
-        self.con.commit()
+        self._record('books', asin, title, abs_path, abs_dir)
 
     def record_episode_as_imported(self, asin, title, abs_path, abs_dir):
         '''
         Record a book as imported
         '''
+        self._record('podcast_episodes', asin, title, abs_path, abs_dir)
+
+    def _record(self, table, asin, title, abs_path, abs_dir):
         # In case abs_dir or abs_path are strings, convert to a pathlib.Paths
         abs_dir = pathlib.Path(abs_dir)
         abs_path = pathlib.Path(abs_path)
 
-        self.cur.execute('INSERT INTO podcast_episodes (asin, title, location) '
-                         'values (?, ?, ?)'
-                        ,(asin, title, abs_path.relative_to(abs_dir).as_posix())
-                        )
+        with self.lock:
+            self._pending[(table, asin)] = (
+                 f'INSERT OR REPLACE INTO {table} (asin, title, location) '
+                 'values (?, ?, ?)'
+                ,(asin, title, abs_path.relative_to(abs_dir).as_posix())
+            )
+            if (   len(self._pending) >= self.commit_every
+               or time.monotonic() - self._last_commit >= self.commit_interval
+               ):
+                self._commit()
+
+    def get_sync_state(self, key):
+        '''
+        Return a stored sync bookkeeping value, or None if it was never set
+        '''
+        with self.lock:
+            row = self.cur.execute('SELECT value FROM sync_state WHERE key = ?'
+                                  ,(key,)
+                                  ).fetchone()
+        return row[0] if row else None
+
+    def set_sync_state(self, key, value):
+        '''
+        Store a sync bookkeeping value
+        '''
+        with self.lock:
+            self.cur.execute('INSERT OR REPLACE INTO sync_state (key, value) '
+                             'values (?, ?)'
+                            ,(key, value)
+                            )
+            self._commit()
+
+    def cache_library_items(self, items):
+        '''
+        Store Audible library items in the local library cache
+
+        Args:
+            items (list): Library item dicts as returned by the Audible API.
+        '''
+        with self.lock:
+            self.cur.executemany('INSERT OR REPLACE INTO library_items '
+                                 '(asin, data) values (?, ?)'
+                                ,((item['asin'], json.dumps(item))
+                                  for item in items
+                                 )
+                                )
+            self._commit()
+
+    def prune_library_cache(self, keep):
+        '''
+        Drop every cached library item whose ASIN is not in keep
+        '''
+        with self.lock:
+            cached = {row[0] for row
+                      in self.cur.execute('SELECT asin FROM library_items')
+                     }
+            self.cur.executemany('DELETE FROM library_items WHERE asin = ?'
+                                ,((asin,) for asin in cached - set(keep))
+                                )
+            self._commit()
+
+    def iter_cached_library(self, page_size=100):
+        '''
+        Yield the local copy of the Audible library one page at a time
+        '''
+        last_asin = ''
+        while True:
+            with self.lock:
+                rows = self.cur.execute('SELECT asin, data FROM library_items '
+                                        'WHERE asin > ? ORDER BY asin LIMIT ?'
+                                       ,(last_asin, page_size)
+                                       ).fetchall()
+            if not rows:
+                return
+            last_asin = rows[-1][0]
+            yield [json.loads(data) for _, data in rows]
+
+    def load_job(self, asin):
+        '''
+        Return the (state, data) last saved for a book part way through the
+        import, or None if there is none
+        '''
+        with self.lock:
+            if ('import_jobs', asin) in self._pending:
+                return None
+            row = self.cur.execute('SELECT state, data FROM import_jobs '
+                                   'WHERE asin = ?'
+                                  ,(asin,)
+                                  ).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def save_job(self, asin, state, data):
+        '''
+        Save the state a book has reached in the import and what it takes to
+        resume from there
+
+        This is committed straight away: it is a checkpoint.
+        '''
+        with self.lock:
+            self._pending.pop(('import_jobs', asin), None)
+            self.cur.execute('INSERT OR REPLACE INTO import_jobs '
+                             '(asin, state, data, updated_at) '
+                             'values (?, ?, ?, ?)'
+                            ,(asin, state, json.dumps(data), time.time())
+                            )
+            self._commit()
+
+    def clear_job(self, asin):
+        '''
+        Forget the import progress of a book
+        '''
+        with self.lock:
+            self._pending[('import_jobs', asin)] = (
+                 'DELETE FROM import_jobs WHERE asin = ?'
+                ,(asin,)
+            )
+
+    def get_chapters(self, asin, source):
+        '''
+        Return the chapters cached for a book from the given chapter source,
+        or None if there are none
+        '''
+        with self.lock:
+            row = self.cur.execute('SELECT data FROM chapters '
+                                   'WHERE asin = ? AND source = ?'
+                                  ,(asin, source)
+                                  ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def cache_chapters(self, asin, source, chapters):
+        '''
+        Cache the chapters of a book read from the given chapter source
+        '''
+        with self.lock:
+            self.cur.execute('INSERT OR REPLACE INTO chapters '
+                             '(asin, source, data) values (?, ?, ?)'
+                            ,(asin, source, json.dumps(chapters))
+                            )
+            self._commit()
+
+    def _commit(self):
+        for sql, parameters in self._pending.values():
+            self.cur.execute(sql, parameters)
         self.con.commit()
+        self._pending.clear()
+        self._last_commit = time.monotonic()
 
-    def setup_database(self, filename):
+    def flush(self):
         '''
-        Set up database tables
+        Commit any records not yet written
         '''
-        con = sqlite3.connect(filename)
-        cur = con.cursor()
-        cur.execute('CREATE TABLE if not exists books(asin, title, location)')
-        cur.execute('CREATE TABLE if not exists podcast_episodes(asin, title, '
-                    'location)'
-                   )
+        with self.lock:
+            self._commit()
+
+    def close(self):
+        '''
+        Commit any pending records and close the database
+        '''
+        with self.lock:
+            self._commit()
+            self.con.close()
+
+    def setup_database(self):
+        '''
+        Set up database tables, upgrading the schema of an existing database
+        '''
+        with self.lock:
+            self.cur.execute('PRAGMA synchronous=NORMAL')
+            import_schema.upgrade(self.con)
+
+
+# States a book goes through in the import pipeline, in order
+JOB_STATES = ('downloaded', 'converted', 'shelved', 'abs_linked'
+             ,'chapters_synced'
+             )
+# Files a job needs to resume from each state, by job key
+JOB_ARTIFACTS = {'downloaded': ('aax_paths', 'aaxc_paths', 'voucher_paths')
+                ,'converted': ('m4b_files',)
+                ,'shelved': ('shelved_files',)
+                ,'abs_linked': ('shelved_files',)
+                ,'chapters_synced': ()
+                }
+# Other job values that later stages need
+JOB_VALUES = ('title', 'abs_path', 'book_id')
+
+
+def artifact_record(path):
+    '''
+    Describe a file produced by a pipeline stage so it can be checked before
+    it is reused
+
+    The size and modification time are recorded, as the content cache does.
+    A SHA-256 checksum is only added with [database] checksum_artifacts set,
+    taken from the content cache for downloads it already checksummed.
+    '''
+    stat = os.stat(path)
+    record = {'path': pathlib.Path(path).as_posix()
+             ,'size': stat.st_size
+             ,'mtime_ns': stat.st_mtime_ns
+             }
+    if config['database'].get('checksum_artifacts', False):
+        record['sha256'] = (   content_cache.checksum(path)
+                            or audible_download.file_sha256(path)
+                           )
+    return record
+
+
+def job_artifact_record(job, path):
+    '''
+    Return the record of a job's file, describing each file only once per
+    run: records made at an earlier state, restored from a previous run or
+    carried over by carry_artifact_records() are reused
+    '''
+    records = job.setdefault('artifact_records', {})
+    key = pathlib.Path(path).as_posix()
+    if key not in records:
+        records[key] = artifact_record(path)
+    return records[key]
+
+
+def carry_artifact_records(job, sources, destinations):
+    '''
+    Reuse the records of files that were moved (not changed) for their new
+    paths
+    '''
+    records = job.setdefault('artifact_records', {})
+    for src, dest in zip(sources, destinations):
+        record = records.get(pathlib.Path(src).as_posix())
+        if record is not None:
+            dest = pathlib.Path(dest).as_posix()
+            records[dest] = {**record, 'path': dest}
+
+
+def artifact_is_intact(record):
+    '''
+    Check that a file recorded by artifact_record() is still there, unchanged
+    '''
+    path = pathlib.Path(record['path'])
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return False
+    if stat.st_size != record['size']:
+        return False
+    if stat.st_mtime_ns != record.get('mtime_ns', stat.st_mtime_ns):
+        return False
+    return (   'sha256' not in record
+           or audible_download.file_sha256(path) == record['sha256']
+           )
+
+
+def job_reached(job, state):
+    '''
+    Check whether a job has already been through the given state
+    '''
+    return (    job.get('state') is not None
+           and JOB_STATES.index(job['state']) >= JOB_STATES.index(state)
+           )
 
 
-def extract_chapters(input_file):
+def checkpoint_job(job, db, state):
+    '''
+    Record that a job reached a state, with the artifacts and values needed
+    to resume it from there
+    '''
+    job['state'] = state
+    if db is None:
+        return
+    data = {'artifacts': {key: [job_artifact_record(job, path)
+                                for path in job[key]
+                               ]
+                          for key in JOB_ARTIFACTS[state]
+                          if key in job
+                         }
+           ,'values': {key: str(job[key]) for key in JOB_VALUES if key in job}
+           }
+    db.save_job(job['book']['asin'], state, data)
+
+
+def restore_job(job, db):
+    '''
+    Pick a job up from the last state a previous run checkpointed, if the
+    files that state left behind are intact
+
+    Returns:
+        dict: The job, with its state, artifacts and values restored.
+    '''
+    logger = logging.getLogger(__name__)
+    asin = job['book']['asin']
+    saved = db.load_job(asin)
+    if saved is None:
+        return job
+    state, data = saved
+    records = [record
+               for key_records in data['artifacts'].values()
+               for record in key_records
+              ]
+    if not all(artifact_is_intact(record) for record in records):
+        logger.warning("Files saved for %s at state %s have changed or gone, "
+                       "starting it over"
+                      ,asin
+                      ,state
+                      )
+        db.clear_job(asin)
+        return job
+    logger.info("Resuming %s after state %s", asin, state)
+    job['artifact_records'] = {record['path']: record for record in records}
+    for key, key_records in data['artifacts'].items():
+        job[key] = [pathlib.Path(record['path']) for record in key_records]
+    for key, value in data['values'].items():
+        job[key] = pathlib.Path(value) if key == 'abs_path' else value
+    job['state'] = state
+    return job
+
+
+def extract_chapters(input_file, **input_options):
     '''
     Extract chapter list and timings from a single AAX or AAXC file.
 
+    The chapters are read straight from the MP4 atoms (see mp4_chapters);
+    ffprobe is only run for files that reader finds no chapters in.
+
     Args:
         input_file (str or Path): Input file path.
+        input_options: Demuxer options for ffprobe, e.g. activation_bytes
+            for an encrypted AAX file.
 
     Returns:
         A list of dictionaries with 'start_time', 'end_time', and 'title' for each chapter.
     '''
     logger = logging.getLogger(__name__)
-    chapters = []
+    try:
+        chapters = mp4_chapters.read_chapters(input_file)
+    except (OSError, mp4_chapters.MP4Error) as e:
+        logger.debug("Could not read chapters of %s directly: %s"
+                    ,input_file
+                    ,e
+                    )
+        chapters = []
+    if chapters:
+        return chapters
 
     try:
         input_file = str(pathlib.Path(input_file))
@@ -155,8 +504,10 @@ def extract_chapters(input_file):
             '-v', 'quiet',
             '-print_format', 'json',
             '-show_chapters',
-            '-i', input_file
         ]
+        for key, value in input_options.items():
+            cmd.extend([f'-{key}', str(value)])
+        cmd.extend(['-i', input_file])
         result = subprocess.run(cmd, stdout=subprocess.PIPE
                                ,stderr=subprocess.PIPE
                                ,text=True
@@ -181,284 +532,702 @@ def extract_chapters(input_file):
     return chapters
 
 
-def get_audible_library(auth=None):
+def _flatten_chapters(chapters):
+    for chapter in chapters:
+        yield chapter
+        yield from _flatten_chapters(chapter.get('chapters', []))
+
+
+def voucher_chapters(voucher_path):
+    '''
+    Read the chapters Audible sent along with an AAXC license
+
+    Returns:
+        tuple: (chapters in the search/chapters format, length of the title
+               in ms), or ([], 0) if the voucher holds no chapter info.
+    '''
+    voucher = json.load(voucher_path.open('r'))
+    info = (voucher['content_license']
+                   ['content_metadata']
+                   .get('chapter_info')
+           )
+    if not info:
+        return [], 0
+    chapters = sorted(_flatten_chapters(info['chapters'])
+                     ,key=lambda chapter: chapter['start_offset_ms']
+                     )
+    return ([{'startOffsetMs': chapter['start_offset_ms']
+             ,'startOffsetSec': chapter['start_offset_ms'] / 1000
+             ,'lengthMs': chapter['length_ms']
+             ,'title': chapter['title']
+             }
+             for chapter in chapters
+            ]
+           ,info['runtime_length_ms']
+           )
+
+
+def file_chapters(path):
+    '''
+    Read the chapters of a decrypted audio file
+
+    Returns:
+        tuple: (chapters in the search/chapters format, length of the file
+               in ms).
+    '''
+    chapters = extract_chapters(path)
+    if chapters:
+        length_ms = round(chapters[-1]['end_time'] * 1000)
+    else:
+        length_ms = round(float(ffmpeg.probe(pathlib.Path(path).as_posix())
+                                ['format']['duration']) * 1000)
+    return ([{'startOffsetMs': round(chapter['start_time'] * 1000)
+             ,'startOffsetSec': chapter['start_time']
+             ,'lengthMs': round((chapter['end_time'] - chapter['start_time'])
+                                * 1000
+                               )
+             ,'title': chapter['title']
+             }
+             for chapter in chapters
+            ]
+           ,length_ms
+           )
+
+
+def local_chapters(job):
+    '''
+    Read a shelved book's chapters without going over the network: from
+    the chapter info in its AAXC vouchers where there are vouchers, else
+    from the shelved files themselves
+
+    The chapters of each part are shifted by the length of the parts
+    before it, as audiobookshelf plays the files of an item back to back.
+    '''
+    voucher_paths = job.get('voucher_paths') or []
+    if (    voucher_paths
+        and len(voucher_paths) == len(job['shelved_files'])
+        and all(path.exists() for path in voucher_paths)
+       ):
+        parts = [voucher_chapters(path) for path in voucher_paths]
+    else:
+        parts = []
+    if not parts or not all(chapters for chapters, _ in parts):
+        parts = [file_chapters(path) for path in job['shelved_files']]
+    chapters = []
+    offset_ms = 0
+    for part_chapters, length_ms in parts:
+        for chapter in part_chapters:
+            start_ms = chapter['startOffsetMs'] + offset_ms
+            chapters.append({**chapter
+                            ,'startOffsetMs': start_ms
+                            ,'startOffsetSec': start_ms / 1000
+                            })
+        offset_ms += length_ms
+    return chapters
+
+
+def book_chapters(job, db):
+    '''
+    Return the chapters to give a shelved book, in the search/chapters
+    format, from the [audiobookshelf] chapter_source:
+
+        remote: audiobookshelf's chapter search (Audnexus), the default
+        local:  the AAXC voucher or the decrypted files (see
+                local_chapters()), falling back to remote if they have no
+                chapters
+
+    Chapters are cached by ASIN in the import database.
+    '''
+    logger = logging.getLogger(__name__)
+    asin = job['book']['asin']
+    source = config['audiobookshelf'].get('chapter_source', 'remote')
+    chapters = db.get_chapters(asin, source)
+    if chapters is not None:
+        return chapters
+    chapters = []
+    if source == 'local':
+        chapters = local_chapters(job)
+        if not chapters:
+            logger.info("No local chapters for %s, looking them up", asin)
+    if not chapters:
+        chapters = shelf.fetch_chapters(asin)
+    db.cache_chapters(asin, source, chapters)
+    return chapters
+
+
+def iter_audible_library_pages(purchased_after=None
+                              ,page_size=100
+                              ,profile=None
+                              ):
+    '''
+    Yield the Audible library one page (list of items) at a time, or only
+    the titles purchased after the given time (an ISO 8601 UTC timestamp)
+
+    profile names the RESPONSE_GROUP_PROFILES entry to request; by default
+    the [audible] library_profile setting, or dedup-only.
+
+    The next page is requested in the background while the caller handles
+    the current one.
+    '''
     logger = logging.getLogger(__name__)
-    if not auth:
-        auth = audible.Authenticator.from_file(config['audible']['auth_file'])
-    with audible.Client(auth=auth) as client:
-        library = []
+    if profile is None:
+        profile = config['audible'].get('library_profile', 'dedup-only')
+    params = {}
+    if purchased_after:
+        params['purchased_after'] = purchased_after
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as prefetch:
+        def fetch(page):
+            logger.info(f"...Retrieving library index page {page}...")
+            with metrics.timer('audible_request', endpoint='library'):
+                items = audible_api.get("1.0/library"
+                                       ,num_results=page_size
+                                       ,page=page
+                                       ,**params
+                                       ,response_groups=RESPONSE_GROUP_PROFILES[profile]
+                                       )['items']
+            metrics.count('library_items_fetched', len(items))
+            return items
+
         page = 1
+        pending = prefetch.submit(fetch, page)
         while True:
-            logger.info(f"...Retrieving library index page {page}...")
-            books = client.get("1.0/library"
-                              ,num_results=100
-                              ,page=page
-                              ,response_groups=("contributors, media, "
-                                                "product_attrs, product_desc, "
-                                                "product_extended_attrs, "
-                                                "sample, series, "
-                                                "ws4v, origin, relationships, "
-                                                "categories, "
-                                                "category_ladders, "
-                                                "origin_asin"
-                                               )
-                              )
-            library.extend(books['items'])
-            if len(books['items']) == 0:
-                break
-            page += 1
-        return library
+            items = pending.result()
+            last_page = len(items) < page_size
+            if not last_page:
+                page += 1
+                pending = prefetch.submit(fetch, page)
+            if items:
+                yield items
+            if last_page:
+                return
+
+
+def sync_audible_library(db, full=False):
+    '''
+    Bring the local copy of the Audible library up to date, yielding the
+    library one page at a time
+
+    Only titles purchased since the last successful sync are requested from
+    Audible, unless a full sync is asked for or no sync has been done yet.  A
+    full sync streams pages straight from Audible as they arrive, and once
+    the last page has been seen drops cached titles that are no longer in the
+    library.
+    '''
+    logger = logging.getLogger(__name__)
+    started = datetime.now(timezone.utc)
+    last_sync = db.get_sync_state('library_synced_at')
+    if full or last_sync is None:
+        logger.info("Full library sync...")
+        seen = set()
+        for page in iter_audible_library_pages():
+            db.cache_library_items(page)
+            seen.update(item['asin'] for item in page)
+            yield page
+        db.prune_library_cache(keep=seen)
+    else:
+        # Overlap with the previous sync a little in case a purchase shows
+        # up in the library after its purchase date
+        since = (datetime.strptime(last_sync, SYNC_TIME_FORMAT)
+                         .replace(tzinfo=timezone.utc)
+                 - LIBRARY_SYNC_OVERLAP
+                )
+        logger.info("Syncing titles purchased since %s...", since)
+        new_items = 0
+        for page in iter_audible_library_pages(
+                         purchased_after=since.strftime(SYNC_TIME_FORMAT)
+                        ):
+            db.cache_library_items(page)
+            new_items += len(page)
+        logger.info("%d new or changed titles", new_items)
+        yield from db.iter_cached_library()
+    db.set_sync_state('library_synced_at', started.strftime(SYNC_TIME_FORMAT))
 
 
-def get_audible_product(asin, auth=None):
-    logger = logging.getLogger(__name__)
-    if not auth:
-        auth = audible.Authenticator.from_file(config['audible']['auth_file'])
-    with audible.Client(auth=auth) as client:
-        product = client.get(f"1.0/catalog/products/{asin}"
-                            ,response_groups=("contributors, media, "
-                                              "product_attrs, product_desc, "
-                                              "product_extended_attrs, "
-                                              "sample, series, "
-                                              "ws4v, relationships, "
-                                              "categories, "
-                                              "category_ladders"
-                                             )
+def get_audible_product(asin, profile='full'):
+    '''
+    Fetch a product from the Audible catalog, requesting the response groups
+    of the named RESPONSE_GROUP_PROFILES entry
+
+    Products are served from the on-disk product cache while it is fresh.
+    '''
+    return audible_api.get_product(asin, profile=profile)
+
+
+def get_audible_products(asins, profile='full'):
+    '''
+    Fetch many products from the Audible catalog at once, many ASINs per
+    request (see [audible] products_per_request and catalog_workers)
+
+    Returns:
+        dict: Product by ASIN; ASINs the catalog does not know are left out.
+    '''
+    return audible_api.get_products(asins, profile=profile)
+
+
+def product_parts(product):
+    '''
+    Return the product itself, or for a multi-part book the product of each
+    part, in order
+    '''
+    if product.get('content_delivery_type') == 'MultiPartBook':
+        components = sorted((rel for rel in product.get('relationships') or []
+                             if rel['relationship_type'] == 'component'
+                            )
+                           ,key=lambda rel: rel['sort']
                            )
-        if 'product' in product:
-            return product['product']
-        return product
+        if components:
+            parts = get_audible_products((rel['asin'] for rel in components)
+                                        ,profile='import'
+                                        )
+            return [parts[rel['asin']] for rel in components]
+    return [product]
 
 
-def download_book_as_aax(asin, quality, download_dir, filename_mode='asin_ascii'):
-    logger = logging.getLogger(__name__)
-    os.chdir(download_dir)
-    audible_cli.cli.cli(['download'
-                        ,'--asin', asin
-                        ,'--quality', quality
-                        ,'--output-dir', download_dir
-                        ,'--filename-mode', filename_mode
-                        ,'--aax'
-                        ]
-                       ,standalone_mode=False
-                       )
+def download_chunk_size():
+    return config['files'].get('download_chunk_size'
+                              ,audible_download.DEFAULT_CHUNK_SIZE
+                              )
 
-    # Get downloaded filename
-    # Check for aax file
-    aax_path = list(pathlib.Path(config['files']['audible_download_dir'])
-                   .glob(f"{asin}*.aax")
-                   )
-    return aax_path
-
-
-def download_product_as_aax(asin
-                           ,quality
-                           ,download_dir
-                           ,filename_mode='asin_ascii'
-                           ,book=None
-                           ):
-    os.chdir(download_dir)
-    audible_cli.cli.cli(['download'
-                        ,'--asin', asin
-                        ,'--quality', quality
-                        ,'--output-dir', download_dir
-                        ,'--filename-mode', filename_mode
-                        ,'--aax'
-                        ]
-                       ,standalone_mode=False
-                       )
 
-    # Get downloaded filename
-    # Check for aax file
-    aax_paths = [p.resolve() for p in download_dir.glob(f'{asin}*.aax')]
-    if book and not aax_paths and book.get('relationships'):
-        parts = [rel for rel in book['relationships']
-                if rel['relationship_type'] == 'component'
-                ]
-        sorted_parts = sorted(parts, key=lambda x: x['sort'])
-        sorted_asins = [p['asin'] for p in sorted_parts]
-        aax_paths = []
-        for a in sorted_asins:
-            part_aax_paths = [   p.resolve()
-                             for p
-                             in download_dir.glob(f'{a}*.aax')
-                             ]
-            if part_aax_paths:
-                aax_paths.extend(part_aax_paths)
-    return aax_paths
+def download_part(part, kind, quality, download_dir, parent=None
+                 ,allow_mpeg=False
+                 ):
+    '''
+    Download one title, or one part of a multi-part book, as aax or aaxc,
+    reusing a verified copy from the content cache if there is one
+
+    Args:
+        part (dict): Product to download.
+        kind (str): "aax" or "aaxc".
+        quality (str): Audible download quality.
+        download_dir (pathlib.Path): Directory to download into.
+        parent (dict): For a part of a multi-part book, the book.
+        allow_mpeg (bool): For aaxc, accept a title only offered without
+                           DRM and download it as mp3 instead.
+    Returns:
+        pathlib.Path: The downloaded file (with its voucher next to it for
+                      aaxc, or with an .mp3 suffix for DRM-free content),
+                      or None if the title is not available as aax.
+    '''
+    path = content_cache.get(part['asin'], quality, kind)
+    if path is None and kind == 'aaxc' and allow_mpeg:
+        path = content_cache.get(part['asin'], quality, 'mp3')
+    if path is not None:
+        return path
+    if kind == 'aax':
+        source = audible_download.aax_source(audible_api
+                                            ,part
+                                            ,quality
+                                            ,parent=parent
+                                            )
+        if source is None:
+            return None
+    else:
+        source = audible_download.aaxc_source(audible_api
+                                             ,part
+                                             ,quality
+                                             ,parent=parent
+                                             ,allow_mpeg=allow_mpeg
+                                             )
+    path = audible_download.download_content(audible_api
+                                            ,source
+                                            ,download_dir
+                                            ,chunk_size=download_chunk_size()
+                                            )
+    content_cache.put(part['asin'], quality, source.kind, path)
+    return path
+
 
+def download_product_as_aax(asin, quality, download_dir, book=None):
+    '''
+    Download a product, or every part of a multi-part book, as aax
 
-def download_product_as_aaxc(asin
+    Returns:
+        list: Paths of the downloaded files in part order, or an empty list
+              if the product is not available as aax.
+    '''
+    product = book or get_audible_product(asin, profile='import')
+    parts = product_parts(product)
+    aax_paths = []
+    for part in parts:
+        path = download_part(part
+                            ,'aax'
                             ,quality
                             ,download_dir
-                            ,filename_mode='asin_ascii'
-                            ):
-    os.chdir(download_dir)
-    audible_cli.cli.cli(['download'
-                        ,'--asin', asin
-                        ,'--quality', quality
-                        ,'--output-dir', download_dir
-                        ,'--filename-mode', filename_mode
-                        ,'--aaxc'
-                        ]
-                       ,standalone_mode=False
-                       )
+                            ,parent=product if len(parts) > 1 else None
+                            )
+        if path is None:
+            return []
+        aax_paths.append(path)
+    return aax_paths
 
-    # Check for aaxc file
-    aaxc_paths = [p.resolve() for p in  download_dir.glob(f'{asin}*.aaxc')]
-    voucher_paths = [p.resolve() for p in download_dir.glob(f'{asin}*.voucher')]
+
+def download_product_as_aaxc(asin, quality, download_dir, book=None):
+    '''
+    Download a product, or every part of a multi-part book, as aaxc with the
+    vouchers needed to decrypt it
+
+    Returns:
+        tuple: (aaxc paths, voucher paths), in part order.
+    '''
+    product = book or get_audible_product(asin, profile='import')
+    parts = product_parts(product)
+    aaxc_paths = [download_part(part
+                               ,'aaxc'
+                               ,quality
+                               ,download_dir
+                               ,parent=product if len(parts) > 1 else None
+                               )
+                  for part in parts
+                 ]
+    voucher_paths = [path.with_suffix('.voucher') for path in aaxc_paths]
     return (aaxc_paths, voucher_paths)
 
 
-def download_podcast_episode(asin
-                            ,download_dir
-                            ,quality='best'
-                            ,filename_mode='asin_ascii'
-                            ):
-    #TODO
-    episode_m4b_path = None
-    aax_paths = download_product_as_aax(asin=asin
-                                       ,download_dir=download_dir
-                                       ,quality=quality
-                                       ,filename_mode=filename_mode
-                                       )
-    if aax_paths:
-        episode_m4b_path = convert_aax_to_m4b(aax_paths)
-    else:
-        aaxc_paths, voucher_paths = download_product_as_aaxc(
-                                         asin=asin
-                                        ,download_dir=download_dir
-                                        ,quality=quality
-                                        ,filename_mode=filename_mode
-                                        )
-        if aaxc_paths and voucher_paths:
-            episode_m4b_path = convert_aaxc_to_m4b(aaxc_paths, voucher_paths)
+def is_book_cached(book):
+    '''
+    Check whether the content cache holds every part of a book, in either
+    format
+    '''
+    quality = config['audible']['quality']
+    return all(   content_cache.get(part['asin'], quality, 'aax')
+               or content_cache.get(part['asin'], quality, 'aaxc')
+               for part in product_parts(book)
+              )
 
-    return episode_m4b_path
+
+def release_downloads(product):
+    '''
+    Let the content cache evict the downloads of a product, or of every part
+    of a multi-part book, now that they have been converted
+    '''
+    content_cache.release(part['asin'] for part in product_parts(product))
 
 
 def convert_aax_to_m4b(aax_paths, output_dir=None, book=None):
     if not output_dir:
-        output_dir = config['files']['tmp_dir']
+        output_dir = staging_dir()
     output_dir = pathlib.Path(output_dir)
     m4b_paths = []
+    jobs = []
     for aax_path in aax_paths:
         m4b_file = (output_dir / aax_path.name).with_suffix(".m4b")
-        (ffmpeg.input(aax_path.as_posix()
-                     ,activation_bytes=config['audible']['activation_bytes']
-                     )
-               .output(m4b_file.as_posix(), codec='copy')
-               .run()
-        )
+        jobs.append((ffmpeg.input(aax_path.as_posix()
+                                 ,activation_bytes=config['audible']['activation_bytes']
+                                 )
+                           .output(m4b_file.as_posix(), codec='copy')
+                    ,aax_path.name
+                    ))
         m4b_paths.append(m4b_file)
+    conversion_pool.run_all(jobs)
     return m4b_paths
 
 
+def voucher_input_options(voucher_path):
+    '''
+    Return the ffmpeg input options that decrypt the AAXC file belonging to
+    the given voucher
+    '''
+    voucher = json.load(voucher_path.open('r'))
+    return {'audible_key': voucher['content_license']['license_response']['key']
+           ,'audible_iv': voucher['content_license']['license_response']['iv']
+           }
+
+
+def _ffconcat_quote(path):
+    return "'" + path.as_posix().replace("'", "'\\''") + "'"
+
+
+def _ffmetadata_escape(value):
+    for char in '\\=;#\n':
+        value = value.replace(char, '\\' + char)
+    return value
+
+
+def concat_parts_to_m4b(parts, m4b_file, title=None):
+    '''
+    Decrypt and join the parts of a multi-part book into a single m4b in one
+    streaming ffmpeg pass (concat demuxer, codec copy)
+
+    The chapters of each part are shifted by the length of the parts before
+    it and written as the chapters of the joined file.  The global tags
+    (author, narrator, ...) and the cover art are taken from the first part.
+
+    Args:
+        parts (list): (path, input_options) for each part in order, where
+            input_options are the demuxer options that decrypt it.
+        m4b_file (pathlib.Path): Output file.
+        title (str): Title to store in the output file's metadata.
+    Returns:
+        pathlib.Path: m4b_file
+    '''
+    chapters = []
+    offset = 0.0
+    concat_lines = ['ffconcat version 1.0']
+    for path, input_options in parts:
+        part_chapters = extract_chapters(path, **input_options)
+        for chapter in part_chapters:
+            chapters.append({'start_time': chapter['start_time'] + offset
+                            ,'end_time': chapter['end_time'] + offset
+                            ,'title': chapter['title']
+                            })
+        if part_chapters:
+            offset += part_chapters[-1]['end_time']
+        else:
+            offset += float(ffmpeg.probe(path.as_posix()
+                                        ,**input_options
+                                        )['format']['duration'])
+        concat_lines.append(f'file {_ffconcat_quote(path)}')
+        for key, value in input_options.items():
+            concat_lines.append(f'option {key} {value}')
+
+    metadata_lines = [';FFMETADATA1']
+    for chapter in chapters:
+        metadata_lines.extend(['[CHAPTER]'
+                              ,'TIMEBASE=1/1000'
+                              ,f"START={round(chapter['start_time'] * 1000)}"
+                              ,f"END={round(chapter['end_time'] * 1000)}"
+                              ,f"title={_ffmetadata_escape(chapter['title'])}"
+                              ])
+
+    concat_file = m4b_file.with_suffix('.ffconcat')
+    metadata_file = m4b_file.with_suffix('.ffmetadata')
+    concat_file.write_text('\n'.join(concat_lines) + '\n')
+    metadata_file.write_text('\n'.join(metadata_lines) + '\n')
+    first_path, first_options = parts[0]
+    first_input = [arg
+                   for key, value in first_options.items()
+                   for arg in (f'-{key}', str(value))
+                  ]
+    title_option = ['-metadata', f'title={title}'] if title else []
+    try:
+        # ffmpeg-python cannot map metadata from an input that has no
+        # streams, so this command is spelled out.  The first part is opened
+        # again on its own for its tags and cover, which the concat demuxer
+        # does not pass on.
+        conversion_pool.run_all([(['ffmpeg'
+                                  ,'-f', 'concat', '-safe', '0'
+                                  ,'-i', concat_file.as_posix()
+                                  ,'-f', 'ffmetadata'
+                                  ,'-i', metadata_file.as_posix()
+                                  ,*first_input
+                                  ,'-i', first_path.as_posix()
+                                  ,'-map', '0:a'
+                                  ,'-map', '2:v?'
+                                  ,'-map_metadata', '2'
+                                  ,'-map_chapters', '1'
+                                  ,*title_option
+                                  ,'-c', 'copy'
+                                  ,'-disposition:v', 'attached_pic'
+                                  ,m4b_file.as_posix()
+                                  ]
+                                 ,m4b_file.name
+                                 )
+                                ])
+    finally:
+        concat_file.unlink(missing_ok=True)
+        metadata_file.unlink(missing_ok=True)
+    return m4b_file
+
+
 def convert_aaxc_to_m4b(aaxc_paths, voucher_paths, output_dir=None):
     if not output_dir:
-        output_dir = config['files']['tmp_dir']
+        output_dir = staging_dir()
     output_dir = pathlib.Path(output_dir)
     m4b_files = []
+    jobs = []
     for aaxc_path, voucher_path in zip(aaxc_paths, voucher_paths):
         m4b_file = (output_dir / aaxc_path.name).with_suffix(".m4b")
 
-        # Extract license
-        voucher = json.load(voucher_path.open('r'))
-        voucker_key = voucher['content_license']['license_response']['key']
-        voucher_iv = voucher['content_license']['license_response']['iv']
-
         # Convert to m4b
-        (ffmpeg.input(aaxc_path.as_posix()
-                     ,activation_bytes=config['audible']['activation_bytes']
-                     ,audible_key=voucker_key
-                     ,audible_iv=voucher_iv
-                     )
-               .output(m4b_file.as_posix(), codec='copy')
-               .run()
-        )
+        jobs.append((ffmpeg.input(aaxc_path.as_posix()
+                                 ,activation_bytes=config['audible']['activation_bytes']
+                                 ,**voucher_input_options(voucher_path)
+                                 )
+                           .output(m4b_file.as_posix(), codec='copy')
+                    ,aaxc_path.name
+                    ))
         m4b_files.append(m4b_file)
+    conversion_pool.run_all(jobs)
     return m4b_files
 
 
-def add_podcast(podcast, download_dir, import_db, auth=None):
-    logger = logging.getLogger(__name__)
-    seasons = [child for child in podcast['relationships']
-               if     child['relationship_to_product'] == 'child'
-                  and child['relationship_type'] == 'season'
-              ]
-    if seasons:
-        # Podcast is organized into seasons, so download by season
-        for season in seasons:
-            # Download season information
-            season_info = get_audible_product(season['asin'], auth=auth)
-            episode_asins = [child['asin'] for child
-                             in season_info['relationships']
-                             if     child['relationship_to_product'] == 'child'
-                                and child['relationship_type'] == 'episode'
-                            ]
-            add_podcast_episodes(episode_asins=episode_asins
-                                ,import_db=import_db
-                                ,download_dir=download_dir
-                                ,podcast_info=podcast
-                                ,season_info=season
-                                ,auth=auth
-                                )
-    else:
-        # Podcase is not organized into seasons, so download by episodes
-        episode_asins = [child['asin'] for child
-                         in season_info['relationships']
-                         if     child['relationship_to_product'] == 'child'
-                            and child['relationship_type'] == 'episode'
-                        ]
-        add_podcast_episodes(episode_asins=episode_asins
-                            ,import_db=import_db
-                            ,download_dir=download_dir
-                            ,podcast_info=podcast
-                            )
+def child_asins(product, relationship_type):
+    '''
+    ASINs of a product's children of one relationship type, e.g. the seasons
+    of a podcast or the episodes of a season
+    '''
+    return [rel['asin'] for rel in product.get('relationships') or []
+            if     rel['relationship_to_product'] == 'child'
+               and rel['relationship_type'] == relationship_type
+           ]
 
 
-def add_podcast_episodes(episode_asins
-                        ,import_db
-                        ,download_dir
-                        ,podcast_info
-                        ,season_info=None
-                        ,auth=None
-                        ):
+def podcast_seasons(podcast):
+    '''
+    Yield (season, episode ASINs) for each season of a podcast, or once
+    (None, episode ASINs) for a podcast that is not organized into seasons
+
+    All seasons are fetched from the catalog together.
+    '''
     logger = logging.getLogger(__name__)
-    for asin in episode_asins:
-        if import_db.is_podcast_episode_already_imported(asin):
-            logger.info("Episode is already imported: %s  %s: %s"
-                       ,podcast_info['asin']
-                       ,podcast_info['title']
-                       ,asin
-                       )
-            continue
-        episode_info = get_audible_product(asin=asin, auth=auth)
-        episode_path = download_podcast_episode(asin, download_dir)
-        if episode_path:
-            title, abs_path = import_episode_into_audiobookshelf(
-                 m4b_file=episode_path
-                ,podcast_info=podcast_info['title']
-                ,season_info=season_info
-                ,episode_info=episode_info
-                ,abs_dir=config['audiobookshelf_ppodcast_dir']
-            )
-        else:
-            logger.warning("Episode not imported: %s  %s: %s  %s"
-                          ,podcast_info['asin']
-                          ,podcast_info['title']
+    season_asins = child_asins(podcast, 'season')
+    if not season_asins:
+        yield None, child_asins(podcast, 'episode')
+        return
+    seasons = get_audible_products(season_asins, profile='dedup-only')
+    for asin in season_asins:
+        if asin not in seasons:
+            logger.warning("Season not found in the catalog: %s  %s: %s"
+                          ,podcast['asin']
+                          ,podcast['title']
                           ,asin
-                          ,episode_info['title']
                           )
             continue
+        yield seasons[asin], child_asins(seasons[asin], 'episode')
+
+
+def episodes_to_import(podcasts, db):
+    '''
+    Yield a podcast pipeline job for every released episode of the given
+    podcasts that has not been imported yet
+
+    The episodes of a season are checked against the import database with a
+    single query, and only the missing ones are fetched from the catalog,
+    many per request.
+    '''
+    logger = logging.getLogger(__name__)
+    for podcast in podcasts:
+        for season, asins in podcast_seasons(podcast):
+            with metrics.timer('dedup', table='podcast_episodes'):
+                imported = db.already_imported(asins, table='podcast_episodes')
+            if imported:
+                logger.info("%d episodes are already imported: %s  %s"
+                           ,len(imported)
+                           ,podcast['asin']
+                           ,podcast['title']
+                           )
+            asins = [asin for asin in asins if asin not in imported]
+            episodes = get_audible_products(asins, profile='import')
+            for asin in asins:
+                episode = episodes.get(asin)
+                if episode is None:
+                    logger.warning("Episode not found in the catalog: %s  %s: %s"
+                                  ,podcast['asin']
+                                  ,podcast['title']
+                                  ,asin
+                                  )
+                elif not is_product_released(episode):
+                    logger.info("Episode is not yet released: %s  %s: %s  %s"
+                               ,podcast['asin']
+                               ,podcast['title']
+                               ,asin
+                               ,episode['title']
+                               )
+                else:
+                    yield {'episode': episode
+                          ,'podcast': podcast
+                          ,'season': season
+                          }
+
+
+def download_episode(job, download_dir):
+    '''
+    Podcast pipeline stage: download an episode, preferring aax and falling
+    back to aaxc, or to mp3 for an episode only offered without DRM
+    '''
+    episode = job['episode']
+    quality = config['audible']['quality']
+    path = download_part(episode, 'aax', quality, download_dir)
+    if path is not None:
+        job['aax_paths'] = [path]
+        return job
+    path = download_part(episode, 'aaxc', quality, download_dir
+                        ,allow_mpeg=True
+                        )
+    if path.suffix == '.mp3':
+        job['mp3_paths'] = [path]
+    else:
+        job['aaxc_paths'] = [path]
+        job['voucher_paths'] = [path.with_suffix('.voucher')]
+    return job
+
+
+def convert_episode(job):
+    '''
+    Podcast pipeline stage: decrypt the downloaded episode into an m4b file
+    in the staging directory
+
+    A DRM-free mp3 needs no ffmpeg; it is copied to the staging directory
+    as it is, leaving the download in the content cache.
+    '''
+    if 'mp3_paths' in job:
+        staging = staging_dir()
+        staging.mkdir(parents=True, exist_ok=True)
+        job['audio_files'] = [pathlib.Path(shutil.copyfile(path
+                                                           ,staging / path.name
+                                                           ))
+                              for path in job['mp3_paths']
+                             ]
+    elif 'aax_paths' in job:
+        job['audio_files'] = convert_aax_to_m4b(job['aax_paths'])
+    else:
+        job['audio_files'] = convert_aaxc_to_m4b(
+                                  aaxc_paths=job['aaxc_paths']
+                                 ,voucher_paths=job['voucher_paths']
+                             )
+    release_downloads(job['episode'])
+    return job
+
 
-        # Record episode as having been added to the library
-        import_db.record_episode_as_imported(
-             asin=asin
-            ,title=title
-            ,abs_path=abs_path
-            ,abs_dir=config['audiobookshelf']['podcast_dir']
-        )
+def shelve_episode(job, db):
+    '''
+    Podcast pipeline stage: move the episode into the podcast's directory and
+    record it as imported
+    '''
+    podcast_dir = config['audiobookshelf']['podcast_dir']
+    title, abs_path = import_episode_into_audiobookshelf(
+         m4b_file=job['audio_files'][0]
+        ,podcast_info=job['podcast']
+        ,season_info=job['season']
+        ,episode_info=job['episode']
+        ,abs_dir=podcast_dir
+    )
+    db.record_episode_as_imported(asin=job['episode']['asin']
+                                 ,title=title
+                                 ,abs_path=abs_path
+                                 ,abs_dir=podcast_dir
+                                 )
+    return job
+
+
+def build_podcast_pipeline(db, download_dir):
+    '''
+    Build the pipeline that imports podcast episodes
+
+    [pipeline] podcast_workers episodes are downloaded, and as many
+    converted, at once.
+    '''
+    pipeline_config = config.get('pipeline', {})
+    workers = pipeline_config.get('podcast_workers', 2)
+    stages = [pipeline.Stage('episode download'
+                            ,functools.partial(download_episode
+                                              ,download_dir=download_dir
+                                              )
+                            ,workers=workers
+                            )
+             ,pipeline.Stage('episode convert', convert_episode, workers=workers)
+             ,pipeline.Stage('episode shelve'
+                            ,functools.partial(shelve_episode, db=db)
+                            ,workers=1
+                            )
+             ]
+    return pipeline.Pipeline(stages
+                            ,queue_size=pipeline_config.get('queue_size', 2)
+                            ,describe=lambda job: "%s  %s" % (job['episode']['asin']
+                                                            ,job['episode']['title']
+                                                            )
+                            )
 
 
 def import_episode_into_audiobookshelf(m4b_file
@@ -473,11 +1242,70 @@ def import_episode_into_audiobookshelf(m4b_file
     podcast_title = podcast_info['title']
     podcast_dir = abs_dir / podcast_title
     podcast_dir.mkdir(parents=True, exist_ok=True)
-    episode_file = shutil.move(m4b_file, podcast_dir /m4b_file.name)
+    episode_file = finalize_file(m4b_file, podcast_dir / m4b_file.name)
     return episode_file.name, episode_file
 
 
-def import_audiobook_into_audiobookshelf(m4b_files, book_info, abs_dir):
+def staging_dir():
+    '''
+    Directory converted files are written to before being shelved
+
+    [files] tmp_dir if set, otherwise a hidden directory inside the
+    audiobooks library, so that shelving a book is a rename on the same
+    filesystem rather than a second full copy.
+    '''
+    tmp_dir = config['files'].get('tmp_dir')
+    if tmp_dir:
+        return pathlib.Path(tmp_dir)
+    return pathlib.Path(config['audiobookshelf']['audiobooks_dir']) / '.staging'
+
+
+def check_staging_filesystem():
+    '''
+    Create the staging directory and warn if it is not on the same
+    filesystem as the library, as every book will then be copied twice
+    '''
+    logger = logging.getLogger(__name__)
+    staging = staging_dir()
+    staging.mkdir(parents=True, exist_ok=True)
+    library = pathlib.Path(config['audiobookshelf']['audiobooks_dir'])
+    if staging.stat().st_dev != library.stat().st_dev:
+        logger.warning("Staging directory %s is on a different filesystem "
+                       "than the library %s; every book will be copied into "
+                       "the library instead of renamed.  Remove tmp_dir "
+                       "from [files] in the config (older versions required "
+                       "it) to stage inside the library."
+                      ,staging
+                      ,library
+                      )
+
+
+def finalize_file(src, dest):
+    '''
+    Move a finished file into its final location, atomically when both are
+    on the same filesystem
+
+    Returns:
+        pathlib.Path: dest
+    '''
+    dest = pathlib.Path(dest)
+    method = 'rename'
+    with metrics.timer('move'):
+        try:
+            os.replace(src, dest)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            method = 'copy'
+            shutil.move(src, dest)
+    metrics.count('moved_bytes', dest.stat().st_size, method=method)
+    return dest
+
+
+def audiobook_location(book_info, abs_dir):
+    '''
+    Work out the folder name (title) and directory a book is shelved in
+    '''
     # In case abs_dir is a string, convert it to a pathlib.Path
     abs_dir = pathlib.Path(abs_dir)
 
@@ -514,10 +1342,14 @@ def import_audiobook_into_audiobookshelf(m4b_files, book_info, abs_dir):
                         narrators = narrators + ', ' + n['name']
         title = title + ' {' + narrators + '}'
 
-    book_dir = book_dir / title
+    return title, book_dir / title
+
+
+def import_audiobook_into_audiobookshelf(m4b_files, book_info, abs_dir):
+    title, book_dir = audiobook_location(book_info, abs_dir)
     book_dir.mkdir(parents=True, exist_ok=True)
     for m4b_file in m4b_files:
-        abs_path = shutil.move(m4b_file, book_dir / m4b_file.name)
+        abs_path = finalize_file(m4b_file, book_dir / m4b_file.name)
     return title, abs_path
 
 
@@ -527,9 +1359,42 @@ def is_product_released(product_info):
     return release_date <= datetime.now()
 
 
-def add_book(book, db, download_dir, auth=None):
+def download_book(job, download_dir, db=None):
+    '''
+    Pipeline stage: download the encrypted audio for a book, preferring aax
+    and falling back to aaxc
+
+    With [files] stream_decrypt set, a book that is not in the content
+    cache is decrypted while it downloads (see stream_book()), and only
+    downloaded to disk first if that fails.  A book a previous run got part
+    way through resumes from its last checkpoint instead.
+    '''
     logger = logging.getLogger(__name__)
-    # Download book as aax
+    book = job['book']
+    if 'authors' not in book:
+        # The library was listed with a lean profile; fetch what is needed to
+        # shelve the book now that it is known to need importing
+        book = job['book'] = {**book
+                             ,**get_audible_product(book['asin']
+                                                   ,profile='import'
+                                                   )
+                             }
+    if db is not None:
+        job = restore_job(job, db)
+    if job_reached(job, 'downloaded'):
+        return job
+    if config['files'].get('stream_decrypt') and not is_book_cached(book):
+        try:
+            job = stream_book(job, download_dir)
+            checkpoint_job(job, db, 'converted')
+            release_downloads(book)
+            return job
+        except ffmpeg.Error as e:
+            logger.warning("Could not decrypt %s while downloading, "
+                           "downloading it first instead: %s"
+                          ,book['asin']
+                          ,e.stderr.decode('utf-8', 'replace').strip()
+                          )
     logger.info('Trying to download as aax: %s', book['asin'])
     aax_paths = download_product_as_aax(
                      asin=book['asin']
@@ -538,83 +1403,373 @@ def add_book(book, db, download_dir, auth=None):
                     ,book=book
                     )
     if len(aax_paths) > 0:
-        tmp_m4b_files = convert_aax_to_m4b(aax_paths
-                                          ,output_dir=config['files']['tmp_dir']
-                                          ,book=book
-                                          )
+        job['aax_paths'] = aax_paths
+        checkpoint_job(job, db, 'downloaded')
+        return job
+
+    logger.info('Trying to download as aaxc: %s', book['asin'])
+    aaxc_paths, voucher_paths = download_product_as_aaxc(
+         book['asin']
+         ,quality=config['audible']['quality']
+         ,download_dir=download_dir
+         ,book=book
+    )
+    if len(aaxc_paths) > 0 and len(voucher_paths) > 0:
+        job['aaxc_paths'] = aaxc_paths
+        job['voucher_paths'] = voucher_paths
+        checkpoint_job(job, db, 'downloaded')
+        return job
+
+    logger.warning("No aax or aaxc file for this title: ASIN: %s "
+                   "Title: %s"
+                  ,book['asin']
+                  ,book['title']
+                  )
+    release_downloads(book)
+    return None
+
+
+def content_sources(book):
+    '''
+    Return the ContentSource of each part of a book, in order: AAX where the
+    part is available as AAX, otherwise AAXC with its decrypted voucher
+    '''
+    parts = product_parts(book)
+    parent = book if len(parts) > 1 else None
+    quality = config['audible']['quality']
+    sources = []
+    for part in parts:
+        source = audible_download.aax_source(audible_api
+                                            ,part
+                                            ,quality
+                                            ,parent=parent
+                                            )
+        if source is None:
+            source = audible_download.aaxc_source(audible_api
+                                                 ,part
+                                                 ,quality
+                                                 ,parent=parent
+                                                 )
+        sources.append(source)
+    return sources
+
+
+def tee_to_file(chunks, path):
+    '''
+    Pass chunks through unchanged while also writing them to a file
+    '''
+    with path.open('wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+            yield chunk
+
+
+def stream_book(job, download_dir):
+    '''
+    Download and decrypt a book in one pass, piping the download straight
+    into ffmpeg so the encrypted file never has to be written and read back
+
+    With [files] keep_encrypted set, the encrypted files (and AAXC
+    vouchers) are also saved in the download directory and the content
+    cache.
+
+    Raises:
+        ffmpeg.Error: If ffmpeg cannot decrypt a part from a pipe.
+    '''
+    book = job['book']
+    output_dir = conversion_output_dir(book)
+    activation_bytes = config['audible']['activation_bytes']
+    futures = []
+    m4b_files = []
+    kept_files = []
+    kept_sources = []
+    for source in content_sources(book):
+        chunks = audible_download.iter_content(audible_api
+                                              ,source
+                                              ,chunk_size=download_chunk_size()
+                                              )
+        if config['files'].get('keep_encrypted'):
+            kept_files.append(download_dir / source.filename)
+            kept_sources.append((source, kept_files[-1]))
+            chunks = tee_to_file(chunks, kept_files[-1])
+            if source.voucher is not None:
+                kept_files.append(kept_files[-1].with_suffix('.voucher'))
+                with kept_files[-1].open('w') as f:
+                    json.dump(source.voucher, f, indent=4)
+        m4b_file = (output_dir / source.filename).with_suffix('.m4b')
+        command = (ffmpeg.input('pipe:0'
+                               ,f='mov'
+                               ,**source.input_options(activation_bytes)
+                               )
+                         .output(m4b_file.as_posix(), codec='copy')
+                  )
+        futures.append(conversion_pool.submit(command, m4b_file.name
+                                             ,stdin=chunks
+                                             ))
+        m4b_files.append(m4b_file)
+    concurrent.futures.wait(futures)
+    try:
+        for future in futures:
+            if future.result().media_seconds <= 0:
+                # A file whose index comes after the audio cannot be read
+                # from a pipe; ffmpeg then exits cleanly with no output
+                raise ffmpeg.Error('ffmpeg', b''
+                                  ,b'No audio could be decrypted from the '
+                                   b'stream'
+                                  )
+    except BaseException:
+        # Partial encrypted files would be mistaken for finished downloads
+        for path in m4b_files + kept_files:
+            path.unlink(missing_ok=True)
+        raise
+    for source, path in kept_sources:
+        content_cache.put(source.asin
+                         ,config['audible']['quality']
+                         ,source.kind
+                         ,path
+                         )
+
+    if config['files'].get('concat_multipart') and len(m4b_files) > 1:
+        m4b_file = output_dir / f"{book['asin']}.m4b"
+        concat_parts_to_m4b([(path, {}) for path in m4b_files]
+                           ,m4b_file
+                           ,title=book['title']
+                           )
+        for path in m4b_files:
+            path.unlink()
+        m4b_files = [m4b_file]
+    job['m4b_files'] = m4b_files
+    return job
+
+
+def conversion_output_dir(book):
+    '''
+    Directory ffmpeg writes a book's m4b files to
+
+    Normally the staging directory.  With [files] direct_output set it is a
+    hidden .partial directory inside the book's final directory, from which
+    shelving is a rename within the same directory tree.
+    '''
+    if config['files'].get('direct_output'):
+        _, book_dir = audiobook_location(
+                           book
+                          ,config['audiobookshelf']['audiobooks_dir']
+                          )
+        output_dir = book_dir / '.partial'
     else:
-        # Download book as aaxc
-        logger.info('Trying to download as aaxc: %s', book['asin'])
-        aaxc_paths, voucher_paths = download_product_as_aaxc(
-             book['asin']
-             ,quality=config['audible']['quality']
-             ,download_dir=pathlib.Path(config['files']['audible_download_dir'])
-             ,filename_mode='asin_ascii'
-        )
-
-        # Check for aaxc file
-        if len(aaxc_paths) > 0 and len(voucher_paths) > 0:
-            tmp_m4b_files = convert_aaxc_to_m4b(aaxc_paths=aaxc_paths
-                                               ,voucher_paths=voucher_paths
-                                               ,output_dir=config['files']['tmp_dir']
+        output_dir = staging_dir()
+    output_dir.mkdir(parents=True, exist_ok=True)
+    return output_dir
+
+
+def convert_book(job, db=None):
+    '''
+    Pipeline stage: decrypt the downloaded files into m4b files
+
+    With [files] concat_multipart set, the parts of a multi-part book are
+    joined into a single m4b.  Books that were decrypted while downloading
+    are passed straight through.
+    '''
+    if job_reached(job, 'converted'):
+        return job
+    if 'aax_paths' in job:
+        parts = [(path
+                 ,{'activation_bytes': config['audible']['activation_bytes']}
+                 )
+                 for path in job['aax_paths']
+                ]
+    else:
+        parts = [(path, voucher_input_options(voucher))
+                 for path, voucher in zip(job['aaxc_paths'], job['voucher_paths'])
+                ]
+    output_dir = conversion_output_dir(job['book'])
+    if config['files'].get('concat_multipart') and len(parts) > 1:
+        m4b_file = output_dir / f"{job['book']['asin']}.m4b"
+        job['m4b_files'] = [concat_parts_to_m4b(parts
+                                               ,m4b_file
+                                               ,title=job['book']['title']
                                                )
+                           ]
+    elif 'aax_paths' in job:
+        job['m4b_files'] = convert_aax_to_m4b(job['aax_paths']
+                                             ,output_dir=output_dir
+                                             ,book=job['book']
+                                             )
+    else:
+        job['m4b_files'] = convert_aaxc_to_m4b(
+                                aaxc_paths=job['aaxc_paths']
+                               ,voucher_paths=job['voucher_paths']
+                               ,output_dir=output_dir
+                               )
+    checkpoint_job(job, db, 'converted')
+    release_downloads(job['book'])
+    return job
 
-        else:
-            logger.warning("No aax or aaxc file for this title: ASIN: %s "
-                           "Title: %s"
-                          ,book['asin']
-                          ,book['title']
-                          )
-            return
 
-    # Put it in place in the audiobookshelf
-    title, abs_path = import_audiobook_into_audiobookshelf(
-         m4b_files=tmp_m4b_files
-        ,book_info=book
+def shelve_book(job, db=None):
+    '''
+    Pipeline stage: move the m4b files into place in the audiobookshelf
+    library
+    '''
+    if job_reached(job, 'shelved'):
+        return job
+    job['title'], job['abs_path'] = import_audiobook_into_audiobookshelf(
+         m4b_files=job['m4b_files']
+        ,book_info=job['book']
         ,abs_dir=pathlib.Path(config['audiobookshelf']['audiobooks_dir'])
     )
+    job['shelved_files'] = [job['abs_path'].parent / m4b_file.name
+                            for m4b_file in job['m4b_files']
+                           ]
+    # The files were only moved, so what was recorded at "converted" holds
+    carry_artifact_records(job, job['m4b_files'], job['shelved_files'])
+    if config['files'].get('direct_output'):
+        # Remove the now empty .partial directory
+        job['m4b_files'][0].parent.rmdir()
+    checkpoint_job(job, db, 'shelved')
+    return job
+
+
+def link_book(job, db, resolver, batch):
+    '''
+    Pipeline stage: wait for audiobookshelf to pick up the new folder, queue
+    its ASIN and chapters as one metadata update, and record the book as
+    imported once the update has been sent
+    '''
+    book = job['book']
+    if job_reached(job, 'chapters_synced'):
+        finish_book(job, db)
+        return job
+    if not job_reached(job, 'abs_linked'):
+        job['book_id'] = resolver.resolve(job['abs_path'].parent)
+        checkpoint_job(job, db, 'abs_linked')
+
+    def done():
+        checkpoint_job(job, db, 'chapters_synced')
+        finish_book(job, db)
+
+    batch.update_item(job['book_id']
+                     ,asin=book['asin']
+                     ,chapters=book_chapters(job, db)
+                     ,on_done=done
+                     )
+    return job
 
-    # Add chapters to audiobookshelf
-    library_id = shelf.get_book_library_id()
-    shelf.trigger_library_rescan(library_id)
-    while not (book_id := shelf.get_item_id_for_folder(library_id
-                                                      ,abs_path.parent
-                                                      )
-              ):
-        time.sleep(1)
-    shelf.update_item_asin(book_id, book['asin'])
-    chapters = shelf.fetch_chapters(book['asin'])
-    shelf.update_item_chapters(book_id, chapters)
-
-    # Record it as having been added to the library
-    db.record_book_as_imported(asin=book['asin']
-                              ,title=title
-                              ,abs_path=abs_path
+
+def finish_book(job, db):
+    '''
+    Record a book as having been added to the library
+    '''
+    db.record_book_as_imported(asin=job['book']['asin']
+                              ,title=job['title']
+                              ,abs_path=job['abs_path']
                               ,abs_dir=config['audiobookshelf']['audiobooks_dir']
                               )
+    db.clear_job(job['book']['asin'])
+
+
+def build_metadata_batch():
+    '''
+    Build the queue of audiobookshelf metadata updates, sending
+    [audiobookshelf] metadata_batch_size items per request
+    '''
+    return MetadataBatch(shelf
+                        ,batch_size=config['audiobookshelf'].get('metadata_batch_size'
+                                                                ,25
+                                                                )
+                        )
+
+
+def build_item_resolver():
+    '''
+    Build the resolver that maps shelved folders to audiobookshelf items,
+    using the scan/poll settings from the [audiobookshelf] config section
+    '''
+    abs_config = config['audiobookshelf']
+    return ItemResolver(shelf
+                       ,shelf.get_book_library_id()
+                       ,batch_window=abs_config.get('scan_batch_window', 2.0)
+                       ,poll_interval=abs_config.get('poll_interval', 1.0)
+                       ,max_poll_interval=abs_config.get('max_poll_interval'
+                                                        ,30.0
+                                                        )
+                       ,rescan_after=abs_config.get('rescan_after', 120.0)
+                       ,timeout=abs_config.get('item_timeout', 900.0)
+                       )
+
+
+def build_import_pipeline(db, download_dir, batch):
+    '''
+    Build the staged import pipeline from the [pipeline] config section
+
+    The metadata stage queues its updates on `batch`; flush it once the
+    pipeline has run.
+    '''
+    pipeline_config = config.get('pipeline', {})
+    stages = [pipeline.Stage('download'
+                            ,functools.partial(download_book
+                                              ,download_dir=download_dir
+                                              ,db=db
+                                              )
+                            ,workers=pipeline_config.get('download_workers', 1)
+                            )
+             ,pipeline.Stage('convert'
+                            ,functools.partial(convert_book, db=db)
+                            ,workers=pipeline_config.get('convert_workers', 2)
+                            )
+             ,pipeline.Stage('shelve'
+                            ,functools.partial(shelve_book, db=db)
+                            ,workers=pipeline_config.get('shelve_workers', 1)
+                            )
+             ,pipeline.Stage('metadata'
+                            ,functools.partial(link_book
+                                              ,db=db
+                                              ,resolver=build_item_resolver()
+                                              ,batch=batch
+                                              )
+                            ,workers=pipeline_config.get('metadata_workers', 4)
+                            )
+             ]
+    return pipeline.Pipeline(stages
+                            ,queue_size=pipeline_config.get('queue_size', 2)
+                            ,describe=lambda job: "%s  %s" % (job['book']['asin']
+                                                            ,job['book']['title']
+                                                            )
+                            )
+
+
+def books_to_import(library_pages, db, podcasts=None):
+    '''
+    Yield a pipeline job for every book in the library that still needs to be
+    imported
+
+    Args:
+        library_pages (iterable): Lists of library items, e.g. from
+                                  sync_audible_library.
+        db (ImportDatabase): Import database to check for imported books.
+        podcasts (list): Podcasts in the library are appended to this list,
+                         to be imported with episodes_to_import(); when None
+                         (or no [audiobookshelf] podcast_dir is set) they are
+                         skipped.
+    '''
+    if not config['audiobookshelf'].get('podcast_dir'):
+        podcasts = None
+    for page in library_pages:
+        with metrics.timer('dedup', table='books'):
+            imported = db.already_imported(book['asin'] for book in page)
+        metrics.count('library_titles', len(page))
+        metrics.count('already_imported_titles', len(imported))
+        yield from _books_to_import(page, imported, podcasts)
 
 
-def main():
+def _books_to_import(library, imported, podcasts=None):
     logger = logging.getLogger(__name__)
-    logger.info("Getting library...")
-    auth = audible.Authenticator.from_file(config['audible']['auth_file'])
-    library = get_audible_library(auth)
-    logger.info("Connecting to db...")
-    db = ImportDatabase(config['database']['location'])
-    logger.info("Handling library...")
     for book in library:
         # Check if book has already been downloaded and added to library
         logger.info("ASIN: %s    Title: %s"
                    ,book['asin']
                    ,book['title']
                    )
-        if book['asin'] in asin_to_skip:
-            logger.info('Book is on the skip list: %s  %s'
-                       ,book['asin']
-                       ,book['title']
-                        )
-            continue
-
         # Skip periodicals for now -- TODO
         if book['content_delivery_type'] == 'Periodical':
             logger.warning("Skipping because it is of content delivery type "
@@ -623,23 +1778,19 @@ def main():
                           ,book['title']
                           )
             continue
-        # Skip podcasts for now -- TODO
         elif book['content_delivery_type'] == 'PodcastParent':
-            logger.warning("Skipping because it is of content delivery type "
-                           "PodcastParent: %s  %s"
-                          ,book['asin']
-                          ,book['title']
-                          )
-            continue
-            #add_podcast(podcast=book
-            #           ,download_dir=config['files']['audible_download_dir']
-            #           ,import_db=db
-            #           ,auth=auth
-            #           )
+            if podcasts is None:
+                logger.warning("Skipping because it is of content delivery type "
+                               "PodcastParent: %s  %s"
+                              ,book['asin']
+                              ,book['title']
+                              )
+                continue
+            podcasts.append(book)
         elif (  book['content_delivery_type'] == 'SinglePartBook'
              or book['content_delivery_type'] == 'MultiPartBook'
              ):
-            if db.is_book_already_imported(book['asin']):
+            if book['asin'] in imported:
                 # This book has already been downloaded and added to the library so
                 # move on to the next book in the list
                 logger.info('Book is already imported: %s  %s'
@@ -656,13 +1807,7 @@ def main():
                               ,book['release_date']
                               )
                 continue
-            add_book(book=book
-                    ,db=db
-                    ,download_dir=pathlib.Path(config['files']
-                                                     ['audible_download_dir']
-                                              )
-                    ,auth=auth
-                    )
+            yield {'book': book}
         else:
             logger.warning("Unhandled content_delivery_type: %s for %s  %s"
                           ,book['content_delivery_type']
@@ -671,6 +1816,80 @@ def main():
                           )
 
 
+def write_run_report(import_pipeline, podcast_pipeline, batch):
+    '''
+    Write the run metrics to the [metrics] json_file and prometheus_file, if
+    set
+    '''
+    logger = logging.getLogger(__name__)
+    metrics_config = config.get('metrics', {})
+    metrics.REGISTRY.record_stages(stage.stats
+                                   for stage in (  import_pipeline.stages
+                                                 + podcast_pipeline.stages
+                                                )
+                                  )
+    metrics.gauge('abs_metadata_requests', batch.requests)
+    metrics.gauge('abs_metadata_failed_items', batch.failed)
+    try:
+        metrics.REGISTRY.write(json_file=metrics_config.get('json_file')
+                              ,prometheus_file=metrics_config.get('prometheus_file')
+                              )
+    except OSError as e:
+        logger.error("Could not write the run report: %s", e)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Import an Audible library into audiobookshelf"
+    )
+    parser.add_argument('--full-sync'
+                       ,action='store_true'
+                       ,help="Fetch the whole Audible library instead of only "
+                             "titles purchased since the last run"
+                       )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    logger = logging.getLogger(__name__)
+    args = parse_args(argv)
+    logger.info("Connecting to db...")
+    db = ImportDatabase(config['database']['location']
+                       ,commit_every=config['database'].get('commit_every', 10)
+                       ,commit_interval=config['database'].get('commit_interval'
+                                                              ,30.0
+                                                              )
+                       )
+    logger.info("Getting library...")
+    library_pages = sync_audible_library(db, full=args.full_sync)
+    check_staging_filesystem()
+    logger.info("Handling library...")
+    batch = build_metadata_batch()
+    download_dir = pathlib.Path(config['files']['audible_download_dir'])
+    import_pipeline = build_import_pipeline(db=db
+                                           ,download_dir=download_dir
+                                           ,batch=batch
+                                           )
+    podcast_pipeline = build_podcast_pipeline(db=db, download_dir=download_dir)
+    podcasts = []
+    try:
+        import_pipeline.run(books_to_import(library_pages, db, podcasts))
+        if podcasts:
+            logger.info("Handling %d podcasts...", len(podcasts))
+            podcast_pipeline.run(episodes_to_import(podcasts, db))
+    finally:
+        batch.flush()
+        logger.info("Sent metadata in %d requests, %d items failed"
+                   ,batch.requests
+                   ,batch.failed
+                   )
+        write_run_report(import_pipeline, podcast_pipeline, batch)
+        db.close()
+        audible_api.close()
+        content_cache.close()
+        conversion_pool.shutdown()
+
+
 if __name__ == "__main__":
     log_level = os.environ.get('LOG_LEVEL', 'INFO').upper()
     logging.basicConfig(level=log_level)
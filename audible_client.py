@@ -0,0 +1,260 @@
+"""
+Shared access to the Audible API
+
+One authenticated client is created per run and reused for every call, and
+catalog products are cached on disk so repeated lookups do not go back to
+Audible.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import pathlib
+import sqlite3
+import threading
+import time
+
+import audible
+
+import import_schema
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Audible API response groups to request, by how much of a product the
+# caller actually reads:
+#   dedup-only: enough to decide whether a title needs importing (ASIN,
+#               title, content delivery type, release date, parts/episodes)
+#   import:     also the contributors, series and media needed to download
+#               and shelve a title
+#   full:       everything, including descriptions and category ladders
+RESPONSE_GROUP_PROFILES = {
+     'dedup-only': "product_attrs, relationships"
+    ,'import': ("contributors, media, product_attrs, series, "
+                "relationships"
+               )
+    ,'full': ("contributors, media, "
+              "product_attrs, product_desc, "
+              "product_extended_attrs, "
+              "sample, series, "
+              "ws4v, origin, relationships, "
+              "categories, "
+              "category_ladders, "
+              "origin_asin"
+             )
+}
+
+
+# Most ASINs the catalog accepts in one 1.0/catalog/products request
+MAX_PRODUCTS_PER_REQUEST = 50
+
+
+class ProductCache:
+    """
+    On-disk cache of Audible catalog products, keyed by ASIN and response
+    group profile, with entries expiring after `ttl` seconds.
+
+    Args:
+        db_file (str or Path): SQLite file to keep the cache in; sharing the
+            import database file is fine.
+        ttl (float): Seconds a cached product stays valid.
+    """
+    def __init__(self, db_file, ttl=7 * 24 * 3600):
+        self.ttl = ttl
+        self.con = sqlite3.connect(db_file, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            import_schema.upgrade(self.con)
+
+    def get(self, asin, profile):
+        """
+        Return the cached product, or None if it is missing or expired.
+        """
+        with self.lock:
+            row = self.con.execute('SELECT data, fetched_at FROM product_cache '
+                                   'WHERE asin = ? AND profile = ?'
+                                  ,(asin, profile)
+                                  ).fetchone()
+        if row is None or time.time() - row[1] > self.ttl:
+            return None
+        return json.loads(row[0])
+
+    def put(self, asin, profile, product):
+        """
+        Store a product fetched from the catalog.
+        """
+        with self.lock:
+            self.con.execute('INSERT OR REPLACE INTO product_cache '
+                             '(asin, profile, data, fetched_at) '
+                             'values (?, ?, ?, ?)'
+                            ,(asin, profile, json.dumps(product), time.time())
+                            )
+            self.con.commit()
+
+    def close(self):
+        with self.lock:
+            self.con.close()
+
+
+class AudibleAPI:
+    """
+    Long-lived, authenticated Audible API client.
+
+    The auth file is read and the connection opened on first use, and both
+    are then shared by every caller (including worker threads) until
+    close().
+
+    Args:
+        auth_file (str or Path): audible-cli style authentication file.
+        product_cache (ProductCache): Cache for get_product(), or None.
+        products_per_request (int): ASINs per catalog request in
+            get_products(), at most MAX_PRODUCTS_PER_REQUEST.
+        catalog_workers (int): Catalog requests get_products() runs at once.
+    """
+    def __init__(self
+                ,auth_file
+                ,product_cache=None
+                ,products_per_request=MAX_PRODUCTS_PER_REQUEST
+                ,catalog_workers=4
+                ):
+        self.auth_file = pathlib.Path(auth_file).expanduser()
+        self.product_cache = product_cache
+        self.products_per_request = max(1, min(products_per_request
+                                              ,MAX_PRODUCTS_PER_REQUEST
+                                              ))
+        self.catalog_workers = max(1, catalog_workers)
+        self._client = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Build the client from the full config, caching products in the
+        [audible] product_cache file (default: the import database) for
+        product_cache_ttl_days (default 7).  Bulk lookups send
+        products_per_request ASINs per request, catalog_workers requests at
+        a time.
+        """
+        cache_file = config['audible'].get('product_cache'
+                                          ,config['database']['location']
+                                          )
+        ttl_days = config['audible'].get('product_cache_ttl_days', 7)
+        return cls(config['audible']['auth_file']
+                  ,product_cache=ProductCache(pathlib.Path(cache_file).expanduser()
+                                             ,ttl=ttl_days * 24 * 3600
+                                             )
+                  ,products_per_request=config['audible'].get(
+                                             'products_per_request'
+                                            ,MAX_PRODUCTS_PER_REQUEST
+                                        )
+                  ,catalog_workers=config['audible'].get('catalog_workers', 4)
+                  )
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                auth = audible.Authenticator.from_file(self.auth_file)
+                self._client = audible.Client(auth=auth)
+            return self._client
+
+    def get(self, path, **params):
+        """
+        GET an API path with the shared client.
+        """
+        return self.client.get(path, **params)
+
+    def get_product(self, asin, profile='full'):
+        """
+        Fetch a product from the Audible catalog, requesting the response
+        groups of the named RESPONSE_GROUP_PROFILES entry, from the product
+        cache when possible.
+
+        Args:
+            asin (str): ASIN of the product.
+            profile (str): Key of RESPONSE_GROUP_PROFILES.
+        Returns:
+            dict: The product.
+        """
+        if self.product_cache is not None:
+            product = self.product_cache.get(asin, profile)
+            metrics.count('product_cache_lookups'
+                         ,result='miss' if product is None else 'hit'
+                         )
+            if product is not None:
+                return product
+        with metrics.timer('audible_request', endpoint='product'):
+            product = self.client.get(f"1.0/catalog/products/{asin}"
+                                     ,response_groups=RESPONSE_GROUP_PROFILES[profile]
+                                     )
+        if 'product' in product:
+            product = product['product']
+        if self.product_cache is not None:
+            self.product_cache.put(asin, profile, product)
+        return product
+
+    def get_products(self, asins, profile='full'):
+        """
+        Fetch many products from the Audible catalog, taking what it can from
+        the product cache and requesting the rest products_per_request ASINs
+        at a time, with up to catalog_workers requests running at once.
+
+        Args:
+            asins (iterable): ASINs of the products.
+            profile (str): Key of RESPONSE_GROUP_PROFILES.
+        Returns:
+            dict: Product by ASIN; ASINs the catalog does not know are left
+                  out.
+        """
+        products = {}
+        missing = []
+        for asin in dict.fromkeys(asins):
+            product = (self.product_cache.get(asin, profile)
+                       if self.product_cache is not None else None
+                      )
+            if product is not None:
+                products[asin] = product
+            else:
+                missing.append(asin)
+        if self.product_cache is not None:
+            metrics.count('product_cache_lookups', len(products), result='hit')
+            metrics.count('product_cache_lookups', len(missing), result='miss')
+        chunks = [missing[i:i + self.products_per_request]
+                  for i in range(0, len(missing), self.products_per_request)
+                 ]
+        if len(chunks) > 1 and self.catalog_workers > 1:
+            with ThreadPoolExecutor(max_workers=min(self.catalog_workers
+                                                   ,len(chunks)
+                                                   )
+                                   ,thread_name_prefix='catalog'
+                                   ) as executor:
+                fetched = list(executor.map(
+                                   lambda chunk: self._fetch_products(chunk, profile)
+                                  ,chunks
+                              ))
+        else:
+            fetched = [self._fetch_products(chunk, profile) for chunk in chunks]
+        for chunk_products in fetched:
+            products.update(chunk_products)
+        return products
+
+    def _fetch_products(self, asins, profile):
+        with metrics.timer('audible_request', endpoint='products'):
+            response = self.client.get("1.0/catalog/products"
+                                      ,asins=','.join(asins)
+                                      ,response_groups=RESPONSE_GROUP_PROFILES[profile]
+                                      )
+        products = {}
+        for product in response.get('products', []):
+            products[product['asin']] = product
+            if self.product_cache is not None:
+                self.product_cache.put(product['asin'], profile, product)
+        return products
+
+    def close(self):
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+        if self.product_cache is not None:
+            self.product_cache.close()
@@ -0,0 +1,543 @@
+"""
+Direct access to Audible audio content
+
+Resolves where a title's audio can be downloaded from (an AAX download link,
+an AAXC link plus its decrypted voucher, or for DRM-free titles an MP3 link)
+and streams or downloads the content through the shared Audible client.
+Downloads go to exact, per-title paths via a ".part" file that later
+attempts resume with HTTP range requests, so any number of them can run at
+once, and are tracked in a size-capped content cache so that verified files
+are reused.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import secrets
+import sqlite3
+import string
+import threading
+import time
+import unicodedata
+
+from audible.aescipher import decrypt_voucher_from_licenserequest
+
+import import_schema
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+AAX_DOWNLOAD_URL = ("https://cde-ta-g7g.amazon.com/FionaCDEServiceEngine/"
+                    "FSDownloadContent"
+                   )
+
+# Codec names audible-cli uses for its "high" and "normal" AAX qualities
+AAX_QUALITY_CODECS = {'high': 'AAX_44_128', 'normal': 'AAX_44_64'}
+
+LICENSE_HEADERS = {"X-ADP-SW": "37801821"
+                  ,"X-ADP-Transport": "WIFI"
+                  ,"X-ADP-LTO": "120"
+                  ,"X-Device-Type-Id": "A2CZJZGLK2JJVM"
+                  ,"device_idiom": "phone"
+                  }
+
+
+class ContentSource:
+    """
+    Where and how to download one title's audio.
+
+    Args:
+        asin (str): ASIN of the title (or part).
+        kind (str): "aax", "aaxc", or "mp3" for DRM-free content.
+        url (str): Download URL.
+        codec (str): Codec/format name, used in file names.
+        base_filename (str): File name without codec and extension.
+        voucher (dict): For AAXC, the license response with its decrypted
+            voucher (key and iv) in content_license.license_response.
+    """
+    def __init__(self, asin, kind, url, codec, base_filename=None, voucher=None):
+        self.asin = asin
+        self.kind = kind
+        self.url = url
+        self.codec = codec
+        self.base_filename = base_filename or asin
+        self.voucher = voucher
+
+    @property
+    def filename(self):
+        """
+        Name of the downloaded file, as audible-cli names it.
+        """
+        return f"{self.base_filename}-{self.codec}.{self.kind}"
+
+    def input_options(self, activation_bytes):
+        """
+        Return the ffmpeg input options that decrypt this content.
+        """
+        if self.kind == 'aax':
+            return {'activation_bytes': activation_bytes}
+        if self.kind == 'mp3':
+            return {}
+        license_response = self.voucher['content_license']['license_response']
+        return {'audible_key': license_response['key']
+               ,'audible_iv': license_response['iv']
+               }
+
+
+def base_filename(product, parent=None):
+    """
+    File name for a product without codec and extension, the same as
+    audible-cli's "asin_ascii" filename mode: the ASIN and an ASCII-only
+    version of the full title.
+
+    Args:
+        product (dict): Product with its title (and subtitle).
+        parent (dict): For a part of a multi-part book, the book.
+    """
+    title = product.get('title') or ''
+    if product.get('subtitle'):
+        title = f"{title}: {product['subtitle']}"
+    if parent is not None:
+        title = f"{parent['title']}: {title}"
+    valid_chars = "-_.() " + string.ascii_letters + string.digits
+    ascii_title = (unicodedata.normalize("NFKD", title)
+                              .encode("ascii", "ignore")
+                              .decode("ascii")
+                              .replace(" ", "_")
+                  )
+    slug = "".join(c for c in ascii_title if c in valid_chars)
+    if len(slug) < 2:
+        slug = product['asin']
+    return f"{product['asin']}_{slug}"[:230]
+
+
+def choose_aax_codec(product, quality):
+    """
+    Pick the AAX codec to download, as audible-cli does: the codec matching
+    the requested quality, or the best one available for "best".
+
+    Args:
+        product (dict): Product with the media response group.
+        quality (str): "best", "high" or "normal".
+    Returns:
+        tuple: (codec name, enhanced codec), or (None, None) if the product
+               cannot be downloaded as AAX.
+    """
+    wanted = AAX_QUALITY_CODECS.get(quality)
+    best = (None, None)
+    best_rank = (0, 0)
+    for codec in product.get('available_codecs') or []:
+        name = codec['name'].upper()
+        if wanted is not None and name == wanted:
+            return name, codec['enhanced_codec']
+        if not name.startswith('AAX_'):
+            continue
+        try:
+            rank = tuple(int(n) for n in name[4:].split('_'))
+        except ValueError:
+            logger.warning("Unexpected codec name: %s", name)
+            continue
+        if rank > best_rank:
+            best = (name, codec['enhanced_codec'])
+            best_rank = rank
+    return best
+
+
+def aax_source(api, product, quality, parent=None):
+    """
+    Return the ContentSource for downloading a product as AAX, or None if it
+    is not available as AAX.
+
+    The download link is the redirect target of Audible's content service,
+    as audible-cli resolves it.  Titles that have AAX codecs listed but that
+    the service will not hand out (e.g. from the Plus catalog) are also
+    reported as unavailable.
+    """
+    logger = logging.getLogger(__name__)
+    codec_name, enhanced_codec = choose_aax_codec(product, quality)
+    if codec_name is None:
+        return None
+    client = api.client
+    with metrics.timer('audible_request', endpoint='aax_link'):
+        response = client.raw_request("HEAD"
+                                     ,AAX_DOWNLOAD_URL
+                                     ,params={"type": "AUDI"
+                                             ,"currentTransportMethod": "WIFI"
+                                             ,"key": product['asin']
+                                             ,"codec": enhanced_codec
+                                             }
+                                     ,apply_auth_flow=True
+                                     )
+    if 'location' not in response.headers:
+        logger.info("No AAX download link for %s: HTTP %d"
+                   ,product['asin']
+                   ,response.status_code
+                   )
+        return None
+    url = response.headers['location'].replace(
+               "cds.audible.com"
+              ,f"cds.audible.{client.auth.locale.domain}"
+          )
+    return ContentSource(product['asin']
+                        ,'aax'
+                        ,url
+                        ,codec_name
+                        ,base_filename=base_filename(product, parent)
+                        )
+
+
+def aaxc_source(api
+               ,product
+               ,quality
+               ,parent=None
+               ,response_groups="content_reference, chapter_info"
+               ,allow_mpeg=False
+               ):
+    """
+    Request a download license for a title and return its AAXC
+    ContentSource, with the voucher already decrypted.
+
+    Titles that are only offered without DRM (many podcast episodes) get an
+    "Mpeg" license; with `allow_mpeg` their ContentSource is returned, of
+    kind "mp3" and without a voucher, as audible-cli downloads them.
+
+    Raises:
+        RuntimeError: If the license is denied, or the title is only offered
+            without DRM and `allow_mpeg` is not set.
+    """
+    asin = product['asin']
+    client = api.client
+    with metrics.timer('audible_request', endpoint='license'):
+        license_response = client.post(
+             f"1.0/content/{asin}/licenserequest"
+            ,body={"supported_drm_types": ["Mpeg", "Adrm"]
+                  ,"quality": "Normal" if quality == 'normal' else "High"
+                  ,"consumption_type": "Download"
+                  ,"response_groups": response_groups
+                  }
+            ,headers={**LICENSE_HEADERS
+                     ,"X-Amzn-RequestId": secrets.token_hex(20).upper()
+                     }
+        )
+    content_license = license_response['content_license']
+    if content_license.get('status_code') == 'Denied':
+        raise RuntimeError(f"License denied for {asin}: "
+                           f"{content_license.get('message')}"
+                          )
+    if content_license.get('drm_type') == 'Mpeg':
+        if not allow_mpeg:
+            raise RuntimeError(f"{asin} is only offered as DRM-free MPEG, "
+                               f"which cannot be converted to m4b"
+                              )
+        metadata = content_license['content_metadata']
+        return ContentSource(asin
+                            ,'mp3'
+                            ,metadata['content_url']['offline_url']
+                            ,metadata['content_reference']['content_format']
+                            ,base_filename=base_filename(product, parent)
+                            )
+    content_license['license_response'] = decrypt_voucher_from_licenserequest(
+                                               client.auth
+                                              ,license_response
+                                          )
+    metadata = content_license['content_metadata']
+    return ContentSource(asin
+                        ,'aaxc'
+                        ,metadata['content_url']['offline_url']
+                        ,metadata['content_reference']['content_format']
+                        ,base_filename=base_filename(product, parent)
+                        ,voucher=license_response
+                        )
+
+
+def iter_content(api, source, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Stream a title's encrypted content.
+
+    Args:
+        api (AudibleAPI): Shared Audible client.
+        source (ContentSource): What to download.
+        chunk_size (int): Bytes per chunk.
+    Yields:
+        bytes: Successive chunks of the content.
+    """
+    with _open(api, source) as response:
+        response.raise_for_status()
+        for chunk in response.iter_bytes(chunk_size):
+            metrics.count('download_bytes', len(chunk), kind=source.kind)
+            yield chunk
+
+
+def _open(api, source, headers=None):
+    return api.client.raw_request("GET"
+                                 ,source.url
+                                 ,stream=True
+                                 ,headers=headers
+                                 ,follow_redirects=True
+                                 ,timeout=60
+                                 )
+
+
+_path_locks = {}
+_path_locks_lock = threading.Lock()
+
+
+def _path_lock(path):
+    with _path_locks_lock:
+        return _path_locks.setdefault(path, threading.Lock())
+
+
+def download_content(api
+                    ,source
+                    ,download_dir
+                    ,chunk_size=DEFAULT_CHUNK_SIZE
+                    ,resume=True
+                    ):
+    """
+    Download a title's encrypted content (and, for AAXC, its voucher) into
+    download_dir under source.filename.
+
+    A file that is already there is not downloaded again.  The content is
+    written to a ".part" file first and renamed once complete; with
+    `resume`, an existing ".part" file left by an interrupted download is
+    continued with an HTTP range request.
+
+    Args:
+        api (AudibleAPI): Shared Audible client.
+        source (ContentSource): What to download.
+        download_dir (Path): Directory to download into.
+        chunk_size (int): Bytes read and written at a time.
+        resume (bool): Continue partial downloads.
+    Returns:
+        Path: The downloaded file.
+    Raises:
+        IOError: If the server sent less than it announced.
+    """
+    logger = logging.getLogger(__name__)
+    path = download_dir / source.filename
+    if source.voucher is not None:
+        with path.with_suffix('.voucher').open('w') as f:
+            json.dump(source.voucher, f, indent=4)
+    with _path_lock(path):
+        if path.exists():
+            logger.info("Already downloaded: %s", path.name)
+            return path
+        part_path = path.with_name(path.name + '.part')
+        if not resume:
+            part_path.unlink(missing_ok=True)
+        with metrics.timer('download', kind=source.kind):
+            while True:
+                offset = part_path.stat().st_size if part_path.exists() else 0
+                headers = {'Range': f'bytes={offset}-'} if offset else None
+                with _open(api, source, headers=headers) as response:
+                    if offset and response.status_code == 416:
+                        # The partial file is no prefix of this content any more
+                        logger.info("Restarting download of %s", path.name)
+                        part_path.unlink()
+                        continue
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        offset = 0
+                    elif offset:
+                        logger.info("Resuming download of %s at %d bytes"
+                                   ,path.name
+                                   ,offset
+                                   )
+                    expected = response.headers.get('content-length')
+                    with part_path.open('ab' if offset else 'wb') as f:
+                        for chunk in response.iter_bytes(chunk_size):
+                            f.write(chunk)
+                            metrics.count('download_bytes'
+                                         ,len(chunk)
+                                         ,kind=source.kind
+                                         )
+                break
+        if expected is not None:
+            size = part_path.stat().st_size
+            if size != offset + int(expected):
+                raise IOError(f"Incomplete download of {path.name}: {size} of "
+                              f"{offset + int(expected)} bytes"
+                             )
+        os.replace(part_path, path)
+    logger.info("Downloaded %s", path.name)
+    return path
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(DEFAULT_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ContentCache:
+    """
+    Index of downloaded content, keyed by ASIN, quality and kind ("aax",
+    "aaxc" or "mp3"), with the size and SHA-256 checksum of each file.
+
+    A file is verified before it is handed out: its size must match, and if
+    it was modified since it was recorded its checksum must still match.
+    When `max_bytes` is set, the least recently used files are deleted each
+    time the cache grows beyond it.  Files of an ASIN handed out or added
+    since the cache was opened are in use and never evicted until the ASIN
+    is released (see release()), once its download has been converted.
+
+    Args:
+        db_file (str or Path): SQLite file to keep the index in; sharing the
+            import database file is fine.
+        max_bytes (int): Size cap of the cached files, or 0/None for none.
+    """
+    def __init__(self, db_file, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.in_use = set()
+        self.con = sqlite3.connect(db_file, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            import_schema.upgrade(self.con)
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Build the cache from the full config, indexed in the import database
+        and capped at [files] download_cache_max_gb (default: no cap).
+        """
+        max_gb = config['files'].get('download_cache_max_gb', 0)
+        return cls(pathlib.Path(config['database']['location']).expanduser()
+                  ,max_bytes=int(max_gb * 1e9)
+                  )
+
+    def get(self, asin, quality, kind):
+        """
+        Return the path of a verified cached file, or None if there is none.
+        A file that fails verification is deleted and forgotten.
+        """
+        logger = logging.getLogger(__name__)
+        with self.lock:
+            self.in_use.add(asin)
+            row = self.con.execute('SELECT path, size, mtime_ns, sha256 '
+                                   'FROM content_cache '
+                                   'WHERE asin = ? AND quality = ? AND kind = ?'
+                                  ,(asin, quality, kind)
+                                  ).fetchone()
+        if row is None:
+            return None
+        path, size, mtime_ns, sha256 = pathlib.Path(row[0]), *row[1:]
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            stat = None
+        intact = (    stat is not None
+                 and stat.st_size == size
+                 and (kind != 'aaxc' or path.with_suffix('.voucher').exists())
+                 and (   stat.st_mtime_ns == mtime_ns
+                      or file_sha256(path) == sha256
+                     )
+                 )
+        if not intact:
+            logger.warning("Cached download %s is missing or damaged", path.name)
+            self._remove(asin, quality, kind, path)
+            return None
+        with self.lock:
+            self.con.execute('UPDATE content_cache SET last_used = ?, '
+                             'mtime_ns = ? '
+                             'WHERE asin = ? AND quality = ? AND kind = ?'
+                            ,(time.time(), stat.st_mtime_ns, asin, quality, kind)
+                            )
+            self.con.commit()
+        logger.info("Using cached download %s", path.name)
+        return path
+
+    def checksum(self, path):
+        """
+        Return the SHA-256 checksum recorded for a cached file, or None if
+        the file is not in the cache or changed since it was recorded.
+        """
+        with self.lock:
+            row = self.con.execute('SELECT size, mtime_ns, sha256 '
+                                   'FROM content_cache WHERE path = ?'
+                                  ,(pathlib.Path(path).as_posix(),)
+                                  ).fetchone()
+        if row is None:
+            return None
+        try:
+            stat = pathlib.Path(path).stat()
+        except FileNotFoundError:
+            return None
+        if (stat.st_size, stat.st_mtime_ns) != (row[0], row[1]):
+            return None
+        return row[2]
+
+    def put(self, asin, quality, kind, path):
+        """
+        Record a downloaded file, then evict old files if over the size cap.
+        The file is in use until its ASIN is released.
+        """
+        stat = path.stat()
+        sha256 = file_sha256(path)
+        with self.lock:
+            self.in_use.add(asin)
+            self.con.execute('INSERT OR REPLACE INTO content_cache '
+                             '(asin, quality, kind, path, size, mtime_ns, '
+                             ' sha256, last_used) '
+                             'values (?, ?, ?, ?, ?, ?, ?, ?)'
+                            ,(asin, quality, kind, path.as_posix(), stat.st_size
+                             ,stat.st_mtime_ns, sha256, time.time()
+                             )
+                            )
+            self.con.commit()
+        if self.max_bytes:
+            self.evict()
+
+    def release(self, asins):
+        """
+        Mark the files of some ASINs as no longer needed by the running
+        import, so they can be evicted, then evict old files if over the
+        size cap.
+        """
+        with self.lock:
+            self.in_use.difference_update(asins)
+        if self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """
+        Delete least recently used files that are not in use until the cache
+        fits in max_bytes.
+        """
+        logger = logging.getLogger(__name__)
+        with self.lock:
+            total = self.con.execute('SELECT COALESCE(SUM(size), 0) '
+                                     'FROM content_cache'
+                                    ).fetchone()[0]
+            candidates = [row for row in self.con.execute('SELECT asin, quality, '
+                                                          'kind, path, size '
+                                                          'FROM content_cache '
+                                                          'ORDER BY last_used'
+                                                         )
+                          if row[0] not in self.in_use
+                         ]
+        for asin, quality, kind, path, size in candidates:
+            if total <= self.max_bytes:
+                break
+            logger.info("Evicting cached download %s", pathlib.Path(path).name)
+            self._remove(asin, quality, kind, pathlib.Path(path))
+            total -= size
+
+    def _remove(self, asin, quality, kind, path):
+        path.unlink(missing_ok=True)
+        path.with_suffix('.voucher').unlink(missing_ok=True)
+        with self.lock:
+            self.con.execute('DELETE FROM content_cache '
+                             'WHERE asin = ? AND quality = ? AND kind = ?'
+                            ,(asin, quality, kind)
+                            )
+            self.con.commit()
+
+    def close(self):
+        with self.lock:
+            self.con.close()
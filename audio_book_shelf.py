@@ -1,10 +1,17 @@
+import hashlib
+import json
 import logging
 import pathlib
+import threading
+import time
 import urllib.parse
 from urllib.parse import urljoin
 
 import requests
 
+from http_session import build_session
+import metrics
+
 logger = logging.getLogger(__name__)
 
 class AudioBookShelf:
@@ -15,6 +22,9 @@ class AudioBookShelf:
         self.api_token = config['api_token']
         self.api_headers = {"Authorization": f"Bearer {self.api_token}"}
         self.audiobooks_dir = pathlib.Path(config['audiobooks_dir'])
+        self.session = build_session(config)
+        self._item_indexes = {}
+        self._index_lock = threading.Lock()
 
     def list_libraries(self):
         """
@@ -24,7 +34,7 @@ class AudioBookShelf:
             List of library dicts as returned by the API.
         """
         url = urljoin(self.api_url, "libraries")
-        response = requests.get(url, headers=self.api_headers)
+        response = self.session.get(url, headers=self.api_headers)
         response.raise_for_status()
         data = response.json()
         return data.get("libraries", [])
@@ -47,25 +57,26 @@ class AudioBookShelf:
         libraries = self.list_libraries()
         return self.find_book_library(libraries)
 
-    def list_library_items(self, library_id):
+    def list_library_items(self, library_id, minified=False):
         """
         Fetch and return all items in the given library.
 
         Args:
             library_id (str): The ID of the library to fetch items from.
+            minified (bool): Request the smaller minified item form.
         Returns:
             list: List of item dicts.
         """
-        params = {"limit": 0, "minified": False}
+        params = {"limit": 0, "minified": 1 if minified else False}
         url = urljoin(self.api_url, f"libraries/{library_id}/items")
-        response = requests.get(url, headers=self.api_headers, params=params)
+        response = self.session.get(url, headers=self.api_headers, params=params)
         response.raise_for_status()
         data = response.json()
         return data.get("results", [])
 
     def fetch_library_item(self, item_id):
         url = urljoin(self.api_url, f"items/{item_id}")
-        response = requests.get(url, headers=self.api_headers)
+        response = self.session.get(url, headers=self.api_headers)
         response.raise_for_status()
         data = response.json()
         return data
@@ -82,7 +93,7 @@ class AudioBookShelf:
         """
         params = {"asin": asin, "region": region}
         url = urljoin(self.api_url, "search/chapters")
-        response = requests.get(url, headers=self.api_headers, params=params)
+        response = self.session.get(url, headers=self.api_headers, params=params)
         response.raise_for_status()
         data = response.json()
         return data.get("chapters", [])
@@ -105,24 +116,33 @@ class AudioBookShelf:
             payload.append({"id": idx, "start": start, "end": end, "title": title})
         return payload
 
-    def update_item_chapters(self, library_item_id, chapters):
+    def update_item_chapters(self, library_item_id, chapters, current_chapters=None):
         """
         Send the chapter payload to Audiobookshelf to update a library item's chapters.
 
         Args:
             library_item_id (str): ID of the library item.
-            payload (list): List of payload dicts.
+            chapters (list): Raw chapter data dicts.
+            current_chapters (list): Chapters already on the item (its
+                media.chapters), if known.  When they match the new payload
+                nothing is sent.
         Returns:
-            dict: JSON response from the API.
+            dict: JSON response from the API, or None if the chapters were
+                  already up to date.
         """
         payload = self.build_chapter_payload(chapters)
+        if (   current_chapters is not None
+           and chapters_hash(current_chapters) == chapters_hash(payload)
+           ):
+            logger.debug("Chapters unchanged for %s", library_item_id)
+            return None
         url = urljoin(self.api_url, f"items/{library_item_id}/chapters")
-        response = requests.post(url
-                                ,headers={**self.api_headers
-                                         ,"Content-Type": "application/json"
-                                         }
-                                ,json={"chapters": payload}
-                                )
+        response = self.session.post(url
+                                    ,headers={**self.api_headers
+                                             ,"Content-Type": "application/json"
+                                             }
+                                    ,json={"chapters": payload}
+                                    )
         response.raise_for_status()
         return response.json()
 
@@ -138,22 +158,88 @@ class AudioBookShelf:
         """
         url = urljoin(self.api_url, f"items/{library_item_id}/media")
         body = {"metadata": {"asin": asin}}
-        response = requests.patch(url
-                                 ,headers={**self.api_headers
-                                          ,"Content-Type": "application/json"
-                                          }
-                                 ,json=body
-                                 )
+        response = self.session.patch(url
+                                     ,headers={**self.api_headers
+                                              ,"Content-Type": "application/json"
+                                              }
+                                     ,json=body
+                                     )
         response.raise_for_status()
         return response.json()
 
-    def get_item_id_for_folder(self, library_id, folder_path):
+    def batch_update_items(self, updates):
+        """
+        Update the media of several library items in one request, via the
+        items/batch/update endpoint.
+
+        Args:
+            updates (list): {"id": library item id, "mediaPayload": payload}
+                for each item, where payload is what PATCH items/{id}/media
+                takes, e.g. {"metadata": {"asin": ...}, "chapters": [...]}.
+        Returns:
+            dict: JSON response from the API.
+        """
+        url = urljoin(self.api_url, "items/batch/update")
+        response = self.session.post(url
+                                    ,headers={**self.api_headers
+                                             ,"Content-Type": "application/json"
+                                             }
+                                    ,json=updates
+                                    )
+        response.raise_for_status()
+        return response.json()
+
+    def refresh_item_index(self, library_id):
+        """
+        Bring the path index for a library up to date.
+
+        The first call builds the index from the full item list; later calls
+        only fetch items added since the newest item already indexed.  Items
+        moved or deleted on the server after they were indexed are not
+        noticed.
+
+        Args:
+            library_id (str): ID of the library to index
+        """
+        with self._index_lock:
+            index = self._item_indexes.get(library_id)
+            if index is None:
+                items = self.list_library_items(library_id, minified=True)
+                index = {"paths": {}, "items": {}, "since": None}
+                self._item_indexes[library_id] = index
+            else:
+                items = self.list_library_items_since(library_id
+                                                     ,since=index["since"]
+                                                     )
+            for item in items:
+                self._index_item(index, item)
+
+    @staticmethod
+    def _index_item(index, item):
+        # Forget the path of the previous version of the item, in case it
+        # was moved
+        old_path = index["items"].get(item["id"])
+        if index["paths"].get(old_path) == item["id"]:
+            del index["paths"][old_path]
+
+        path = item_relative_path(item)
+        index["paths"][path] = item["id"]
+        index["items"][item["id"]] = path
+
+        added = item.get("addedAt")
+        if added is not None and (   index["since"] is None
+                                 or added > index["since"]
+                                 ):
+            index["since"] = added
+
+    def get_item_id_for_folder(self, library_id, folder_path, refresh=True):
         """
         Retrieve the item id for the specified folder in the specified library.
 
         Args:
             library_id (str): ID of the library to search
             folder_path (pathlib.Path): Path of the item for which to search
+            refresh (bool): Pick up items added since the last lookup first
         Returns:
             str: item ID for the path
         """
@@ -161,22 +247,359 @@ class AudioBookShelf:
         logger.debug("folder_path = %s", folder_path)
         folder_relative = folder_path.relative_to(self.audiobooks_dir)
         logger.debug("folder_relative = %s", folder_relative)
-        items = self.list_library_items(library_id)
-        for item in items:
-            item_path = pathlib.Path(*pathlib.Path(item["path"]).parts[2:])
-            logger.debug("item_path = %s", item_path)
-            if item_path == folder_relative:
-                return item["id"]
-        return None
+        if refresh or library_id not in self._item_indexes:
+            self.refresh_item_index(library_id)
+        with self._index_lock:
+            return self._item_indexes[library_id]["paths"].get(folder_relative)
+
+    def list_library_items_since(self, library_id, since=None, page_size=100):
+        """
+        Fetch the items in the given library that were added since the given
+        time.
 
-    def trigger_library_rescan(self, library_id):
+        Items are requested newest first, one page at a time, and paging stops
+        at the first item added before `since`, so the cost is proportional to
+        the number of new items rather than the size of the library.  (The
+        items query cannot sort by updatedAt, so changes to existing items
+        cannot be paged this way.)
+
+        Args:
+            library_id (str): The ID of the library to fetch items from.
+            since (int): Server addedAt timestamp (ms); None fetches all.
+            page_size (int): Number of items to request per page.
+        Returns:
+            list: List of minified item dicts, newest first.
+        """
+        url = urljoin(self.api_url, f"libraries/{library_id}/items")
+        items = []
+        page = 0
+        while True:
+            params = {"limit": page_size
+                     ,"page": page
+                     ,"sort": "addedAt"
+                     ,"desc": 1
+                     ,"minified": 1
+                     }
+            response = self.session.get(url, headers=self.api_headers, params=params)
+            response.raise_for_status()
+            results = response.json().get("results", [])
+            for item in results:
+                if since is not None and item.get("addedAt", 0) < since:
+                    return items
+                items.append(item)
+            if len(results) < page_size:
+                return items
+            page += 1
+
+    def trigger_library_rescan(self, library_id, force=True):
         """
         Call the audiobookshelf API to trigger a library rescan.
 
         Args:
             library_id (str): ID of the library to scan
+            force (bool): Rescan every item, not just new or changed ones
         """
-        params = {"force": 1}
+        params = {"force": 1} if force else {}
         url = urljoin(self.api_url, f"libraries/{library_id}/scan")
-        response = requests.get(url, headers=self.api_headers, params=params)
+        response = self.session.get(url, headers=self.api_headers, params=params)
         return response.status_code == 200
+
+
+def chapters_hash(chapters):
+    """
+    Return a stable hash of a chapter list.
+
+    Only the start, end and title of each chapter count, with times rounded
+    to the millisecond, so a build_chapter_payload() result and the chapters
+    audiobookshelf returns for an item (media.chapters) hash the same when
+    they describe the same chapters.
+
+    Args:
+        chapters (list): Dicts with start, end and title keys.
+    Returns:
+        str: Hex digest.
+    """
+    def rounded(value):
+        return None if value is None else round(float(value), 3)
+
+    canonical = [[rounded(ch.get("start")), rounded(ch.get("end")), ch.get("title")]
+                 for ch in chapters
+                ]
+    encoded = json.dumps(canonical, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def item_relative_path(item):
+    """
+    Return an item's path relative to its library folder.
+
+    Audiobookshelf reports item paths as seen by the server, e.g.
+    /audiobooks/Author/Title, so the root and library folder are dropped.
+    """
+    return pathlib.Path(*pathlib.Path(item["path"]).parts[2:])
+
+
+class ItemResolver:
+    """
+    Resolves newly shelved folders to audiobookshelf library item ids.
+
+    Folders shelved within `batch_window` seconds of each other share a single
+    (non-forced) library scan.  Waiting callers poll an incremental
+    path -> item id index, refreshed only with items changed since the last
+    refresh, backing off between polls up to `max_poll_interval`.  If a folder
+    still has not appeared after `rescan_after` seconds (e.g. because the scan
+    request arrived while the server was already scanning) another scan is
+    requested, and after `timeout` seconds resolve() gives up.
+
+    The index itself is the one kept by AudioBookShelf.
+    """
+    def __init__(self
+                ,shelf
+                ,library_id
+                ,batch_window=2.0
+                ,poll_interval=1.0
+                ,max_poll_interval=30.0
+                ,rescan_after=120.0
+                ,timeout=900.0
+                ):
+        self.shelf = shelf
+        self.library_id = library_id
+        self.batch_window = batch_window
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.rescan_after = rescan_after
+        self.timeout = timeout
+        self._last_refresh = None
+        self._pending = set()
+        self._scan_timer = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def add(self, folder_path):
+        """
+        Register a newly shelved folder, scheduling a scan for its batch.
+
+        Args:
+            folder_path (pathlib.Path): Absolute path of the shelved folder.
+        """
+        with self._lock:
+            self._pending.add(folder_path)
+            if self._scan_timer is None:
+                self._scan_timer = threading.Timer(self.batch_window, self._scan)
+                self._scan_timer.daemon = True
+                self._scan_timer.start()
+
+    def _scan(self):
+        with self._lock:
+            batch = self._pending
+            self._pending = set()
+            self._scan_timer = None
+        metrics.count('abs_scans')
+        logger.info("Scanning library %s for %d new folder(s)"
+                   ,self.library_id
+                   ,len(batch)
+                   )
+        if not self.shelf.trigger_library_rescan(self.library_id, force=False):
+            logger.warning("Library scan request for %s was not accepted"
+                          ,self.library_id
+                          )
+
+    def refresh(self):
+        """
+        Update the shelf's index with items changed since the previous
+        refresh.
+
+        Concurrent callers share one refresh, and refreshes are spaced at least
+        `poll_interval` apart.
+        """
+        with self._refresh_lock:
+            now = time.monotonic()
+            if (   self._last_refresh is not None
+               and now - self._last_refresh < self.poll_interval
+               ):
+                return
+            self.shelf.refresh_item_index(self.library_id)
+            self._last_refresh = time.monotonic()
+
+    def resolve(self, folder_path):
+        """
+        Wait for audiobookshelf to pick up a shelved folder.
+
+        Args:
+            folder_path (pathlib.Path): Absolute path of the shelved folder.
+        Returns:
+            str: item ID for the folder
+        Raises:
+            TimeoutError: If the folder does not show up within `timeout`.
+        """
+        with metrics.timer('abs_item_wait'):
+            return self._wait_for(folder_path)
+
+    def _wait_for(self, folder_path):
+        self.add(folder_path)
+        started = time.monotonic()
+        last_scan = started
+        delay = self.poll_interval
+        while True:
+            time.sleep(delay)
+            self.refresh()
+            if (item_id := self.shelf.get_item_id_for_folder(self.library_id
+                                                            ,folder_path
+                                                            ,refresh=False
+                                                            )
+               ):
+                return item_id
+            now = time.monotonic()
+            if now - started > self.timeout:
+                raise TimeoutError(f"{folder_path} did not appear in "
+                                   f"library {self.library_id} after "
+                                   f"{self.timeout}s"
+                                  )
+            if now - last_scan > self.rescan_after:
+                self.add(folder_path)
+                last_scan = now
+            delay = min(delay * 2, self.max_poll_interval)
+
+
+class MetadataBatch:
+    """
+    Queues ASIN and chapter changes for library items and sends them to
+    audiobookshelf together.
+
+    Changes for the same item are merged into one media update, and once
+    `batch_size` items are queued they are sent in a single
+    items/batch/update request.  Servers without the batch endpoint get one
+    request per item instead.  Each change can carry an `on_done` callback,
+    run once it has been sent; changes that fail are logged and their
+    callbacks are not run.
+
+    Call flush() when done to send what is still queued.
+    """
+    def __init__(self, shelf, batch_size=25):
+        self.shelf = shelf
+        self.batch_size = max(1, batch_size)
+        self.batch_supported = True
+        self.requests = 0
+        self.failed = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def update_item(self
+                   ,library_item_id
+                   ,asin=None
+                   ,chapters=None
+                   ,current_chapters=None
+                   ,on_done=None
+                   ):
+        """
+        Queue changes for a library item.
+
+        Args:
+            library_item_id (str): ID of the library item.
+            asin (str): ASIN to set, or None to leave it.
+            chapters (list): Raw chapter data dicts (as fetch_chapters()
+                returns them) to set, or None to leave them.
+            current_chapters (list): Chapters already on the item, if known;
+                when they match `chapters` the chapters are left alone.
+            on_done (callable): Called without arguments once the changes
+                are sent.
+        """
+        media = {}
+        if asin is not None:
+            media["metadata"] = {"asin": asin}
+        if chapters is not None:
+            payload = self.shelf.build_chapter_payload(chapters)
+            if (   current_chapters is None
+               or chapters_hash(current_chapters) != chapters_hash(payload)
+               ):
+                media["chapters"] = payload
+        with self._lock:
+            pending = self._pending.setdefault(library_item_id
+                                              ,{"media": {}
+                                               ,"chapters": None
+                                               ,"callbacks": []
+                                               }
+                                              )
+            pending["media"].update(media)
+            if "chapters" in media:
+                pending["chapters"] = chapters
+            if on_done is not None:
+                pending["callbacks"].append(on_done)
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Send every queued change.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        to_send = {item_id: change for item_id, change in pending.items()
+                   if change["media"]
+                  }
+        sent = set(pending) - set(to_send)
+        with self._lock:
+            batch_supported = self.batch_supported
+        if to_send and batch_supported:
+            try:
+                self._count(requests=1)
+                self.shelf.batch_update_items(
+                     [{"id": item_id, "mediaPayload": change["media"]}
+                      for item_id, change in to_send.items()
+                     ]
+                )
+                sent.update(to_send)
+                to_send = {}
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code not in (404, 405):
+                    logger.error("Batch update of %d items failed: %s"
+                                ,len(to_send)
+                                ,e
+                                )
+                    self._count(failed=len(to_send))
+                    to_send = {}
+                else:
+                    logger.info("No batch update endpoint, updating items "
+                                "one by one"
+                               )
+                    with self._lock:
+                        self.batch_supported = False
+            except requests.RequestException as e:
+                logger.error("Batch update of %d items failed: %s"
+                            ,len(to_send)
+                            ,e
+                            )
+                self._count(failed=len(to_send))
+                to_send = {}
+        for item_id, change in to_send.items():
+            try:
+                self._update_one(item_id, change)
+                sent.add(item_id)
+            except requests.RequestException as e:
+                logger.error("Updating %s failed: %s", item_id, e)
+                self._count(failed=1)
+        for item_id in (item_id for item_id in pending if item_id in sent):
+            for callback in pending[item_id]["callbacks"]:
+                try:
+                    callback()
+                except Exception:
+                    logger.exception("Callback for %s failed", item_id)
+
+    def _count(self, requests=0, failed=0):
+        # flush() runs on several metadata workers at once
+        with self._lock:
+            self.requests += requests
+            self.failed += failed
+
+    def _update_one(self, library_item_id, change):
+        if "metadata" in change["media"]:
+            self._count(requests=1)
+            self.shelf.update_item_asin(library_item_id
+                                       ,change["media"]["metadata"]["asin"]
+                                       )
+        if "chapters" in change["media"]:
+            self._count(requests=1)
+            self.shelf.update_item_chapters(library_item_id, change["chapters"])
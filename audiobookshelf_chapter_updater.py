@@ -3,16 +3,18 @@ Audiobookshelf Chapter Updater
 Break down into testable pieces
 """
 
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 import os
 import re
+import time
 import tomllib
 import logging
 from pathlib import Path
-import pprint
-from urllib.parse import urljoin
 
-import requests
-from audible import Authenticator, Client
+from audible_client import AudibleAPI
+from audio_book_shelf import AudioBookShelf, MetadataBatch, chapters_hash
+from pipeline import StageStats
 
 # Load configuration
 config_filename = os.getenv("AUDIBLE_AUDIOBOOKSHELF_CONFIG_FILE")
@@ -28,155 +30,18 @@ else:
 with config_file.open("rb") as f:
     config = tomllib.load(f)
 
-# API configuration
-API_URL = config['audiobookshelf']['base_url'].rstrip("/") + "/api/"
-API_TOKEN = config['audiobookshelf']['api_token']
-HEADERS = {"Authorization": f"Bearer {API_TOKEN}"}
-CONFIG_AUDIBLE_AUTH_FILE = config['audible']['auth_file']
+AUDIBLE = AudibleAPI.from_config(config)
 
 
-def list_libraries():
+def part_asin_from_filename(item):
     """
-    Fetch and return the list of libraries from Audiobookshelf.
-
-    Returns:
-        List of library dicts as returned by the API.
-    """
-    url = urljoin(API_URL, "libraries")
-    response = requests.get(url, headers=HEADERS)
-    response.raise_for_status()
-    data = response.json()
-    return data.get("libraries", [])
-
-
-def find_book_library(libraries):
-    """
-    Given a list of library objects, return the ID of the first "book" library.
-
-    Args:
-        libraries (list): List of library dicts.
-    Returns:
-        str: The library ID for books.
-    """
-    for lib in libraries:
-        if lib.get("mediaType") == "book":
-            return lib["id"]
-    raise RuntimeError("No book library found")
-
-
-def list_library_items(library_id):
-    """
-    Fetch and return all items in the given library.
-
-    Args:
-        library_id (str): The ID of the library to fetch items from.
-    Returns:
-        list: List of item dicts.
-    """
-    params = {"limit": 0, "minified": False}
-    url = urljoin(API_URL, f"libraries/{library_id}/items")
-    response = requests.get(url, headers=HEADERS, params=params)
-    response.raise_for_status()
-    data = response.json()
-    return data.get("results", [])
-
-
-def fetch_library_item(item_id):
-    #TODO
-    url = urljoin(API_URL, f"items/{item_id}")
-    response = requests.get(url, headers=HEADERS)
-    response.raise_for_status()
-    data = response.json()
-    return data
-
-
-def fetch_chapters(asin, region="us"):
-    """
-    Fetch chapter metadata for the given ASIN via Audiobookshelf's search/chapters API.
-
-    Args:
-        asin (str): Audible ASIN of the book.
-        region (str): Region code, default "us".
-    Returns:
-        list: List of raw chapter dicts as returned by the API.
-    """
-    params = {"asin": asin, "region": region}
-    url = urljoin(API_URL, "search/chapters")
-    response = requests.get(url, headers=HEADERS, params=params)
-    response.raise_for_status()
-    data = response.json()
-    return data.get("chapters", [])
-
-
-def build_payload(chapters):
-    """
-    Build the update payload from raw chapter data.
-
-    Args:
-        chapters (list): Raw chapter data dicts.
-    Returns:
-        list: List of payload dicts {id, start, end, title}.
-    """
-    payload = []
-    for idx, ch in enumerate(chapters):
-        start = ch.get("startOffsetSec")
-        length = ch.get("lengthMs", 0) / 1000.0
-        end = start + length if start is not None else None
-        title = ch.get("title", f"Chapter {idx+1}")
-        payload.append({"id": idx, "start": start, "end": end, "title": title})
-    return payload
-
-
-def update_item_chapters(library_item_id, payload):
-    """
-    Send the chapter payload to Audiobookshelf to update a library item's chapters.
-
-    Args:
-        library_item_id (str): ID of the library item.
-        payload (list): List of payload dicts.
-    Returns:
-        dict: JSON response from the API.
-    """
-    url = urljoin(API_URL, f"items/{library_item_id}/chapters")
-    response = requests.post(
-        url,
-        headers={**HEADERS, "Content-Type": "application/json"},
-        json={"chapters": payload}
-    )
-    response.raise_for_status()
-    return response.json()
-
-
-def update_item_asin(library_item_id, asin):
-    """
-    Update the ASIN metadata for a library item via API.
-
-    Args:
-        library_item_id (str): ID of the library item.
-        asin (str): The Audible ASIN to set.
-    Returns:
-        dict: JSON response from the API.
-    """
-    url = urljoin(API_URL, f"items/{library_item_id}/media")
-    body = {"metadata": {"asin": asin}}
-    response = requests.patch(
-        url,
-        headers={**HEADERS, "Content-Type": "application/json"},
-        json=body
-    )
-    response.raise_for_status()
-    return response.json()
-
-
-def derive_asin_from_filename(item):
-    """
-    Derive the root ASIN from the item's directory by inspecting .m4b filenames.
-    For multipart books, this also fetches the origin_asin via Audible API if available.
+    Find the ASIN in the name of the first .m4b file in the item's directory.
+    For a part of a multipart book this is the ASIN of the part.
 
     Args:
         item (dict): Library item dict from Audiobookshelf API.
     Returns:
-        str or None: Derived ASIN, or None if not found.
+        str or None: ASIN in the filename, or None if not found.
     """
     logger = logging.getLogger(__name__)
     lib_root = Path(config['audiobookshelf']['audiobooks_dir'])
@@ -213,58 +78,209 @@ def derive_asin_from_filename(item):
     if not match:
         logger.warning("No ASIN pattern found in filename %s", filename)
         return None
-    part_asin = match.group(1)
+    return match.group(1)
 
+
+def derive_asin_from_filename(item):
+    """
+    Derive the root ASIN from the item's directory by inspecting .m4b filenames.
+    For multipart books, this also looks up the root ASIN of the part via the Audible
+    API (served from the product cache after the first lookup).
+
+    Args:
+        item (dict): Library item dict from Audiobookshelf API.
+    Returns:
+        str or None: Derived ASIN, or None if not found.
+    """
+    part_asin = part_asin_from_filename(item)
+    if part_asin is None:
+        return None
     # Fetch origin_asin if multipart
-    auth = Authenticator.from_file(CONFIG_AUDIBLE_AUTH_FILE)
-    with Client(auth=auth) as client:
-        # Fetch full product info to get origin_asin
-        product = client.get(f"1.0/catalog/products/{part_asin}")
+    product = AUDIBLE.get_product(part_asin, profile='dedup-only')
+    return root_asin_for_product(product)
 
-    if isinstance(product, dict) and 'product' in product:
-        product = product['product']
-    root_asin = product.get('origin_asin') or part_asin
-    return root_asin
 
+def derive_asins_from_filenames(items):
+    """
+    Derive the root ASIN of every item that has none in its metadata, looking
+    up the products of all of their files together, many ASINs per catalog
+    request.
 
-def main():
+    Args:
+        items (list): Library item dicts from Audiobookshelf API.
+    Returns:
+        dict: Derived ASIN (or None if not found) by library item id.
+    """
+    logger = logging.getLogger(__name__)
+    part_asins = {item.get("id"): part_asin_from_filename(item)
+                  for item in items
+                  if not item.get("media", {}).get("metadata", {}).get("asin")
+                 }
+    products = AUDIBLE.get_products(filter(None, part_asins.values())
+                                   ,profile='dedup-only'
+                                   )
+    derived = {}
+    for item_id, part_asin in part_asins.items():
+        if part_asin is not None and part_asin not in products:
+            logger.warning("ASIN %s of item %s not found in the Audible catalog"
+                          ,part_asin
+                          ,item_id
+                          )
+        derived[item_id] = (root_asin_for_product(products[part_asin])
+                            if part_asin in products else None
+                           )
+    return derived
+
+
+def root_asin_for_product(product):
+    """
+    Return the ASIN of the title a product belongs to: its origin_asin, else
+    the parent of a component part, else the product's own ASIN.
+    """
+    parents = [rel['asin'] for rel in product.get('relationships', [])
+               if rel.get('relationship_to_product') == 'parent'
+               and rel.get('relationship_type') == 'component'
+              ]
+    return product.get('origin_asin') or next(iter(parents), product['asin'])
+
+
+def process_item(item, shelf, batch, derived_asins=None):
+    """
+    Make sure a single library item has an ASIN and up to date chapters.
+
+    The changes are queued on `batch`, which merges the ASIN and chapters of
+    an item into one update and sends many items per request.
+
+    Args:
+        item (dict): Library item dict from Audiobookshelf API.
+        shelf (AudioBookShelf): Audiobookshelf client.
+        batch (MetadataBatch): Queue for the item's changes.
+        derived_asins (dict): ASINs already derived from the filenames, as
+            returned by derive_asins_from_filenames(); when None the item's
+            ASIN is derived on its own.
+    Returns:
+        str: "processed" if new chapters were queued, "dropped" if the item
+             was skipped.
+    """
+    lib_id = item.get("id")
+    asin = item.get("media", {}).get("metadata", {}).get("asin")
+    new_asin = None
+    if not asin:
+        if derived_asins is not None:
+            derived = derived_asins.get(lib_id)
+        else:
+            derived = derive_asin_from_filename(item)
+        if not derived:
+            print(f"Skipping {lib_id} (no ASIN in metadata or filename)")
+            return "dropped"
+        print(f"Derived ASIN {derived} from filename for item {lib_id}")
+        asin = new_asin = derived
+
+    print(f"Processing {asin} -> {lib_id}")
+    chapters = shelf.fetch_chapters(asin)
+    if not chapters:
+        print(f"  No chapters found for {asin}; skipping.")
+        if new_asin:
+            batch.update_item(lib_id, asin=new_asin)
+        return "dropped"
+
+    payload = shelf.build_chapter_payload(chapters)
+    current = item.get("media", {}).get("chapters")
+    if current is not None and chapters_hash(current) == chapters_hash(payload):
+        print(f"  Chapters unchanged for {asin}; skipping.")
+        if new_asin:
+            batch.update_item(lib_id, asin=new_asin)
+        return "dropped"
+    batch.update_item(lib_id, asin=new_asin, chapters=chapters)
+    print(f"  Queued new chapters for {asin}")
+    return "processed"
+
+
+def parse_args(argv=None):
+    updater_config = config.get('chapter_updater', {})
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--concurrency"
+                       ,type=int
+                       ,default=updater_config.get('concurrency', 1)
+                       ,help="Number of library items processed at once"
+                       )
+    parser.add_argument("--rate-limit"
+                       ,type=float
+                       ,default=updater_config.get('rate_limit', 0)
+                       ,help="Maximum Audiobookshelf requests per second "
+                             "(0 for no limit)"
+                       )
+    parser.add_argument("--progress-every"
+                       ,type=int
+                       ,default=updater_config.get('progress_every', 100)
+                       ,help="Print a progress line after this many items"
+                       )
+    parser.add_argument("--batch-size"
+                       ,type=int
+                       ,default=updater_config.get('batch_size', 25)
+                       ,help="Items whose changes are sent in one request"
+                       )
+    args = parser.parse_args(argv)
+    if args.progress_every < 1:
+        parser.error("--progress-every must be at least 1")
+    return args
+
+
+def main(argv=None):
     """
     Main orchestration:
       1. List libraries
       2. Find book library
-      3. List items
-      4. For each item, fetch chapters and update
+      3. List items, and derive the ASINs missing from their metadata
+      4. For each item, fetch chapters and update, running up to
+         --concurrency items at once
     """
-    libraries = list_libraries()
-    book_lib_id = find_book_library(libraries)
-    items = list_library_items(book_lib_id)
-
-    for item in items:
-        item_expanded = fetch_library_item(item["id"])
-        pprint.pprint(item_expanded)
-        break
-        lib_id = item.get("id")
-        asin = item.get("media", {}).get("metadata", {}).get("asin")
-        if not asin:
-            derived = derive_asin_from_filename(item)
-            if not derived:
-                print(f"Skipping {lib_id} (no ASIN in metadata or filename)")
-                continue
-            print(f"Derived ASIN {derived} from filename for item {lib_id}")
-            update_item_asin(lib_id, derived)
-            asin = derived
-
-        print(f"Processing {asin} -> {lib_id}")
-        chapters = fetch_chapters(asin)
-        if not chapters:
-            print("  No chapters found; skipping.")
-            continue
-
-        payload = build_payload(chapters)
-        resp = update_item_chapters(lib_id, payload)
-        print("  Updated:", resp)
+    args = parse_args(argv)
+    shelf = AudioBookShelf({**config['audiobookshelf']
+                           ,'pool_size': max(args.concurrency
+                                            ,config['audiobookshelf']
+                                                  .get('pool_size', 10)
+                                            )
+                           ,'rate_limit': args.rate_limit
+                           })
+    batch = MetadataBatch(shelf, batch_size=args.batch_size)
+
+    book_lib_id = shelf.get_book_library_id()
+    # The full (non-minified) listing already has each item's metadata, so
+    # items do not need to be fetched again one by one
+    items = shelf.list_library_items(book_lib_id)
+    derived_asins = derive_asins_from_filenames(items)
+
+    stats = StageStats("chapters")
+
+    def run(item):
+        started = time.monotonic()
+        try:
+            outcome = process_item(item, shelf, batch, derived_asins)
+        except Exception as e:
+            print(f"Failed {item.get('id')}: {e}")
+            outcome = "failed"
+        handled = stats.record(started, time.monotonic(), outcome)
+        if handled % args.progress_every == 0:
+            print(f"Progress: {handled}/{len(items)} items, "
+                  f"{stats.throughput:.2f} items/s"
+                 )
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        # Reading the results re-raises anything run() itself raised
+        for _ in executor.map(run, items):
+            pass
+    batch.flush()
+    AUDIBLE.close()
+
+    print(f"Done: {stats.processed} updated, {stats.dropped} skipped, "
+          f"{stats.failed} failed out of {len(items)} items in "
+          f"{stats.wall_seconds:.1f}s ({stats.throughput:.2f} items/s)"
+         )
+    print(f"Sent the changes in {batch.requests} requests; "
+          f"{batch.failed} items could not be updated"
+         )
 
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,142 @@
+#! /usr/bin/env python3
+'''
+Benchmark the native MP4 chapter reader against ffprobe
+
+Reads the chapters of the given files (or of generated m4b files) with
+mp4_chapters.read_chapters() and with one ffprobe process per file, checks
+that both agree, and reports the time per file.
+
+    python benchmarks/chapter_parser.py ~/data/Audiobooks/**/*.m4b
+    python benchmarks/chapter_parser.py --generate 200 --chapters 40
+'''
+
+import argparse
+import json
+import pathlib
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent))
+import fixtures
+import mp4_chapters
+
+
+def ffprobe_chapters(path):
+    result = subprocess.run(['ffprobe'
+                            ,'-v', 'quiet'
+                            ,'-print_format', 'json'
+                            ,'-show_chapters'
+                            ,'-i', str(path)
+                            ]
+                           ,stdout=subprocess.PIPE
+                           ,check=True
+                           )
+    return [{'start_time': float(chapter['start_time'])
+            ,'end_time': float(chapter['end_time'])
+            ,'title': chapter.get('tags', {}).get('title', f"Chapter {idx + 1}")
+            }
+            for idx, chapter in enumerate(json.loads(result.stdout)
+                                              .get('chapters', [])
+                                         )
+           ]
+
+
+def generate_fixtures(directory, count, chapters, seconds):
+    '''
+    Write `count` copies of a short m4b with `chapters` chapters
+    '''
+    first = fixtures.write_chaptered_m4b(directory / 'fixture-0.m4b'
+                                        ,seconds
+                                        ,chapters
+                                        )
+    files = [first]
+    for i in range(1, count):
+        files.append(directory / f'fixture-{i}.m4b')
+        shutil.copyfile(first, files[-1])
+    return files
+
+
+def time_reader(reader, files, repeat):
+    best = None
+    results = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        results = [reader(path) for path in files]
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, results
+
+
+def same_chapters(a, b, tolerance=0.001):
+    return (    len(a) == len(b)
+           and all(    abs(x['start_time'] - y['start_time']) <= tolerance
+                   and abs(x['end_time'] - y['end_time']) <= tolerance
+                   and x['title'] == y['title']
+                   for x, y in zip(a, b)
+                  )
+           )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('files', nargs='*', type=pathlib.Path
+                       ,help="MP4/M4B files to read"
+                       )
+    parser.add_argument('--generate', type=int, default=0, metavar='N'
+                       ,help="Generate N m4b files to read (needs ffmpeg)"
+                       )
+    parser.add_argument('--chapters', type=int, default=30
+                       ,help="Chapters per generated file (default 30)"
+                       )
+    parser.add_argument('--seconds', type=int, default=60
+                       ,help="Length of a generated file (default 60)"
+                       )
+    parser.add_argument('--repeat', type=int, default=3
+                       ,help="Runs per reader; the best is reported (default 3)"
+                       )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory() as tmp:
+        files = list(args.files)
+        if args.generate:
+            files += generate_fixtures(pathlib.Path(tmp)
+                                      ,args.generate
+                                      ,args.chapters
+                                      ,args.seconds
+                                      )
+        if not files:
+            sys.exit("No files given; pass some or use --generate")
+
+        native_time, native = time_reader(mp4_chapters.read_chapters
+                                         ,files
+                                         ,args.repeat
+                                         )
+        print(f"native:  {len(files)} files in {native_time:.3f}s "
+              f"({native_time / len(files) * 1e3:.2f} ms/file)"
+             )
+        if shutil.which('ffprobe') is None:
+            print("ffprobe not found, skipping the comparison")
+            return
+        ffprobe_time, probed = time_reader(ffprobe_chapters, files, args.repeat)
+        print(f"ffprobe: {len(files)} files in {ffprobe_time:.3f}s "
+              f"({ffprobe_time / len(files) * 1e3:.2f} ms/file)"
+             )
+        print(f"speedup: {ffprobe_time / native_time:.1f}x")
+        mismatches = [path for path, a, b in zip(files, native, probed)
+                      if not same_chapters(a, b)
+                     ]
+        for path in mismatches:
+            print(f"chapters differ: {path}")
+        if mismatches:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
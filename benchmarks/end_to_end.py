@@ -0,0 +1,308 @@
+#! /usr/bin/env python3
+'''
+Benchmark the importer and the chapter updater against local fakes
+
+For each library size, runs audible-audiobookshelf-import.py's main() on a
+synthetic Audible library (see fake_audible.py) into an empty library
+served by a fake audiobookshelf (see fake_audiobookshelf.py), then runs
+audiobookshelf_chapter_updater.py's main() on a library of the same size in
+which some items have no ASIN and some have stale chapters.  Everything runs
+in a temporary directory; no Audible account or audiobookshelf server is
+needed, only ffmpeg.
+
+    python benchmarks/end_to_end.py
+    python benchmarks/end_to_end.py --sizes 100,1000 --latency 0.01
+'''
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import logging
+import os
+import pathlib
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent))
+import fake_audible
+import fake_audiobookshelf
+import fixtures
+import metrics
+
+
+def generate_fixture(path, seconds=3, chapters=3):
+    '''
+    Write a small m4b with chapters, stored with the index up front as
+    Audible's files are
+    '''
+    fixtures.write_chaptered_m4b(path, seconds, chapters, faststart=True)
+    return path.read_bytes()
+
+
+def write_config(directory, base_url, args):
+    '''
+    Write a config file for a run in `directory` and return its path
+    '''
+    config = f'''
+[audiobookshelf]
+base_url = "{base_url}"
+api_token = "benchmark"
+audiobooks_dir = "{directory / 'audiobooks'}"
+podcast_dir = "{directory / 'podcasts'}"
+scan_batch_window = {args.scan_batch_window}
+poll_interval = {args.poll_interval}
+max_poll_interval = {args.max_poll_interval}
+item_timeout = 600
+
+[audible]
+auth_file = "{directory / 'unused-auth.json'}"
+quality = "best"
+activation_bytes = "00000000"
+
+[files]
+audible_download_dir = "{directory / 'downloads'}"
+
+[database]
+location = "{directory / 'import.db'}"
+
+[pipeline]
+metadata_workers = {args.metadata_workers}
+convert_workers = {args.convert_workers}
+
+[chapter_updater]
+concurrency = {args.updater_concurrency}
+progress_every = 1000000
+
+[metrics]
+json_file = "{directory / 'report.json'}"
+'''
+    for name in ('audiobooks', 'podcasts', 'downloads'):
+        (directory / name).mkdir()
+    path = directory / 'config.toml'
+    path.write_text(config)
+    return path
+
+
+def load_script(path, name, config_file):
+    '''
+    Import one of the scripts fresh, reading `config_file`
+    '''
+    os.environ['AUDIBLE_AUDIOBOOKSHELF_CONFIG_FILE'] = str(config_file)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_import(size, content, args):
+    '''
+    Import a library of `size` titles into an empty fake audiobookshelf
+    '''
+    catalog = fake_audible.generate_catalog(size, seed=args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = pathlib.Path(tmp)
+        shelf = fake_audiobookshelf.FakeAudiobookshelf(tmp / 'audiobooks'
+                                                      ,catalog.chapters
+                                                      ,latency=args.latency
+                                                      ,scan_delay=args.scan_delay
+                                                      )
+        config_file = write_config(tmp, shelf.start(), args)
+        try:
+            importer = load_script(ROOT / 'audible-audiobookshelf-import.py'
+                                  ,'audible_audiobookshelf_import'
+                                  ,config_file
+                                  )
+            audible = fake_audible.FakeAudibleClient(catalog
+                                                    ,content
+                                                    ,latency=args.latency
+                                                    )
+            importer.audible_api._client = audible
+            metrics.REGISTRY = metrics.Metrics()
+            started = time.perf_counter()
+            importer.main([])
+            elapsed = time.perf_counter() - started
+        finally:
+            shelf.stop()
+        con = sqlite3.connect(tmp / 'import.db')
+        books = con.execute('SELECT count(*) FROM books').fetchone()[0]
+        episodes = con.execute('SELECT count(*) FROM podcast_episodes').fetchone()[0]
+        cached_products = con.execute('SELECT count(*) FROM product_cache').fetchone()[0]
+        cached_downloads = con.execute('SELECT count(*) FROM content_cache').fetchone()[0]
+        con.close()
+        report = json.loads((tmp / 'report.json').read_text())
+    if books != len(catalog.books):
+        print(f"  warning: imported {books} of {len(catalog.books)} books")
+    if cached_downloads != audible.requests['download']:
+        print(f"  warning: {cached_downloads} of {audible.requests['download']} "
+              f"downloads are in the download cache"
+             )
+    return {'phase': 'import'
+           ,'size': size
+           ,'seconds': elapsed
+           ,'done': books + episodes
+           ,'audible_requests': sum(audible.requests.values())
+           ,'abs_requests': sum(shelf.requests.values())
+           ,'detail': {'audible': dict(audible.requests)
+                      ,'audiobookshelf': dict(shelf.requests)
+                      ,'item_wait_seconds': _histogram_sum(report
+                                                          ,'abs_item_wait_seconds'
+                                                          )
+                      ,'dedup_seconds': _histogram_sum(report, 'dedup_seconds')
+                      ,'cached_products': cached_products
+                      ,'cached_downloads': cached_downloads
+                      }
+           }
+
+
+def _histogram_sum(report, name):
+    return sum(h['sum'] for h in report['histograms'] if h['name'] == name)
+
+
+def seed_updater_library(catalog, shelf, audiobooks_dir):
+    '''
+    Fill the fake audiobookshelf with one item per book: every fifth item
+    has no ASIN (only the .m4b file names tell it, as for books shelved by
+    hand), and every other item has out-of-date chapters
+    '''
+    for n, asin in enumerate(catalog.books):
+        product = catalog.products[asin]
+        files = [asin]
+        if product['content_delivery_type'] == 'MultiPartBook':
+            files = [rel['asin'] for rel in product['relationships']]
+        rel_path = f"Author {n % 500}/{product['title']}"
+        folder = audiobooks_dir / rel_path
+        folder.mkdir(parents=True)
+        for file_asin in files:
+            (folder / f"{file_asin}_Benchmark-AAX_44_128.m4b").write_bytes(b'')
+        chapters = [{'id': idx
+                    ,'start': ch['startOffsetSec']
+                    ,'end': ch['startOffsetSec'] + ch['lengthMs'] / 1000
+                    ,'title': ch['title']
+                    }
+                    for idx, ch in enumerate(catalog.chapters(asin))
+                   ]
+        if n % 2:
+            chapters = chapters[:1]
+        shelf.add_item(rel_path
+                      ,asin=None if n % 5 == 0 else asin
+                      ,chapters=chapters
+                      )
+
+
+def run_updater(size, content, args):
+    '''
+    Update the ASINs and chapters of a library of `size` titles
+    '''
+    catalog = fake_audible.generate_catalog(size, seed=args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = pathlib.Path(tmp)
+        shelf = fake_audiobookshelf.FakeAudiobookshelf(tmp / 'audiobooks'
+                                                      ,catalog.chapters
+                                                      ,latency=args.latency
+                                                      )
+        config_file = write_config(tmp, shelf.start(), args)
+        seed_updater_library(catalog, shelf, tmp / "audiobooks")
+        try:
+            updater = load_script(ROOT / 'audiobookshelf_chapter_updater.py'
+                                 ,'audiobookshelf_chapter_updater'
+                                 ,config_file
+                                 )
+            audible = fake_audible.FakeAudibleClient(catalog
+                                                    ,content
+                                                    ,latency=args.latency
+                                                    )
+            updater.AUDIBLE._client = audible
+            output = io.StringIO()
+            started = time.perf_counter()
+            with contextlib.redirect_stdout(output):
+                updater.main([])
+            elapsed = time.perf_counter() - started
+        finally:
+            shelf.stop()
+    missing = sum(1 for item in shelf.items.values()
+                  if not item['media']['metadata']['asin']
+                 )
+    if missing:
+        print(f"  warning: {missing} items still have no ASIN")
+    return {'phase': 'updater'
+           ,'size': size
+           ,'seconds': elapsed
+           ,'done': len(shelf.items)
+           ,'audible_requests': sum(audible.requests.values())
+           ,'abs_requests': sum(shelf.requests.values())
+           ,'detail': {'audible': dict(audible.requests)
+                      ,'audiobookshelf': dict(shelf.requests)
+                      }
+           }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='100,1000,10000'
+                       ,type=lambda value: [int(n) for n in value.split(',')]
+                       ,help="Library sizes to run (default 100,1000,10000)"
+                       )
+    parser.add_argument('--phases', default='import,updater'
+                       ,type=lambda value: value.split(',')
+                       ,help="Which of import,updater to run (default both)"
+                       )
+    parser.add_argument('--latency', type=float, default=0.002
+                       ,help="Seconds each fake Audible/audiobookshelf request "
+                             "takes (default 0.002)"
+                       )
+    parser.add_argument('--scan-delay', type=float, default=0.1
+                       ,help="Seconds a fake library scan takes (default 0.1)"
+                       )
+    parser.add_argument('--scan-batch-window', type=float, default=0.2)
+    parser.add_argument('--poll-interval', type=float, default=0.2)
+    parser.add_argument('--max-poll-interval', type=float, default=2.0)
+    parser.add_argument('--metadata-workers', type=int, default=16)
+    parser.add_argument('--convert-workers', type=int, default=4)
+    parser.add_argument('--updater-concurrency', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0
+                       ,help="Seed for the shape of the generated library"
+                       )
+    parser.add_argument('--json', type=pathlib.Path
+                       ,help="Also write the results, with request counts by "
+                             "endpoint, to this file"
+                       )
+    parser.add_argument('--verbose', action='store_true'
+                       ,help="Show the scripts' log output"
+                       )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if shutil.which('ffmpeg') is None:
+        sys.exit("ffmpeg is needed to generate and convert the test files")
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR)
+    with tempfile.TemporaryDirectory() as tmp:
+        content = generate_fixture(pathlib.Path(tmp) / 'fixture.m4b')
+
+    runners = {'import': run_import, 'updater': run_updater}
+    results = []
+    print(f"{'phase':<8} {'titles':>7} {'seconds':>9} {'titles/s':>9} "
+          f"{'audible req':>12} {'abs req':>8}"
+         )
+    for size in args.sizes:
+        for phase in args.phases:
+            result = runners[phase](size, content, args)
+            results.append(result)
+            print(f"{phase:<8} {size:>7} {result['seconds']:>9.1f} "
+                  f"{size / result['seconds']:>9.1f} "
+                  f"{result['audible_requests']:>12} {result['abs_requests']:>8}"
+                 )
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,311 @@
+'''
+In-process stand-in for the Audible API, for benchmarks
+
+generate_catalog() builds a synthetic library of N titles: single-part
+books, multi-part books with their parts, and podcasts with seasons and
+episodes.  FakeAudibleClient answers the calls the importer and the chapter
+updater make through audible.Client (library pages, catalog lookups, AAX
+download links, licenses for DRM-free episodes and downloads) from that
+catalog, and serves the same small unencrypted m4b for every download.
+ffmpeg ignores the decryption options for unencrypted input, so the files
+convert like real AAX files.
+
+Assign an instance to AudibleAPI._client to use it instead of the real
+client.
+'''
+
+import collections
+import random
+import threading
+import time
+import types
+import urllib.parse
+
+RELEASE_DATE = "2020-01-01"
+CODECS = [{'name': 'aax_22_32', 'enhanced_codec': 'LC_32_22050_stereo'}
+         ,{'name': 'aax_44_128', 'enhanced_codec': 'LC_128_44100_stereo'}
+         ]
+
+
+class Catalog:
+    '''
+    A synthetic Audible library
+
+    Attributes:
+        library (list): Library items, in the lean dedup-only shape.
+        products (dict): Full product of every title, part, season and
+                         episode, by ASIN.
+        books (list): ASINs of the single- and multi-part books.
+        podcasts (list): ASINs of the podcasts.
+        drm_free (set): ASINs of the episodes only offered without DRM.
+    '''
+    def __init__(self):
+        self.library = []
+        self.products = {}
+        self.books = []
+        self.podcasts = []
+        self.drm_free = set()
+
+    def chapters(self, asin, count=3):
+        '''
+        Chapters for a title, in audiobookshelf's search/chapters format
+        '''
+        length_ms = 1000
+        return [{'title': f"Chapter {i + 1}"
+                ,'startOffsetMs': i * length_ms
+                ,'startOffsetSec': i * length_ms // 1000
+                ,'lengthMs': length_ms
+                }
+                for i in range(count)
+               ]
+
+
+def _asin(kind, n):
+    return f"B{kind}{n:08d}"
+
+
+def _child(asin, relationship_type, sort):
+    return {'asin': asin
+           ,'relationship_to_product': 'child'
+           ,'relationship_type': relationship_type
+           ,'sort': str(sort)
+           }
+
+
+def _parent(asin, relationship_type):
+    return {'asin': asin
+           ,'relationship_to_product': 'parent'
+           ,'relationship_type': relationship_type
+           }
+
+
+def _product(asin, title, delivery_type, relationships, n):
+    return {'asin': asin
+           ,'title': title
+           ,'subtitle': None
+           ,'content_delivery_type': delivery_type
+           ,'release_date': RELEASE_DATE
+           ,'authors': [{'name': f"Author {n % 500}"}]
+           ,'narrators': [{'name': f"Narrator {n % 300}"}]
+           ,'series': ([{'title': f"Series {n % 200}", 'sequence': str(n % 7 + 1)}]
+                       if n % 3 == 0 else []
+                      )
+           ,'available_codecs': CODECS
+           ,'relationships': relationships
+           }
+
+
+def _episodes(catalog, parent_asin, parent_title, count, first, n):
+    '''
+    Add `count` episodes of a podcast or season to the catalog, numbered from
+    `first`, and return the parent's relationships to them; every other
+    episode is only offered without DRM
+    '''
+    relationships = []
+    for e in range(count):
+        asin = _asin(4, first + e)
+        catalog.products[asin] = _product(asin
+                                         ,f"{parent_title} Episode {e + 1}"
+                                         ,'PodcastEpisode'
+                                         ,[_parent(parent_asin, 'episode')]
+                                         ,n
+                                         )
+        if (first + e) % 2:
+            catalog.products[asin]['available_codecs'] = []
+            catalog.drm_free.add(asin)
+        relationships.append(_child(asin, 'episode', e + 1))
+    return relationships
+
+
+def generate_catalog(count, multipart_share=0.05, podcast_share=0.02, seed=0):
+    '''
+    Build a library of `count` titles
+
+    Args:
+        count (int): Titles in the library.
+        multipart_share (float): Share of titles that are multi-part books
+                                 (2 or 3 parts).
+        podcast_share (float): Share of titles that are podcasts; half of
+                               them have 2 seasons of 3 episodes, the rest 4
+                               episodes without seasons.
+        seed (int): Seed for choosing the kind of each title.
+    Returns:
+        Catalog: The library.
+    '''
+    rng = random.Random(seed)
+    catalog = Catalog()
+    parts = seasons = episodes = 0
+    for n in range(count):
+        roll = rng.random()
+        if roll < podcast_share:
+            asin = _asin(2, n)
+            relationships = []
+            if n % 2:
+                for s in range(2):
+                    season_asin = _asin(3, seasons)
+                    seasons += 1
+                    title = f"Podcast {n} Season {s + 1}"
+                    catalog.products[season_asin] = _product(
+                         season_asin
+                        ,title
+                        ,'PodcastSeason'
+                        ,[_parent(asin, 'season')
+                         ,*_episodes(catalog, season_asin, title, 3, episodes, n)
+                         ]
+                        ,n
+                    )
+                    episodes += 3
+                    relationships.append(_child(season_asin, 'season', s + 1))
+            else:
+                relationships = _episodes(catalog, asin, f"Podcast {n}", 4
+                                         ,episodes, n
+                                         )
+                episodes += 4
+            product = _product(asin, f"Podcast {n}", 'PodcastParent'
+                              ,relationships, n
+                              )
+            catalog.podcasts.append(asin)
+        elif roll < podcast_share + multipart_share:
+            asin = _asin(0, n)
+            relationships = []
+            for p in range(2 + n % 2):
+                part_asin = _asin(1, parts)
+                parts += 1
+                catalog.products[part_asin] = _product(part_asin
+                                                      ,f"Part {p + 1}"
+                                                      ,'SinglePartBook'
+                                                      ,[_parent(asin, 'component')]
+                                                      ,n
+                                                      )
+                relationships.append(_child(part_asin, 'component', p + 1))
+            product = _product(asin, f"Book {n}", 'MultiPartBook'
+                              ,relationships, n
+                              )
+            catalog.books.append(asin)
+        else:
+            asin = _asin(0, n)
+            product = _product(asin, f"Book {n}", 'SinglePartBook', [], n)
+            catalog.books.append(asin)
+        catalog.products[asin] = product
+        catalog.library.append({key: product[key]
+                                for key in ('asin'
+                                           ,'title'
+                                           ,'content_delivery_type'
+                                           ,'release_date'
+                                           ,'relationships'
+                                           )
+                               })
+    return catalog
+
+
+class FakeResponse:
+    '''
+    The parts of an httpx response the importer reads
+    '''
+    def __init__(self, status_code, headers=None, content=b''):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.content = content
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(f"HTTP {self.status_code}")
+
+    def iter_bytes(self, chunk_size=None):
+        chunk_size = chunk_size or len(self.content) or 1
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class FakeAudibleClient:
+    '''
+    Answers audible.Client calls from a Catalog
+
+    Args:
+        catalog (Catalog): Library and products to serve.
+        content (bytes): Audio served for every download.
+        latency (float): Seconds each request takes.
+    Attributes:
+        requests (collections.Counter): Requests made, by endpoint.
+    '''
+    def __init__(self, catalog, content, latency=0.0):
+        self.catalog = catalog
+        self.content = content
+        self.latency = latency
+        self.requests = collections.Counter()
+        self.auth = types.SimpleNamespace(locale=types.SimpleNamespace(domain='com'))
+        self._lock = threading.Lock()
+
+    def _request(self, endpoint):
+        with self._lock:
+            self.requests[endpoint] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get(self, path, **params):
+        if path == "1.0/library":
+            self._request('library')
+            if params.get('purchased_after'):
+                return {'items': []}
+            size = params.get('num_results', 100)
+            start = (params.get('page', 1) - 1) * size
+            return {'items': self.catalog.library[start:start + size]}
+        if path == "1.0/catalog/products":
+            self._request('catalog/products')
+            return {'products': [self.catalog.products[asin]
+                                 for asin in params['asins'].split(',')
+                                 if asin in self.catalog.products
+                                ]
+                   }
+        if path.startswith("1.0/catalog/products/"):
+            self._request('catalog/product')
+            return {'product': self.catalog.products[path.rsplit('/', 1)[1]]}
+        raise LookupError(f"Unexpected Audible API call: {path}")
+
+    def post(self, path, body=None, headers=None, **kwargs):
+        self._request('licenserequest')
+        asin = path.split('/')[2]
+        if asin in self.catalog.drm_free:
+            query = urllib.parse.urlencode({'asin': asin})
+            return {'content_license':
+                        {'status_code': 'Granted'
+                        ,'drm_type': 'Mpeg'
+                        ,'content_metadata':
+                             {'content_url': {'offline_url': f"https://cds.audible.com/mp3?{query}"}
+                             ,'content_reference': {'content_format': 'MPEG'}
+                             }
+                        }
+                   }
+        return {'content_license': {'status_code': 'Denied'
+                                   ,'message': "AAXC is not part of the benchmark"
+                                   }
+               }
+
+    def raw_request(self, method, url, params=None, headers=None, **kwargs):
+        if method == "HEAD":
+            self._request('aax_link')
+            query = urllib.parse.urlencode({'asin': params['key']})
+            return FakeResponse(302, {'location': f"https://cds.audible.com/download?{query}"})
+        self._request('download')
+        offset = 0
+        if headers and 'Range' in headers:
+            offset = int(headers['Range'].split('=')[1].rstrip('-'))
+            if offset >= len(self.content):
+                return FakeResponse(416)
+        body = self.content[offset:]
+        return FakeResponse(206 if offset else 200
+                           ,{'content-length': str(len(body))}
+                           ,body
+                           )
+
+    def close(self):
+        pass
@@ -0,0 +1,236 @@
+'''
+Local stand-in for an audiobookshelf server, for benchmarks
+
+Serves the parts of the audiobookshelf API the importer and the chapter
+updater use over HTTP on 127.0.0.1:
+
+    GET   /api/libraries
+    GET   /api/libraries/<id>/items   (limit, page, sort=addedAt, desc)
+    GET   /api/libraries/<id>/scan
+    GET   /api/items/<id>
+    GET   /api/search/chapters        (asin)
+    POST  /api/items/batch/update
+    PATCH /api/items/<id>/media
+    POST  /api/items/<id>/chapters
+
+A scan adds an item for every new directory with .m4b files under the
+audiobooks directory, like audiobookshelf's folder scanner, after
+`scan_delay` seconds.
+'''
+
+import collections
+import http.server
+import json
+import os
+import pathlib
+import random
+import threading
+import time
+import urllib.parse
+
+BOOK_LIBRARY_ID = 'lib_books'
+# Audiobookshelf reports item paths as seen by the server
+SERVER_ROOT = '/audiobooks'
+
+
+class FakeAudiobookshelf:
+    '''
+    Args:
+        audiobooks_dir (pathlib.Path): Directory the book library scans.
+        chapters_for (callable): Returns the search/chapters result for an
+                                 ASIN.
+        latency (float): Seconds each request takes.
+        scan_delay (float): Seconds a scan takes to add new items.
+    Attributes:
+        items (dict): Library items by id.
+        requests (collections.Counter): Requests handled, by endpoint.
+    '''
+    def __init__(self, audiobooks_dir, chapters_for, latency=0.0, scan_delay=0.0):
+        self.audiobooks_dir = pathlib.Path(audiobooks_dir)
+        self.chapters_for = chapters_for
+        self.latency = latency
+        self.scan_delay = scan_delay
+        self.items = {}
+        self.requests = collections.Counter()
+        self._paths = set()
+        self._updated_at = 0
+        self._lock = threading.Lock()
+        self._scan_lock = threading.Lock()
+        self._server = None
+
+    def _count(self, endpoint):
+        with self._lock:
+            self.requests[endpoint] += 1
+
+    def _touch(self, item):
+        # Timestamps in ms, strictly increasing so "added since" paging is
+        # exact
+        self._updated_at = max(self._updated_at + 1, int(time.time() * 1000))
+        item['updatedAt'] = self._updated_at
+        item.setdefault('addedAt', self._updated_at)
+
+    def add_item(self, rel_path, asin=None, chapters=None):
+        '''
+        Add an item for a folder of the book library
+
+        Args:
+            rel_path (str): Folder relative to the audiobooks directory.
+            asin (str): ASIN in the item's metadata, or None.
+            chapters (list): Chapters in audiobookshelf's {id, start, end,
+                             title} form.
+        Returns:
+            str: The item id.
+        '''
+        with self._lock:
+            item_id = f"li_{len(self.items):08d}"
+            item = {'id': item_id
+                   ,'libraryId': BOOK_LIBRARY_ID
+                   ,'path': f"{SERVER_ROOT}/{rel_path}"
+                   ,'relPath': str(rel_path)
+                   ,'mediaType': 'book'
+                   ,'media': {'metadata': {'title': pathlib.Path(rel_path).name
+                                          ,'asin': asin
+                                          }
+                             ,'chapters': chapters or []
+                             }
+                   }
+            self._touch(item)
+            self.items[item_id] = item
+            self._paths.add(str(rel_path))
+            return item_id
+
+    def scan(self):
+        '''
+        Add an item for every folder with .m4b files that has none yet
+        '''
+        with self._scan_lock:
+            self._scan()
+
+    def _scan(self):
+        for dirpath, dirnames, filenames in os.walk(self.audiobooks_dir):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            if any(name.endswith('.m4b') for name in filenames):
+                rel_path = str(pathlib.Path(dirpath).relative_to(self.audiobooks_dir))
+                if rel_path not in self._paths:
+                    self.add_item(rel_path)
+
+    def _update_media(self, item_id, payload):
+        with self._lock:
+            item = self.items[item_id]
+            if 'metadata' in payload:
+                item['media']['metadata'].update(payload['metadata'])
+            if 'chapters' in payload:
+                item['media']['chapters'] = payload['chapters']
+            self._touch(item)
+
+    def _list_items(self, query):
+        with self._lock:
+            items = list(self.items.values())
+        # Like audiobookshelf, sort only by the keys it supports and return
+        # any other sort in no particular order
+        sort = query.get('sort')
+        if sort in ('addedAt', 'size', 'mtimeMs', 'birthtimeMs'):
+            items.sort(key=lambda item: item.get(sort, 0)
+                      ,reverse=query.get('desc') == '1'
+                      )
+        elif sort:
+            random.Random(sort).shuffle(items)
+        limit = int(query.get('limit', 0))
+        if limit:
+            page = int(query.get('page', 0))
+            items = items[page * limit:(page + 1) * limit]
+        return {'results': items, 'total': len(self.items)}
+
+    def handle(self, method, path, query, body):
+        '''
+        Answer one API request
+
+        Returns:
+            tuple: (HTTP status, JSON-serializable body)
+        '''
+        parts = path.strip('/').split('/')[1:]
+        if method == 'GET' and parts == ['libraries']:
+            self._count('libraries')
+            return 200, {'libraries': [{'id': BOOK_LIBRARY_ID
+                                       ,'name': 'Audiobooks'
+                                       ,'mediaType': 'book'
+                                       }
+                                      ,{'id': 'lib_podcasts'
+                                       ,'name': 'Podcasts'
+                                       ,'mediaType': 'podcast'
+                                       }
+                                      ]}
+        if method == 'GET' and parts[:1] == ['libraries'] and parts[2:] == ['items']:
+            self._count('library items')
+            return 200, self._list_items(query)
+        if method == 'GET' and parts[:1] == ['libraries'] and parts[2:] == ['scan']:
+            self._count('scan')
+            timer = threading.Timer(self.scan_delay, self.scan)
+            timer.daemon = True
+            timer.start()
+            return 200, {}
+        if method == 'GET' and parts == ['search', 'chapters']:
+            self._count('search/chapters')
+            return 200, {'chapters': self.chapters_for(query.get('asin'))}
+        if method == 'POST' and parts == ['items', 'batch', 'update']:
+            self._count('batch update')
+            for update in body:
+                self._update_media(update['id'], update['mediaPayload'])
+            return 200, {'success': True, 'updates': len(body)}
+        if parts[:1] == ['items'] and len(parts) >= 2 and parts[1] in self.items:
+            item_id = parts[1]
+            if method == 'GET' and len(parts) == 2:
+                self._count('item')
+                return 200, self.items[item_id]
+            if method == 'PATCH' and parts[2:] == ['media']:
+                self._count('item media')
+                self._update_media(item_id, body)
+                return 200, {'updated': True}
+            if method == 'POST' and parts[2:] == ['chapters']:
+                self._count('item chapters')
+                self._update_media(item_id, body)
+                return 200, {'success': True}
+        self._count('not found')
+        return 404, {'error': f"{method} {path} is not part of the fake"}
+
+    def start(self):
+        '''
+        Start serving in a background thread
+
+        Returns:
+            str: Base URL of the server.
+        '''
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _respond(self):
+                url = urllib.parse.urlsplit(self.path)
+                query = dict(urllib.parse.parse_qsl(url.query))
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                if fake.latency:
+                    time.sleep(fake.latency)
+                status, data = fake.handle(self.command, url.path, query, body)
+                payload = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = do_PATCH = _respond
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
@@ -0,0 +1,43 @@
+'''
+Generated audio files shared by the benchmarks (needs ffmpeg)
+'''
+
+import subprocess
+
+
+def write_chaptered_m4b(path, seconds, chapters, faststart=False):
+    '''
+    Write a short m4b of a sine tone with `chapters` chapters of equal length
+
+    Args:
+        path (pathlib.Path): File to write; a .ffmetadata file is written
+                             next to it.
+        seconds (int): Length of the audio.
+        chapters (int): Number of chapters.
+        faststart (bool): Store the index up front, as Audible's files are.
+    Returns:
+        pathlib.Path: path
+    '''
+    metadata = [';FFMETADATA1', 'title=Benchmark']
+    length_ms = seconds * 1000 // chapters
+    for i in range(chapters):
+        metadata.extend(['[CHAPTER]'
+                        ,'TIMEBASE=1/1000'
+                        ,f'START={i * length_ms}'
+                        ,f'END={(i + 1) * length_ms}'
+                        ,f'title=Chapter {i + 1}'
+                        ])
+    metadata_file = path.with_suffix('.ffmetadata')
+    metadata_file.write_text('\n'.join(metadata) + '\n')
+    subprocess.run(['ffmpeg', '-v', 'error', '-y'
+                   ,'-f', 'lavfi', '-i', f'sine=duration={seconds}'
+                   ,'-i', metadata_file.as_posix()
+                   ,'-map', '0', '-map_metadata', '1', '-map_chapters', '1'
+                   ,'-c:a', 'aac', '-b:a', '32k'
+                   ,*(['-movflags', '+faststart'] if faststart else [])
+                   ,'-f', 'mp4'
+                   ,path.as_posix()
+                   ]
+                  ,check=True
+                  )
+    return path
@@ -0,0 +1,227 @@
+"""
+Pool of concurrent ffmpeg jobs
+
+Runs ffmpeg commands (ffmpeg-python streams or plain argument lists) as quiet
+subprocesses, several at a time, and reports the throughput of each job from
+ffmpeg's -progress output.
+"""
+
+import concurrent.futures
+import logging
+import os
+import subprocess
+import threading
+import time
+
+import ffmpeg
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ConversionResult:
+    """
+    Metrics for one finished ffmpeg job.
+    """
+    def __init__(self, description, output_bytes, media_seconds, elapsed):
+        self.description = description
+        self.output_bytes = output_bytes
+        self.media_seconds = media_seconds
+        self.elapsed = elapsed
+
+    @property
+    def bytes_per_second(self):
+        return self.output_bytes / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def realtime_factor(self):
+        """
+        Seconds of audio processed per second of wall time.
+        """
+        return self.media_seconds / self.elapsed if self.elapsed > 0 else 0.0
+
+    def summary(self):
+        return (f"{self.description}: {self.output_bytes / 1e6:.1f} MB in "
+                f"{self.elapsed:.1f}s ({self.bytes_per_second / 1e6:.1f} MB/s, "
+                f"{self.realtime_factor:.0f}x realtime)"
+               )
+
+
+def run_ffmpeg(command, description, stdin=None):
+    """
+    Run an ffmpeg command to completion.
+
+    ffmpeg's console output is captured instead of printed; only errors are
+    kept, and progress is read from -progress on stdout.
+
+    Args:
+        command: ffmpeg-python output node, e.g.
+            ffmpeg.input(...).output(...), or an argument list starting with
+            the ffmpeg executable for commands ffmpeg-python cannot express.
+        description (str): Name of the job for log messages.
+        stdin: Iterable of bytes chunks to feed to ffmpeg's standard input
+            (read with the "pipe:0" input), or None.
+    Returns:
+        ConversionResult: Size, duration and speed of the job.
+    Raises:
+        ffmpeg.Error: If ffmpeg exits with an error.
+        Exception: Whatever iterating `stdin` raised; ffmpeg is killed.
+    """
+    if hasattr(command, 'compile'):
+        command = command.compile()
+    args = [command[0]
+           ,'-nostats'
+           ,'-loglevel', 'error'
+           ,'-progress', 'pipe:1'
+           ,'-y'
+           ,*command[1:]
+           ]
+    started = time.monotonic()
+    process = subprocess.Popen(args
+                              ,stdin=subprocess.DEVNULL if stdin is None
+                                     else subprocess.PIPE
+                              ,stdout=subprocess.PIPE
+                              ,stderr=subprocess.PIPE
+                              )
+    # Drain stderr on the side so a chatty ffmpeg can never block on a full
+    # pipe while stdout is being read
+    stderr_chunks = []
+    stderr_reader = threading.Thread(target=lambda: stderr_chunks.append(
+                                                        process.stderr.read()
+                                                    )
+                                    ,daemon=True
+                                    )
+    stderr_reader.start()
+
+    feed_errors = []
+
+    def feed():
+        try:
+            for chunk in stdin:
+                process.stdin.write(chunk)
+        except BrokenPipeError:
+            # ffmpeg stopped reading; its own error is reported below
+            pass
+        except Exception as e:
+            feed_errors.append(e)
+            process.kill()
+        finally:
+            if hasattr(stdin, 'close'):
+                stdin.close()
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    if stdin is not None:
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+
+    progress = {}
+    stdout_lines = []
+    for raw_line in process.stdout:
+        stdout_lines.append(raw_line)
+        key, _, value = raw_line.decode('utf-8', 'replace').strip().partition('=')
+        progress[key] = value
+        if key == 'progress':
+            logger.debug("%s: %s of audio, %s bytes, speed %s"
+                        ,description
+                        ,progress.get('out_time')
+                        ,progress.get('total_size')
+                        ,progress.get('speed')
+                        )
+    process.wait()
+    stderr_reader.join()
+    if stdin is not None:
+        feeder.join()
+    elapsed = time.monotonic() - started
+    metrics.observe('conversion_seconds', elapsed)
+    if feed_errors or process.returncode != 0:
+        metrics.count('conversions', outcome='failed')
+    if feed_errors:
+        raise feed_errors[0]
+    if process.returncode != 0:
+        raise ffmpeg.Error('ffmpeg', b''.join(stdout_lines), b''.join(stderr_chunks))
+
+    def number(key):
+        try:
+            return int(progress.get(key, 0))
+        except ValueError:
+            return 0
+
+    result = ConversionResult(description
+                             ,output_bytes=number('total_size')
+                             ,media_seconds=number('out_time_us') / 1e6
+                             ,elapsed=elapsed
+                             )
+    metrics.count('conversions', outcome='ok')
+    metrics.count('conversion_output_bytes', result.output_bytes)
+    metrics.count('conversion_media_seconds', result.media_seconds)
+    return result
+
+
+class ConversionPool:
+    """
+    Runs up to `workers` ffmpeg jobs at once.
+
+    Args:
+        workers (int): Number of concurrent jobs; when 0/None it is derived
+            from the CPU count, capped by how many jobs the disk can feed.
+        disk_bandwidth (float): Sustained disk throughput in MB/s, or None if
+            unknown.
+        job_bandwidth (float): Disk throughput one codec-copy remux uses, in
+            MB/s.
+    """
+    def __init__(self, workers=None, disk_bandwidth=None, job_bandwidth=50.0):
+        if not workers:
+            workers = os.cpu_count() or 1
+            if disk_bandwidth:
+                workers = min(workers, max(1, int(disk_bandwidth // job_bandwidth)))
+        self.workers = workers
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+                              max_workers=workers
+                             ,thread_name_prefix='ffmpeg'
+                         )
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Build the pool from the [ffmpeg] config section.
+        """
+        return cls(workers=config.get('workers')
+                  ,disk_bandwidth=config.get('disk_bandwidth')
+                  ,job_bandwidth=config.get('job_bandwidth', 50.0)
+                  )
+
+    def submit(self, command, description, stdin=None):
+        """
+        Queue an ffmpeg job; see run_ffmpeg() for the accepted commands and
+        stdin.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the job's ConversionResult.
+        """
+        return self._executor.submit(self._run, command, description, stdin)
+
+    def run_all(self, jobs):
+        """
+        Run several (command, description) jobs concurrently and wait for all
+        of them.
+
+        Returns:
+            list: ConversionResult for each job, in order.
+        """
+        futures = [self.submit(command, description)
+                   for command, description in jobs
+                  ]
+        return [future.result() for future in futures]
+
+    @staticmethod
+    def _run(command, description, stdin=None):
+        result = run_ffmpeg(command, description, stdin=stdin)
+        logger.info("Converted %s", result.summary())
+        return result
+
+    def shutdown(self):
+        self._executor.shutdown()
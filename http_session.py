@@ -0,0 +1,133 @@
+"""
+Shared HTTP session for talking to Audiobookshelf
+
+Keeps connections alive between calls, retries rate-limited and failed
+requests with jittered exponential backoff, applies a default timeout and can
+cap the request rate.
+"""
+
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# The chapter and metadata updates replace what is on the server, so they are
+# as safe to repeat as the reads
+RETRY_METHODS = frozenset(("GET", "HEAD", "OPTIONS", "POST", "PATCH", "PUT"
+                          ,"DELETE"
+                          ))
+
+
+class JitteredRetry(Retry):
+    """
+    Retry whose exponential backoff is spread over [0, backoff) ("full
+    jitter"), so that concurrent workers that hit a 429 together do not all
+    retry at the same moment.  A Retry-After header from the server still
+    takes precedence.
+    """
+    def get_backoff_time(self):
+        return random.uniform(0, super().get_backoff_time())
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket allowing `rate` calls per second on average,
+    with bursts of up to `burst` calls.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a call is allowed.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst
+                                  ,self._tokens + (now - self._updated) * self.rate
+                                  )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class APISession(requests.Session):
+    """
+    requests.Session that applies a default timeout to every request and,
+    when given a RateLimiter, waits for it before sending.
+    """
+    def __init__(self, timeout=None, rate_limiter=None):
+        super().__init__()
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        return super().request(method, url, **kwargs)
+
+
+def record_response(response, *args, **kwargs):
+    """
+    Response hook counting each request and its latency in the run metrics.
+    """
+    method = response.request.method
+    metrics.count('abs_requests', method=method, status=response.status_code)
+    metrics.observe('abs_request_seconds'
+                   ,response.elapsed.total_seconds()
+                   ,method=method
+                   )
+
+
+def build_session(config):
+    """
+    Build a pooled, retrying session from a config section.
+
+    Recognised keys (all optional):
+        pool_size (int): Connections kept alive per host, default 10.
+        timeout (float): Seconds to wait for connect/read, default 30.
+        retries (int): Retries for errors and 429/5xx responses, default 5.
+        backoff_factor (float): Base of the exponential backoff, default 0.5.
+        rate_limit (float): Maximum requests per second, default 0 (no limit).
+
+    Args:
+        config (dict): Config section, e.g. config['audiobookshelf'].
+    Returns:
+        APISession: The configured session.
+    """
+    pool_size = config.get("pool_size", 10)
+    retry = JitteredRetry(total=config.get("retries", 5)
+                         ,backoff_factor=config.get("backoff_factor", 0.5)
+                         ,status_forcelist=RETRY_STATUSES
+                         ,allowed_methods=RETRY_METHODS
+                         ,respect_retry_after_header=True
+                         ,raise_on_status=False
+                         )
+    adapter = HTTPAdapter(pool_connections=pool_size
+                         ,pool_maxsize=pool_size
+                         ,max_retries=retry
+                         )
+    rate_limit = config.get("rate_limit", 0)
+    session = APISession(timeout=config.get("timeout", 30)
+                        ,rate_limiter=RateLimiter(rate_limit) if rate_limit else None
+                        )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["Accept-Encoding"] = "gzip, deflate"
+    session.hooks["response"].append(record_response)
+    return session
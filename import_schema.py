@@ -0,0 +1,89 @@
+"""
+Schema of the import database
+
+The import records, the Audible product cache and the download cache index
+all live in one SQLite file by default, so the tables of all of them are
+created and upgraded here, by whichever of them opens the file first.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Each entry upgrades the schema by one version; PRAGMA user_version records
+# how many have been applied.  Never edit an entry once released, append a
+# new one instead.
+MIGRATIONS = [
+    # 1: original, unindexed tables
+    ('CREATE TABLE IF NOT EXISTS books(asin, title, location);'
+     'CREATE TABLE IF NOT EXISTS podcast_episodes(asin, title, location);'
+    )
+    # 2: key both tables on ASIN, dropping any duplicate rows
+   ,('CREATE TABLE books_v2(asin TEXT PRIMARY KEY, title TEXT, '
+     '                      location TEXT);'
+     'INSERT OR IGNORE INTO books_v2 SELECT asin, title, location FROM books;'
+     'DROP TABLE books;'
+     'ALTER TABLE books_v2 RENAME TO books;'
+     'CREATE TABLE podcast_episodes_v2(asin TEXT PRIMARY KEY, title TEXT, '
+     '                                 location TEXT);'
+     'INSERT OR IGNORE INTO podcast_episodes_v2 '
+     '    SELECT asin, title, location FROM podcast_episodes;'
+     'DROP TABLE podcast_episodes;'
+     'ALTER TABLE podcast_episodes_v2 RENAME TO podcast_episodes;'
+    )
+    # 3: local copy of the Audible library and sync bookkeeping
+   ,('CREATE TABLE library_items(asin TEXT PRIMARY KEY, data TEXT);'
+     'CREATE TABLE sync_state(key TEXT PRIMARY KEY, value TEXT);'
+    )
+    # 4: progress of books part way through the import pipeline
+   ,('CREATE TABLE import_jobs(asin TEXT PRIMARY KEY, state TEXT, '
+     '                         data TEXT, updated_at REAL);'
+    )
+    # 5: chapters of each book, by where they were read from
+   ,('CREATE TABLE chapters(asin TEXT, source TEXT, data TEXT, '
+     '                     PRIMARY KEY (asin, source));'
+    )
+    # 6: Audible catalog products (audible_client.ProductCache); it may
+    #    already exist, as the cache used to create it itself
+   ,('CREATE TABLE IF NOT EXISTS product_cache(asin TEXT, profile TEXT, '
+     '    data TEXT, fetched_at REAL, PRIMARY KEY (asin, profile));'
+    )
+    # 7: downloaded content (audible_download.ContentCache); it may already
+    #    exist, as the cache used to create it itself
+   ,('CREATE TABLE IF NOT EXISTS content_cache(asin TEXT, quality TEXT, '
+     '    kind TEXT, path TEXT, size INTEGER, mtime_ns INTEGER, sha256 TEXT, '
+     '    last_used REAL, PRIMARY KEY (asin, quality, kind));'
+    )
+]
+
+
+def upgrade(con):
+    """
+    Switch a database to WAL mode and apply the migrations it is missing.
+
+    Each migration runs in its own transaction together with the version
+    bump, and the version is read again once the write lock is held, so
+    connections opening the same file at once apply each migration once.
+
+    Args:
+        con (sqlite3.Connection): Connection to the database, with no
+            transaction open.
+    """
+    con.execute('PRAGMA journal_mode=WAL')
+    while True:
+        con.execute('BEGIN IMMEDIATE')
+        version = con.execute('PRAGMA user_version').fetchone()[0]
+        if version >= len(MIGRATIONS):
+            con.execute('ROLLBACK')
+            return
+        number = version + 1
+        logger.info("Upgrading import database to schema version %d", number)
+        try:
+            for statement in MIGRATIONS[version].split(';'):
+                if statement.strip():
+                    con.execute(statement)
+            con.execute(f'PRAGMA user_version = {number}')
+            con.execute('COMMIT')
+        except BaseException:
+            con.execute('ROLLBACK')
+            raise
@@ -0,0 +1,266 @@
+"""
+Run metrics
+
+Counters, gauges and timing histograms recorded while an import runs, and a
+report of them written at the end as JSON and in the Prometheus text format
+read by node_exporter's textfile collector.
+
+Modules record into the shared REGISTRY through the module-level functions:
+
+    with metrics.timer('download', kind='aax'):
+        ...
+    metrics.count('download_bytes', len(chunk))
+"""
+
+import bisect
+import contextlib
+import json
+import os
+import pathlib
+import threading
+import time
+
+# Upper bounds (seconds) of the histogram buckets; they span single HTTP
+# requests as well as hour-long downloads and conversions
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60
+                  ,120, 300, 600, 1800, 3600
+                  )
+PROMETHEUS_PREFIX = 'audible_import_'
+
+
+class Histogram:
+    """
+    Distribution of observed values over fixed buckets.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.buckets, value)
+        if idx < len(self.buckets):
+            self.counts[idx] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """
+        Return (upper bound, observations <= bound) for each bucket.
+        """
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Metrics:
+    """
+    Thread-safe store of counters, gauges and histograms, each identified by
+    a name and a set of labels.
+
+    Args:
+        buckets (tuple): Histogram bucket upper bounds.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def count(self, name, value=1, **labels):
+        """
+        Add `value` to a counter.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        """
+        Set a gauge.
+        """
+        with self._lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        """
+        Add an observation to a histogram.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(self.buckets)
+            self.histograms[key].observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """
+        Time the enclosed block into the histogram `<name>_seconds`, also
+        when it raises.
+        """
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(f"{name}_seconds", time.monotonic() - started, **labels)
+
+    def record_stages(self, stage_stats):
+        """
+        Record the StageStats of a finished pipeline as gauges.
+        """
+        for stats in stage_stats:
+            for outcome in ('processed', 'dropped', 'failed'):
+                self.gauge('stage_items'
+                          ,getattr(stats, outcome)
+                          ,stage=stats.name
+                          ,outcome=outcome
+                          )
+            self.gauge('stage_busy_seconds', stats.busy_seconds, stage=stats.name)
+            self.gauge('stage_wall_seconds', stats.wall_seconds, stage=stats.name)
+
+    def report(self):
+        """
+        Return everything recorded so far as a JSON-serializable dict.
+        """
+        with self._lock:
+            return {'started': self.started
+                   ,'duration_seconds': time.time() - self.started
+                   ,'counters': [{'name': name
+                                 ,'labels': dict(labels)
+                                 ,'value': value
+                                 }
+                                 for (name, labels), value
+                                 in sorted(self.counters.items())
+                                ]
+                   ,'gauges': [{'name': name
+                               ,'labels': dict(labels)
+                               ,'value': value
+                               }
+                               for (name, labels), value
+                               in sorted(self.gauges.items())
+                              ]
+                   ,'histograms': [{'name': name
+                                   ,'labels': dict(labels)
+                                   ,'count': histogram.count
+                                   ,'sum': histogram.sum
+                                   ,'buckets': {str(bound): count
+                                               for bound, count
+                                               in histogram.cumulative()
+                                               }
+                                   }
+                                   for (name, labels), histogram
+                                   in sorted(self.histograms.items())
+                                  ]
+                   }
+
+    def prometheus(self):
+        """
+        Return everything recorded so far in the Prometheus text exposition
+        format.
+        """
+        report = self.report()
+        lines = []
+
+        def family(name, kind):
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}{name} {kind}")
+
+        family('run_start_time_seconds', 'gauge')
+        lines.append(f"{PROMETHEUS_PREFIX}run_start_time_seconds "
+                     f"{report['started']}"
+                    )
+        family('run_duration_seconds', 'gauge')
+        lines.append(f"{PROMETHEUS_PREFIX}run_duration_seconds "
+                     f"{report['duration_seconds']}"
+                    )
+        for section, kind, suffix in (('counters', 'counter', '_total')
+                                     ,('gauges', 'gauge', '')
+                                     ):
+            previous = None
+            for metric in report[section]:
+                name = metric['name'] + suffix
+                if name != previous:
+                    family(name, kind)
+                    previous = name
+                lines.append(f"{PROMETHEUS_PREFIX}{name}"
+                             f"{_labels(metric['labels'])} {metric['value']}"
+                            )
+        previous = None
+        for metric in report['histograms']:
+            name = metric['name']
+            if name != previous:
+                family(name, 'histogram')
+                previous = name
+            for bound, count in metric['buckets'].items():
+                lines.append(f"{PROMETHEUS_PREFIX}{name}_bucket"
+                             f"{_labels({**metric['labels'], 'le': bound})} "
+                             f"{count}"
+                            )
+            lines.append(f"{PROMETHEUS_PREFIX}{name}_bucket"
+                         f"{_labels({**metric['labels'], 'le': '+Inf'})} "
+                         f"{metric['count']}"
+                        )
+            lines.append(f"{PROMETHEUS_PREFIX}{name}_sum"
+                         f"{_labels(metric['labels'])} {metric['sum']}"
+                        )
+            lines.append(f"{PROMETHEUS_PREFIX}{name}_count"
+                         f"{_labels(metric['labels'])} {metric['count']}"
+                        )
+        return '\n'.join(lines) + '\n'
+
+    def write(self, json_file=None, prometheus_file=None):
+        """
+        Write the report to the given files.  Each file is replaced in one
+        step, so node_exporter never reads a half-written report.
+        """
+        if json_file:
+            _write_atomic(json_file, json.dumps(self.report(), indent=2))
+        if prometheus_file:
+            _write_atomic(prometheus_file, self.prometheus())
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"'
+                          for key, value in sorted(labels.items())
+                         ) + '}'
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\')
+                      .replace('"', '\\"')
+                      .replace('\n', '\\n')
+           )
+
+
+def _write_atomic(path, text):
+    path = pathlib.Path(path).expanduser()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    tmp_path.write_text(text)
+    os.replace(tmp_path, path)
+
+
+REGISTRY = Metrics()
+
+
+def count(name, value=1, **labels):
+    REGISTRY.count(name, value, **labels)
+
+
+def gauge(name, value, **labels):
+    REGISTRY.gauge(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    REGISTRY.observe(name, value, **labels)
+
+
+def timer(name, **labels):
+    return REGISTRY.timer(name, **labels)
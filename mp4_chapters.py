@@ -0,0 +1,241 @@
+"""
+Fast chapter reader for MP4 files (m4b, aax, aaxc)
+
+Reads chapters straight from the container instead of running ffprobe: the
+file is memory-mapped and only the atom headers on the way to the chapter
+data are touched, so the audio payload is never read.  Both Nero chapters
+(moov/udta/chpl) and QuickTime chapter tracks (a text track referenced by a
+tref/chap atom) are understood; like ffmpeg, chpl wins when both exist.
+The chapter data of Audible files is not encrypted, so no keys are needed.
+"""
+
+import mmap
+import struct
+
+# chpl start times are in units of 100ns
+CHPL_TIMESCALE = 10_000_000
+
+
+class MP4Error(ValueError):
+    """
+    The file is not an MP4 file, or its structure is damaged.
+    """
+
+
+def _atoms(buf, start, end):
+    """
+    Yield (type, payload start, end) of each atom between start and end.
+    """
+    pos = start
+    while pos + 8 <= end:
+        size, kind = struct.unpack_from('>I4s', buf, pos)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', buf, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            raise MP4Error(f"Bad {kind!r} atom at offset {pos}")
+        yield kind, pos + header, pos + size
+        pos += size
+
+
+def _child(buf, start, end, kind):
+    for child_kind, child_start, child_end in _atoms(buf, start, end):
+        if child_kind == kind:
+            return child_start, child_end
+    return None
+
+
+def _path(buf, start, end, *kinds):
+    span = (start, end)
+    for kind in kinds:
+        span = _child(buf, *span, kind)
+        if span is None:
+            return None
+    return span
+
+
+def _timescale_and_duration(buf, start):
+    """
+    Read the timescale and duration of an mvhd or mdhd atom.
+    """
+    if buf[start] == 1:
+        return struct.unpack_from('>IQ', buf, start + 20)
+    return struct.unpack_from('>II', buf, start + 12)
+
+
+def _chpl_chapters(buf, start, end):
+    version = buf[start]
+    pos = start + 4
+    if version:
+        pos += 4
+    count = buf[pos]
+    pos += 1
+    chapters = []
+    for _ in range(count):
+        if pos + 9 > end:
+            raise MP4Error("Truncated chpl atom")
+        chapter_start, title_length = struct.unpack_from('>QB', buf, pos)
+        pos += 9
+        title = bytes(buf[pos:pos + title_length]).decode('utf-8', 'replace')
+        pos += title_length
+        chapters.append((chapter_start / CHPL_TIMESCALE, title))
+    return chapters
+
+
+def _track_id(buf, trak_start, trak_end):
+    tkhd = _child(buf, trak_start, trak_end, b'tkhd')
+    if tkhd is None:
+        return None
+    offset = 20 if buf[tkhd[0]] == 1 else 12
+    return struct.unpack_from('>I', buf, tkhd[0] + offset)[0]
+
+
+def _chapter_track_ids(buf, trak_start, trak_end):
+    chap = _path(buf, trak_start, trak_end, b'tref', b'chap')
+    if chap is None:
+        return []
+    return list(struct.unpack_from(f'>{(chap[1] - chap[0]) // 4}I'
+                                  ,buf
+                                  ,chap[0]
+                                  ))
+
+
+def _table(buf, span, fmt):
+    """
+    Read a sample table atom: version/flags, entry count, then entries.
+    """
+    start = span[0] + 4
+    count = struct.unpack_from('>I', buf, start)[0]
+    size = struct.calcsize('>' + fmt)
+    if start + 4 + count * size > span[1]:
+        raise MP4Error("Truncated sample table")
+    return [struct.unpack_from('>' + fmt, buf, start + 4 + i * size)
+            for i in range(count)
+           ]
+
+
+def _decode_text_sample(data):
+    if len(data) < 2:
+        return ''
+    length = struct.unpack_from('>H', data)[0]
+    text = data[2:2 + length]
+    if text[:2] in (b'\xfe\xff', b'\xff\xfe'):
+        return text.decode('utf-16', 'replace')
+    return text.decode('utf-8', 'replace')
+
+
+def _track_chapters(buf, trak_start, trak_end):
+    mdia = _child(buf, trak_start, trak_end, b'mdia')
+    mdhd = _child(buf, *mdia, b'mdhd')
+    timescale, _ = _timescale_and_duration(buf, mdhd[0])
+    stbl = _path(buf, *mdia, b'minf', b'stbl')
+    if stbl is None:
+        return []
+
+    durations = []
+    for count, delta in _table(buf, _child(buf, *stbl, b'stts'), 'II'):
+        durations.extend([delta] * count)
+
+    stsz = _child(buf, *stbl, b'stsz')
+    sample_size, sample_count = struct.unpack_from('>II', buf, stsz[0] + 4)
+    if sample_size:
+        sizes = [sample_size] * sample_count
+    else:
+        sizes = list(struct.unpack_from(f'>{sample_count}I', buf, stsz[0] + 12))
+
+    stco = _child(buf, *stbl, b'stco')
+    if stco is not None:
+        chunk_offsets = [offset for offset, in _table(buf, stco, 'I')]
+    else:
+        chunk_offsets = [offset
+                         for offset, in _table(buf, _child(buf, *stbl, b'co64'), 'Q')
+                        ]
+    stsc = _table(buf, _child(buf, *stbl, b'stsc'), 'III')
+
+    # Work out where each sample is: stsc gives the samples per chunk for
+    # runs of chunks, and samples sit back to back within a chunk
+    offsets = []
+    for i, (first_chunk, per_chunk, _) in enumerate(stsc):
+        last_chunk = stsc[i + 1][0] - 1 if i + 1 < len(stsc) else len(chunk_offsets)
+        for chunk in range(first_chunk, last_chunk + 1):
+            offset = chunk_offsets[chunk - 1]
+            for _ in range(per_chunk):
+                if len(offsets) == len(sizes):
+                    break
+                offsets.append(offset)
+                offset += sizes[len(offsets) - 1]
+
+    chapters = []
+    time = 0
+    for offset, size, duration in zip(offsets, sizes, durations):
+        if offset + size > len(buf):
+            raise MP4Error("Chapter text beyond the end of the file")
+        chapters.append((time / timescale
+                        ,_decode_text_sample(bytes(buf[offset:offset + size]))
+                        ))
+        time += duration
+    return chapters
+
+
+def _read(buf):
+    moov = _child(buf, 0, len(buf), b'moov')
+    if moov is None:
+        raise MP4Error("No moov atom")
+    mvhd = _child(buf, *moov, b'mvhd')
+    if mvhd is None:
+        raise MP4Error("No mvhd atom")
+    timescale, duration = _timescale_and_duration(buf, mvhd[0])
+    total = duration / timescale if timescale else 0.0
+
+    chapters = []
+    chpl = _path(buf, *moov, b'udta', b'chpl')
+    if chpl is not None:
+        chapters = _chpl_chapters(buf, *chpl)
+    if not chapters:
+        tracks = {}
+        chapter_track_ids = []
+        for kind, start, end in _atoms(buf, *moov):
+            if kind == b'trak':
+                tracks[_track_id(buf, start, end)] = (start, end)
+                chapter_track_ids.extend(_chapter_track_ids(buf, start, end))
+        for track_id in chapter_track_ids:
+            if track_id in tracks:
+                chapters = _track_chapters(buf, *tracks[track_id])
+                break
+
+    result = []
+    for idx, (start, title) in enumerate(chapters):
+        end = chapters[idx + 1][0] if idx + 1 < len(chapters) else total
+        result.append({'start_time': start
+                      ,'end_time': max(end, start)
+                      ,'title': title or f"Chapter {idx + 1}"
+                      })
+    return result
+
+
+def read_chapters(path):
+    """
+    Read the chapters of an MP4 file.
+
+    Args:
+        path (str or Path): File to read.
+    Returns:
+        list: A dict with 'start_time', 'end_time' (seconds) and 'title' for
+              each chapter, as extract_chapters() returns them; empty if the
+              file has no chapters.
+    Raises:
+        MP4Error: If the file is not an MP4 file or is damaged.
+    """
+    with open(path, 'rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise MP4Error(f"{path} is empty")
+        with buf, memoryview(buf) as view:
+            try:
+                return _read(view)
+            except (struct.error, IndexError, TypeError) as e:
+                raise MP4Error(f"Damaged MP4 file {path}: {e}") from e
@@ -0,0 +1,182 @@
+"""
+Staged import pipeline
+
+Runs a sequence of stages, each with its own pool of worker threads, connected
+by bounded queues so that e.g. downloads, ffmpeg conversions and
+audiobookshelf updates for different books overlap instead of running one
+book at a time.
+"""
+
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Sentinel placed on a stage's input queue to tell one worker to exit
+_STOP = object()
+
+
+class StageStats:
+    """
+    Thread-safe counters describing the work done by one pipeline stage.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.processed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+        self.first_start = None
+        self.last_end = None
+        self._lock = threading.Lock()
+
+    def record(self, started, ended, outcome):
+        """
+        Record one item handled by the stage.
+
+        Args:
+            started (float): time.monotonic() when work on the item began.
+            ended (float): time.monotonic() when work on the item finished.
+            outcome (str): One of "processed", "dropped" or "failed".
+        Returns:
+            int: Items handled so far, counting this one, as of the update.
+        """
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+            self.busy_seconds += ended - started
+            if self.first_start is None or started < self.first_start:
+                self.first_start = started
+            if self.last_end is None or ended > self.last_end:
+                self.last_end = ended
+            return self.handled
+
+    @property
+    def handled(self):
+        return self.processed + self.dropped + self.failed
+
+    @property
+    def wall_seconds(self):
+        if self.first_start is None:
+            return 0.0
+        return self.last_end - self.first_start
+
+    @property
+    def throughput(self):
+        """
+        Items handled per second of stage wall time.
+        """
+        wall = self.wall_seconds
+        return self.handled / wall if wall > 0 else 0.0
+
+    def summary(self):
+        return (f"{self.name}: {self.processed} processed, "
+                f"{self.dropped} dropped, {self.failed} failed in "
+                f"{self.wall_seconds:.1f}s "
+                f"({self.throughput:.3f} items/s, "
+                f"{self.busy_seconds:.1f}s busy)"
+               )
+
+
+class Stage:
+    """
+    One step of a pipeline.
+
+    Args:
+        name (str): Name used in logs and statistics.
+        func (callable): Called with each item; returns the item to hand to
+            the next stage, or None to drop it.
+        workers (int): Number of worker threads running func concurrently.
+    """
+    def __init__(self, name, func, workers=1):
+        if workers < 1:
+            raise ValueError(f"Stage {name} needs at least one worker")
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.stats = StageStats(name)
+
+
+class Pipeline:
+    """
+    Connects stages with bounded queues and runs them concurrently.
+
+    Args:
+        stages (list): Stage objects, in processing order.
+        queue_size (int): Maximum number of items waiting in front of each
+            stage.  A full queue blocks the previous stage, which keeps e.g.
+            downloads from running arbitrarily far ahead of conversions.
+        describe (callable): Returns a short description of an item for log
+            messages.
+    """
+    def __init__(self, stages, queue_size=2, describe=repr):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.describe = describe
+
+    def run(self, items):
+        """
+        Push every item through all stages and wait for them to finish.
+
+        Args:
+            items (iterable): Items for the first stage.  Consumed lazily, so
+                a generator keeps memory flat.
+        Returns:
+            list: The StageStats for each stage.
+        """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        threads = []
+        for idx, stage in enumerate(self.stages):
+            out_queue = queues[idx + 1] if idx + 1 < len(queues) else None
+            stage_threads = [threading.Thread(target=self._work
+                                             ,args=(stage
+                                                   ,queues[idx]
+                                                   ,out_queue
+                                                   )
+                                             ,name=f"{stage.name}-{n}"
+                                             ,daemon=True
+                                             )
+                             for n in range(stage.workers)
+                            ]
+            for thread in stage_threads:
+                thread.start()
+            threads.append(stage_threads)
+
+        try:
+            for item in items:
+                queues[0].put(item)
+        finally:
+            # Also when the items raise (or on Ctrl-C): the caller closes what
+            # the workers use once run() returns, so let them finish first.
+            # Shut the stages down in order: once every worker of a stage has
+            # exited nothing more can reach the next stage, so it can be
+            # stopped.
+            for in_queue, stage_threads in zip(queues, threads):
+                for _ in stage_threads:
+                    in_queue.put(_STOP)
+                for thread in stage_threads:
+                    thread.join()
+
+        for stage in self.stages:
+            logger.info("Stage %s", stage.stats.summary())
+        return [stage.stats for stage in self.stages]
+
+    def _work(self, stage, in_queue, out_queue):
+        while (item := in_queue.get()) is not _STOP:
+            started = time.monotonic()
+            try:
+                result = stage.func(item)
+            except Exception:
+                logger.exception("Stage %s failed for %s"
+                                ,stage.name
+                                ,self.describe(item)
+                                )
+                stage.stats.record(started, time.monotonic(), "failed")
+                continue
+            if result is None:
+                stage.stats.record(started, time.monotonic(), "dropped")
+                continue
+            stage.stats.record(started, time.monotonic(), "processed")
+            if out_queue is not None:
+                out_queue.put(result)
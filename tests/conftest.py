@@ -0,0 +1,47 @@
+import importlib.util
+import os
+import pathlib
+import sys
+
+import pytest
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+
+@pytest.fixture(scope='session')
+def importer(tmp_path_factory):
+    '''
+    The import script, loaded as a module with a config pointing into a
+    temporary directory (no server or Audible account is contacted)
+    '''
+    tmp = tmp_path_factory.mktemp('importer')
+    for name in ('audiobooks', 'podcasts', 'downloads'):
+        (tmp / name).mkdir()
+    config_file = tmp / 'config.toml'
+    config_file.write_text(f'''
+[audiobookshelf]
+base_url = "http://127.0.0.1:1"
+api_token = "test"
+audiobooks_dir = "{tmp / 'audiobooks'}"
+podcast_dir = "{tmp / 'podcasts'}"
+
+[audible]
+auth_file = "{tmp / 'auth.json'}"
+quality = "best"
+activation_bytes = "00000000"
+
+[files]
+audible_download_dir = "{tmp / 'downloads'}"
+
+[database]
+location = "{tmp / 'import.db'}"
+''')
+    os.environ['AUDIBLE_AUDIOBOOKSHELF_CONFIG_FILE'] = str(config_file)
+    spec = importlib.util.spec_from_file_location(
+                'audible_audiobookshelf_import'
+               ,ROOT / 'audible-audiobookshelf-import.py'
+           )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
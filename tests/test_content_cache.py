@@ -0,0 +1,35 @@
+import audible_download
+
+
+def download(tmp_path, asin, size):
+    path = tmp_path / f'{asin}.aax'
+    path.write_bytes(bytes(size))
+    return path
+
+
+def test_downloads_are_evicted_once_released(tmp_path):
+    cache = audible_download.ContentCache(tmp_path / 'import.db', max_bytes=250)
+    try:
+        first = download(tmp_path, 'B001', 100)
+        cache.put('B001', 'best', 'aax', first)
+        second = download(tmp_path, 'B002', 100)
+        cache.put('B002', 'best', 'aax', second)
+        third = download(tmp_path, 'B003', 100)
+        cache.put('B003', 'best', 'aax', third)
+        # Over the cap, but every download is still in use
+        assert first.exists() and second.exists() and third.exists()
+
+        cache.release(['B001', 'B002'])
+        # The least recently used released download goes first
+        assert not first.exists()
+        assert second.exists() and third.exists()
+        assert cache.get('B001', 'best', 'aax') is None
+
+        # A later download pushes out the remaining released one at once
+        cache.release(['B003'])
+        fourth = download(tmp_path, 'B004', 100)
+        cache.put('B004', 'best', 'aax', fourth)
+        assert not second.exists()
+        assert third.exists() and fourth.exists()
+    finally:
+        cache.close()
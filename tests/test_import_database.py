@@ -0,0 +1,102 @@
+import sqlite3
+
+import audible_client
+import audible_download
+import import_schema
+
+
+def baseline_database(path, rows):
+    '''
+    Create a database as the baseline script left it: unversioned, unindexed
+    tables, possibly with the same book recorded more than once
+    '''
+    con = sqlite3.connect(path)
+    con.execute('CREATE TABLE books(asin, title, location)')
+    con.execute('CREATE TABLE podcast_episodes(asin, title, location)')
+    con.executemany('INSERT INTO books VALUES (?, ?, ?)', rows)
+    con.commit()
+    con.close()
+
+
+def test_upgrade_baseline_database_with_duplicates(importer, tmp_path):
+    db_file = tmp_path / 'import.db'
+    baseline_database(db_file, [('B001', 'One', 'A/One')
+                               ,('B001', 'One', 'A/One')
+                               ,('B002', 'Two', 'A/Two')
+                               ])
+
+    db = importer.ImportDatabase(db_file)
+    try:
+        assert db.already_imported(['B001', 'B002', 'B003']) == {'B001', 'B002'}
+        version = db.cur.execute('PRAGMA user_version').fetchone()[0]
+        assert version == len(import_schema.MIGRATIONS)
+        rows = db.cur.execute('SELECT asin, title, location FROM books '
+                              'ORDER BY asin'
+                             ).fetchall()
+        assert rows == [('B001', 'One', 'A/One'), ('B002', 'Two', 'A/Two')]
+    finally:
+        db.close()
+
+
+def test_upgrade_keeps_cache_tables_created_before_migrations(tmp_path):
+    # Before migrations 6 and 7 the caches created their own tables
+    db_file = tmp_path / 'import.db'
+    con = sqlite3.connect(db_file)
+    for migration in import_schema.MIGRATIONS[:5]:
+        con.executescript(migration)
+    con.execute('PRAGMA user_version = 5')
+    con.execute('CREATE TABLE product_cache(asin TEXT, profile TEXT, '
+                'data TEXT, fetched_at REAL, PRIMARY KEY (asin, profile))'
+               )
+    con.execute("INSERT INTO product_cache VALUES ('B001', 'full', '{}', 0)")
+    con.commit()
+    con.close()
+
+    cache = audible_client.ProductCache(db_file)
+    cache.close()
+
+    con = sqlite3.connect(db_file)
+    assert con.execute('PRAGMA user_version').fetchone()[0] == 7
+    assert con.execute('SELECT count(*) FROM product_cache').fetchone()[0] == 1
+    con.close()
+
+
+def test_batched_records_do_not_lock_out_the_caches(importer, tmp_path):
+    db_file = tmp_path / 'import.db'
+    db = importer.ImportDatabase(db_file, commit_every=10)
+    products = audible_client.ProductCache(db_file)
+    products.con.execute('PRAGMA busy_timeout = 0')
+    content = audible_download.ContentCache(db_file)
+    content.con.execute('PRAGMA busy_timeout = 0')
+    download = tmp_path / 'B001.aax'
+    download.write_bytes(b'audio')
+    try:
+        db.record_book_as_imported('B001', 'One', tmp_path / 'A' / 'One'
+                                  ,tmp_path
+                                  )
+        assert not db.con.in_transaction
+        # Both would raise "database is locked" if the record held the lock
+        products.put('B001', 'full', {'asin': 'B001'})
+        content.put('B001', 'best', 'aax', download)
+        assert db.already_imported(['B001']) == {'B001'}
+    finally:
+        db.close()
+        products.close()
+        content.close()
+
+    con = sqlite3.connect(db_file)
+    assert con.execute('SELECT asin FROM books').fetchall() == [('B001',)]
+    con.close()
+
+
+def test_cleared_job_is_gone_before_it_is_written(importer, tmp_path):
+    db = importer.ImportDatabase(tmp_path / 'import.db', commit_every=10)
+    try:
+        db.save_job('B001', 'downloaded', {'artifacts': {}, 'values': {}})
+        db.clear_job('B001')
+        assert db.load_job('B001') is None
+        db.save_job('B001', 'converted', {'artifacts': {}, 'values': {}})
+        db.flush()
+        assert db.load_job('B001')[0] == 'converted'
+    finally:
+        db.close()
@@ -0,0 +1,103 @@
+import pytest
+import requests
+
+from audio_book_shelf import AudioBookShelf, MetadataBatch
+
+CHAPTERS = [{'title': 'One', 'startOffsetSec': 0, 'lengthMs': 1000}
+           ,{'title': 'Two', 'startOffsetSec': 1, 'lengthMs': 1000}
+           ]
+
+
+class FakeShelf:
+    '''
+    Records the update calls MetadataBatch makes; the batch endpoint fails
+    with `batch_status` if it is set
+    '''
+    build_chapter_payload = AudioBookShelf.build_chapter_payload
+
+    def __init__(self, batch_status=None):
+        self.batch_status = batch_status
+        self.calls = []
+
+    def batch_update_items(self, updates):
+        self.calls.append(('batch', [update['id'] for update in updates]))
+        if self.batch_status is not None:
+            response = requests.Response()
+            response.status_code = self.batch_status
+            raise requests.HTTPError(f"HTTP {self.batch_status}"
+                                    ,response=response
+                                    )
+        return {'success': True}
+
+    def update_item_asin(self, library_item_id, asin):
+        self.calls.append(('asin', library_item_id))
+
+    def update_item_chapters(self, library_item_id, chapters):
+        self.calls.append(('chapters', library_item_id))
+
+
+def test_changes_for_an_item_are_merged_into_one_batch():
+    shelf = FakeShelf()
+    batch = MetadataBatch(shelf, batch_size=2)
+    done = []
+    batch.update_item('li_1', asin='B001', on_done=lambda: done.append('li_1'))
+    batch.update_item('li_1', chapters=CHAPTERS)
+    batch.update_item('li_2', asin='B002', on_done=lambda: done.append('li_2'))
+
+    assert shelf.calls == [('batch', ['li_1', 'li_2'])]
+    assert batch.requests == 1
+    assert sorted(done) == ['li_1', 'li_2']
+
+
+@pytest.mark.parametrize('status', [404, 405])
+def test_falls_back_to_one_request_per_item(status):
+    shelf = FakeShelf(batch_status=status)
+    batch = MetadataBatch(shelf)
+    done = []
+    batch.update_item('li_1', asin='B001', chapters=CHAPTERS
+                     ,on_done=lambda: done.append('li_1')
+                     )
+    batch.update_item('li_2', asin='B002', on_done=lambda: done.append('li_2'))
+    batch.flush()
+
+    assert shelf.calls == [('batch', ['li_1', 'li_2'])
+                          ,('asin', 'li_1')
+                          ,('chapters', 'li_1')
+                          ,('asin', 'li_2')
+                          ]
+    assert not batch.batch_supported
+    assert batch.failed == 0
+    assert sorted(done) == ['li_1', 'li_2']
+
+    # Later flushes go straight to the per-item requests
+    shelf.calls.clear()
+    batch.update_item('li_3', asin='B003')
+    batch.flush()
+    assert shelf.calls == [('asin', 'li_3')]
+
+
+def test_other_batch_errors_fail_the_items():
+    shelf = FakeShelf(batch_status=500)
+    batch = MetadataBatch(shelf)
+    done = []
+    batch.update_item('li_1', asin='B001', on_done=lambda: done.append('li_1'))
+    batch.flush()
+
+    assert shelf.calls == [('batch', ['li_1'])]
+    assert batch.batch_supported
+    assert batch.failed == 1
+    assert done == []
+
+
+def test_unchanged_chapters_are_not_sent():
+    shelf = FakeShelf()
+    batch = MetadataBatch(shelf)
+    current = shelf.build_chapter_payload(CHAPTERS)
+    done = []
+    batch.update_item('li_1', chapters=CHAPTERS, current_chapters=current
+                     ,on_done=lambda: done.append('li_1')
+                     )
+    batch.flush()
+
+    assert shelf.calls == []
+    assert done == ['li_1']
@@ -0,0 +1,197 @@
+import struct
+
+import pytest
+
+import mp4_chapters
+from mp4_chapters import MP4Error, read_chapters
+
+
+def atom(kind, *payload):
+    data = b''.join(payload)
+    return struct.pack('>I4s', 8 + len(data), kind) + data
+
+
+def full_atom(kind, version, *payload):
+    return atom(kind, struct.pack('>B3x', version), *payload)
+
+
+def mvhd(timescale, duration, version=0):
+    if version:
+        return full_atom(b'mvhd', 1, struct.pack('>QQIQ', 0, 0, timescale, duration)
+                        ,bytes(80)
+                        )
+    return full_atom(b'mvhd', 0, struct.pack('>IIII', 0, 0, timescale, duration)
+                    ,bytes(80)
+                    )
+
+
+def chpl(chapters, version=0):
+    entries = b''
+    for start, title in chapters:
+        encoded = title.encode('utf-8')
+        entries += struct.pack('>QB', int(start * mp4_chapters.CHPL_TIMESCALE)
+                              ,len(encoded)
+                              ) + encoded
+    reserved = bytes(4) if version else b''
+    return full_atom(b'chpl', version, reserved, bytes([len(chapters)]), entries)
+
+
+def text_sample(text):
+    encoded = text.encode('utf-8')
+    return struct.pack('>H', len(encoded)) + encoded
+
+
+def text_track_file(titles, durations, chunks, co64=False, offset_shift=0):
+    '''
+    Build an m4b whose chapters are a QuickTime text track: track 1 (audio)
+    references track 2 (text) through tref/chap, and the text samples sit in
+    mdat, `chunks` samples per chunk
+    '''
+    ftyp = atom(b'ftyp', b'M4B ', bytes(4))
+    samples = [text_sample(title) for title in titles]
+    mdat = atom(b'mdat', *samples)
+
+    data_start = len(ftyp) + 8
+    chunk_offsets = []
+    sample_idx = 0
+    position = data_start
+    for count in chunks:
+        chunk_offsets.append(position + offset_shift)
+        for sample in samples[sample_idx:sample_idx + count]:
+            position += len(sample)
+        sample_idx += count
+
+    stts = full_atom(b'stts', 0, struct.pack('>I', len(durations))
+                    ,*(struct.pack('>II', 1, duration) for duration in durations)
+                    )
+    stsz = full_atom(b'stsz', 0, struct.pack('>II', 0, len(samples))
+                    ,*(struct.pack('>I', len(sample)) for sample in samples)
+                    )
+    if co64:
+        chunk_table = full_atom(b'co64', 0, struct.pack('>I', len(chunk_offsets))
+                               ,*(struct.pack('>Q', o) for o in chunk_offsets)
+                               )
+    else:
+        chunk_table = full_atom(b'stco', 0, struct.pack('>I', len(chunk_offsets))
+                               ,*(struct.pack('>I', o) for o in chunk_offsets)
+                               )
+    stsc = full_atom(b'stsc', 0, struct.pack('>I', len(chunks))
+                    ,*(struct.pack('>III', idx + 1, count, 1)
+                       for idx, count in enumerate(chunks)
+                      )
+                    )
+    text_trak = atom(b'trak'
+                    ,full_atom(b'tkhd', 0, struct.pack('>III', 0, 0, 2), bytes(68))
+                    ,atom(b'mdia'
+                         ,full_atom(b'mdhd', 0, struct.pack('>IIII', 0, 0, 1000
+                                                           ,sum(durations)
+                                                           ))
+                         ,atom(b'minf'
+                              ,atom(b'stbl', stts, stsz, chunk_table, stsc)
+                              )
+                         )
+                    )
+    audio_trak = atom(b'trak'
+                     ,full_atom(b'tkhd', 0, struct.pack('>III', 0, 0, 1), bytes(68))
+                     ,atom(b'tref', atom(b'chap', struct.pack('>I', 2)))
+                     )
+    moov = atom(b'moov', mvhd(1000, sum(durations)), audio_trak, text_trak)
+    return ftyp + mdat + moov
+
+
+def write(tmp_path, data):
+    path = tmp_path / 'book.m4b'
+    path.write_bytes(data)
+    return path
+
+
+@pytest.mark.parametrize('version', [0, 1])
+def test_chpl_chapters(tmp_path, version):
+    moov = atom(b'moov'
+               ,mvhd(1000, 300_000, version=version)
+               ,atom(b'udta', chpl([(0, 'Opening'), (120.5, 'Middle')
+                                   ,(200, 'Ünïcode')
+                                   ]
+                                  ,version=version
+                                  ))
+               )
+    path = write(tmp_path, atom(b'ftyp', b'M4B ', bytes(4)) + moov)
+
+    assert read_chapters(path) == [
+         {'start_time': 0.0, 'end_time': 120.5, 'title': 'Opening'}
+        ,{'start_time': 120.5, 'end_time': 200.0, 'title': 'Middle'}
+        ,{'start_time': 200.0, 'end_time': 300.0, 'title': 'Ünïcode'}
+    ]
+
+
+def test_chpl_is_preferred_over_a_text_track(tmp_path):
+    data = text_track_file(['Track one', 'Track two'], [1000, 1000], [2])
+    udta = atom(b'udta', chpl([(0, 'Nero one'), (1, 'Nero two')]))
+    moov_start = data.index(b'moov') - 4
+    moov_size = struct.unpack_from('>I', data, moov_start)[0]
+    data = (data[:moov_start]
+           + struct.pack('>I', moov_size + len(udta))
+           + data[moov_start + 4:]
+           + udta
+           )
+
+    titles = [chapter['title'] for chapter in read_chapters(write(tmp_path, data))]
+    assert titles == ['Nero one', 'Nero two']
+
+
+@pytest.mark.parametrize('co64', [False, True])
+def test_text_track_chapters(tmp_path, co64):
+    data = text_track_file(['One', 'Two', 'Three']
+                          ,[1000, 1500, 500]
+                          ,chunks=[2, 1]
+                          ,co64=co64
+                          )
+
+    assert read_chapters(write(tmp_path, data)) == [
+         {'start_time': 0.0, 'end_time': 1.0, 'title': 'One'}
+        ,{'start_time': 1.0, 'end_time': 2.5, 'title': 'Two'}
+        ,{'start_time': 2.5, 'end_time': 3.0, 'title': 'Three'}
+    ]
+
+
+def test_no_chapters(tmp_path):
+    path = write(tmp_path, atom(b'ftyp', b'M4B ', bytes(4))
+                          + atom(b'moov', mvhd(1000, 1000))
+                )
+    assert read_chapters(path) == []
+
+
+def test_atom_larger_than_its_parent(tmp_path):
+    moov = atom(b'moov', mvhd(1000, 1000), atom(b'udta', chpl([(0, 'One')])))
+    # Claim the udta atom runs past the end of moov
+    udta_start = moov.index(b'udta') - 4
+    moov = (moov[:udta_start]
+           + struct.pack('>I', 4096)
+           + moov[udta_start + 4:]
+           )
+    with pytest.raises(MP4Error):
+        read_chapters(write(tmp_path, moov))
+
+
+def test_truncated_chpl(tmp_path):
+    chapters = chpl([(0, 'One'), (1, 'Two')])
+    # Claim three chapters where there are two
+    chapters = chapters[:12] + bytes([3]) + chapters[13:]
+    moov = atom(b'moov', mvhd(1000, 3000), atom(b'udta', chapters))
+    with pytest.raises(MP4Error):
+        read_chapters(write(tmp_path, moov))
+
+
+def test_chapter_text_beyond_the_end_of_the_file(tmp_path):
+    data = text_track_file(['One', 'Two'], [1000, 1000], [2]
+                          ,offset_shift=1_000_000
+                          )
+    with pytest.raises(MP4Error):
+        read_chapters(write(tmp_path, data))
+
+
+def test_not_an_mp4_file(tmp_path):
+    with pytest.raises(MP4Error):
+        read_chapters(write(tmp_path, atom(b'ftyp', b'M4B ', bytes(4))))
+    with pytest.raises(MP4Error):
+        read_chapters(write(tmp_path, b''))